@@ -0,0 +1,192 @@
+import math
+import time
+from collections import OrderedDict
+
+import jwt
+from jwt.exceptions import InvalidTokenError
+from starlette.routing import Match
+
+from metrics import admission_limit, admission_rejected
+from responses import ORJSONResponse
+from settings import ADMISSION_INITIAL_LIMIT, ADMISSION_MIN_LIMIT, ADMISSION_MAX_LIMIT, ADMISSION_LATENCY_TOLERANCE, \
+    RATE_LIMITS, SECRET_KEY, ALGORITHM
+
+# Admission control and rate limiting of this worker. A slow database shows up as growing latency: the limit of
+# the affected routes backs off and the excess is rejected at once with 503, instead of queueing until every
+# request times out together.
+
+# latency averages, the short one follows the current load, the long one the route's usual latency and rises
+# slowly, so a sustained slowdown keeps the limit down for about a thousand requests before it becomes the norm
+SHORT_ALPHA = 0.1
+LONG_ALPHA = 0.01
+LONG_RISE_ALPHA = 0.001
+# multiplicative decrease, at most once per round trip
+BACKOFF = 0.9
+# routes never limited: metrics must stay readable under overload, availability streams are long lived and idle
+EXEMPT_ROUTES = {"/metrics", "/api/books/availability"}
+# resolved (method, path) -> route, and token buckets kept per worker
+RESOLVED_PATHS = 10000
+RATE_LIMIT_BUCKETS = 100000
+
+
+def parse_rate_limits(value: str) -> dict:
+    """
+    :param value: "route=requests per second/burst,..."
+    :return: route -> (rate, burst)
+    """
+    limits = {}
+    for item in filter(None, (item.strip() for item in value.split(","))):
+        route, _, limit = item.rpartition("=")
+        rate, _, burst = limit.partition("/")
+        limits[route] = (float(rate), float(burst or rate))
+    return limits
+
+
+class AdaptiveLimit:
+    """
+    Concurrency limit of one route, AIMD on latency: the limit grows by about one per `limit` requests served
+    while they are as fast as usual and shrinks by BACKOFF when the recent latency exceeds the long term latency
+    by ADMISSION_LATENCY_TOLERANCE or the route fails with 5xx
+    """
+    __slots__ = ("limit", "in_flight", "short", "long", "last_decrease")
+
+    def __init__(self):
+        self.limit = float(ADMISSION_INITIAL_LIMIT)
+        self.in_flight = 0
+        self.short = None
+        self.long = None
+        self.last_decrease = 0.0
+
+    def acquire(self) -> bool:
+        if self.in_flight >= int(self.limit):
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self, latency: float, failed: bool):
+        self.in_flight -= 1
+        if self.long is None:
+            self.short = self.long = latency
+        else:
+            self.short += (latency - self.short) * SHORT_ALPHA
+            self.long += (latency - self.long) * (LONG_ALPHA if latency < self.long else LONG_RISE_ALPHA)
+        now = time.monotonic()
+        if failed or self.short > self.long * ADMISSION_LATENCY_TOLERANCE:
+            if now - self.last_decrease > self.short:
+                self.limit = max(ADMISSION_MIN_LIMIT, self.limit * BACKOFF)
+                self.last_decrease = now
+        elif self.in_flight + 1 >= self.limit / 2:
+            # only grow a limit that is in use
+            self.limit = min(ADMISSION_MAX_LIMIT, self.limit + 1 / self.limit)
+
+
+def user_key(scope) -> str:
+    """
+    Rate limit key: the token's user at the client address, the client address for requests without a valid
+    token. Clients sharing one token (an operator's admin token, a service account) each get their own bucket,
+    logging in again does not give a client a new one.
+    """
+    client = scope.get("client")
+    address = client[0] if client else "-"
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() == "bearer":
+                try:
+                    return f"user:{jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])['sub']}@{address}"
+                except (InvalidTokenError, KeyError):
+                    pass
+            break
+    return f"client:{address}"
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware applying the route's adaptive concurrency limit and, on expensive routes, per user and client
+    token bucket rate limits (RATE_LIMITS, see user_key). Rejected requests get 503 or 429 with Retry-After
+    without reaching the route.
+    """
+
+    def __init__(self, app, routes: list):
+        self.app = app
+        self.routes = routes
+        self.resolved = OrderedDict()
+        self.limits = {}
+        self.rate_limits = parse_rate_limits(RATE_LIMITS)
+        # (route, user_key) -> [tokens, last refill]
+        self.buckets = OrderedDict()
+
+    def resolve(self, scope):
+        """
+        Route serving the request, found the way the router finds it and remembered per method and path
+        """
+        key = (scope["method"], scope["path"])
+        route = self.resolved.get(key)
+        if route is None and key not in self.resolved:
+            route = next((route for route in self.routes if route.matches(scope)[0] == Match.FULL), None)
+            self.resolved[key] = route
+            if len(self.resolved) > RESOLVED_PATHS:
+                self.resolved.popitem(last=False)
+        return route
+
+    def take_token(self, path: str, scope) -> float:
+        """
+        :return: 0 when the request may run, else seconds until the user's bucket holds a token
+        """
+        rate, burst = self.rate_limits[path]
+        key = (path, user_key(scope))
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [burst, now]
+            if len(self.buckets) > RATE_LIMIT_BUCKETS:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / rate
+
+    async def reject(self, scope, receive, send, path: str, reason: str, status_code: int, retry_after: float):
+        admission_rejected.inc(scope["method"], path, reason)
+        detail = "Too many requests, please slow down" if reason == "rate_limit" else \
+            "Server is busy, please try again"
+        response = ORJSONResponse({"detail": detail}, status_code=status_code,
+                                  headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+        await response(scope, receive, send)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        route = self.resolve(scope)
+        if route is None or route.path in EXEMPT_ROUTES:
+            return await self.app(scope, receive, send)
+        path = route.path
+        # rejected requests are still reported under their route
+        scope["route"] = route
+        if path in self.rate_limits:
+            wait = self.take_token(path, scope)
+            if wait:
+                return await self.reject(scope, receive, send, path, "rate_limit", 429, wait)
+        limit = self.limits.get(path)
+        if limit is None:
+            limit = self.limits[path] = AdaptiveLimit()
+        if not limit.acquire():
+            return await self.reject(scope, receive, send, path, "overload", 503, limit.short or 1)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            limit.release(time.perf_counter() - start, status_code >= 500)
+            admission_limit.set(path, value=int(limit.limit))
@@ -0,0 +1,36 @@
+"""user book history indexes added
+
+Revision ID: 5b8e2d41c7a9
+Revises: 9c470e8547ef
+Create Date: 2026-10-17 15:02:18.640113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b8e2d41c7a9'
+down_revision = '9c470e8547ef'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_user_book_history_user_id_id', 'user_book_history', ['user_id', 'id'], unique=False)
+    op.create_index('ix_user_book_history_book_id_id', 'user_book_history', ['book_id', 'id'], unique=False)
+    op.create_index('ix_user_book_history_borrowed_date_id', 'user_book_history', ['borrowed_date', 'id'],
+                    unique=False)
+    op.create_index('ix_user_book_history_returned_date_id', 'user_book_history', ['returned_date', 'id'],
+                    unique=False)
+    # partial index of the open loans
+    op.create_index('ix_user_book_history_open_loans', 'user_book_history', ['user_id', 'book_id'], unique=False,
+                    postgresql_where=sa.text('returned_date IS NULL'), sqlite_where=sa.text('returned_date IS NULL'))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_user_book_history_open_loans', table_name='user_book_history')
+    op.drop_index('ix_user_book_history_returned_date_id', table_name='user_book_history')
+    op.drop_index('ix_user_book_history_borrowed_date_id', table_name='user_book_history')
+    op.drop_index('ix_user_book_history_book_id_id', table_name='user_book_history')
+    op.drop_index('ix_user_book_history_user_id_id', table_name='user_book_history')
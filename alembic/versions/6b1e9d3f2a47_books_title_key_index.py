@@ -0,0 +1,29 @@
+"""books title key index
+
+Revision ID: 6b1e9d3f2a47
+Revises: e3c9b7a15f02
+Create Date: 2026-10-17 21:40:12.530114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6b1e9d3f2a47'
+down_revision = 'e3c9b7a15f02'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # the title keyset orders by coalesce(title, ''), a NULL title broke the (title, id) comparison.
+    # Replaces the (title, id) index, or the expression index ``python -m models`` created on a new database:
+    # reflection skips expression indexes, it is dropped by name
+    op.execute("DROP INDEX IF EXISTS ix_books_title_id")
+    op.create_index('ix_books_title_id', 'books', [sa.text("coalesce(title, '')"), 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_books_title_id', table_name='books')
+    op.create_index('ix_books_title_id', 'books', ['title', 'id'], unique=False)
@@ -0,0 +1,56 @@
+"""books full text and trigram search on sqlite
+
+Revision ID: 8d2f6a1c4e90
+Revises: 6b1e9d3f2a47
+Create Date: 2026-10-17 22:18:45.902361
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2f6a1c4e90'
+down_revision = '6b1e9d3f2a47'
+branch_labels = None
+depends_on = None
+
+# (index, indexed columns, options) of the FTS5 indexes search uses on SQLite, as models.BOOK_SEARCH_DDL creates
+# them; Postgres has tsvector and pg_trgm (3f1d2c9a7b64)
+SEARCH_INDEXES = [
+    ('books_fts', ['title', 'author', 'description'], "tokenize='unicode61 remove_diacritics 2'"),
+    ('books_trgm', ['title', 'author'], "tokenize='trigram'"),
+]
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for index, columns, options in SEARCH_INDEXES:
+        listed = ', '.join(columns)
+        new = ', '.join(f'new.{column}' for column in columns)
+        old = ', '.join(f'old.{column}' for column in columns)
+        # IF NOT EXISTS, ``python -m models`` creates them on a new database
+        op.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5("
+                   f"{listed}, content='books', content_rowid='id', {options})")
+        # replaced, older ones fire on every update of a book, including count changes on borrow and return
+        for trigger in ('insert', 'delete', 'update'):
+            op.execute(f"DROP TRIGGER IF EXISTS {index}_{trigger}")
+        op.execute(f"CREATE TRIGGER {index}_insert AFTER INSERT ON books BEGIN "
+                   f"INSERT INTO {index}(rowid, {listed}) VALUES (new.id, {new}); END")
+        op.execute(f"CREATE TRIGGER {index}_delete AFTER DELETE ON books BEGIN "
+                   f"INSERT INTO {index}({index}, rowid, {listed}) VALUES ('delete', old.id, {old}); END")
+        op.execute(f"CREATE TRIGGER {index}_update AFTER UPDATE OF {listed} ON books BEGIN "
+                   f"INSERT INTO {index}({index}, rowid, {listed}) VALUES ('delete', old.id, {old}); "
+                   f"INSERT INTO {index}(rowid, {listed}) VALUES (new.id, {new}); END")
+        # index the existing books
+        op.execute(f"INSERT INTO {index}({index}) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    # books_fts stays, older revisions expect it from ``python -m models``
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for trigger in ('books_trgm_insert', 'books_trgm_delete', 'books_trgm_update'):
+        op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    op.execute("DROP TABLE IF EXISTS books_trgm")
@@ -0,0 +1,73 @@
+"""book rating summary added
+
+Revision ID: 9c470e8547ef
+Revises: 3f1d2c9a7b64
+Create Date: 2026-10-17 13:26:51.907342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c470e8547ef'
+down_revision = '3f1d2c9a7b64'
+branch_labels = None
+depends_on = None
+
+STAR_VALUE = "CASE rating WHEN 'ONE_STAR' THEN 1 WHEN 'TWO_STARS' THEN 2 WHEN 'THREE_STARS' THEN 3 " \
+             "WHEN 'FOUR_STARS' THEN 4 WHEN 'FIVE_STARS' THEN 5 END"
+
+
+def upgrade() -> None:
+    # ``python -m models`` (create_schema) may have created the table already, empty
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table('book_rating_summary'):
+        op.create_table('book_rating_summary',
+        sa.Column('book_id', sa.Integer(), nullable=False),
+        sa.Column('rating_sum', sa.Integer(), nullable=False),
+        sa.Column('rating_count', sa.Integer(), nullable=False),
+        sa.Column('rating_avg', sa.Float(), nullable=False),
+        sa.Column('stars_1', sa.Integer(), nullable=False),
+        sa.Column('stars_2', sa.Integer(), nullable=False),
+        sa.Column('stars_3', sa.Integer(), nullable=False),
+        sa.Column('stars_4', sa.Integer(), nullable=False),
+        sa.Column('stars_5', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['book_id'], ['books.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('book_id')
+        )
+        existing = set()
+    else:
+        existing = {index['name'] for index in inspector.get_indexes('book_rating_summary')}
+    if 'ix_book_rating_summary_avg_book' not in existing:
+        op.create_index('ix_book_rating_summary_avg_book', 'book_rating_summary', ['rating_avg', 'book_id'],
+                        unique=False)
+
+    # keep only the latest rating of every user for a book before enforcing uniqueness
+    op.execute(
+        "DELETE FROM user_book_rating WHERE id NOT IN "
+        "(SELECT MAX(id) FROM user_book_rating GROUP BY user_id, book_id)"
+    )
+    if 'uq_user_book_rating_user_book' not in {
+            constraint['name'] for constraint in inspector.get_unique_constraints('user_book_rating')}:
+        op.create_unique_constraint('uq_user_book_rating_user_book', 'user_book_rating', ['user_id', 'book_id'])
+
+    # backfill the aggregates from the existing ratings, unless they are kept already
+    if op.get_bind().execute(sa.text("SELECT 1 FROM book_rating_summary LIMIT 1")).first() is not None:
+        return
+    op.execute(
+        "INSERT INTO book_rating_summary "
+        "(book_id, rating_sum, rating_count, rating_avg, stars_1, stars_2, stars_3, stars_4, stars_5) "
+        "SELECT book_id, SUM(stars), COUNT(*), AVG(stars), "
+        "SUM(CASE WHEN stars = 1 THEN 1 ELSE 0 END), SUM(CASE WHEN stars = 2 THEN 1 ELSE 0 END), "
+        "SUM(CASE WHEN stars = 3 THEN 1 ELSE 0 END), SUM(CASE WHEN stars = 4 THEN 1 ELSE 0 END), "
+        "SUM(CASE WHEN stars = 5 THEN 1 ELSE 0 END) "
+        f"FROM (SELECT book_id, {STAR_VALUE} AS stars FROM user_book_rating WHERE book_id IS NOT NULL) AS ratings "
+        "GROUP BY book_id"
+    )
+
+
+def downgrade() -> None:
+    op.drop_constraint('uq_user_book_rating_user_book', 'user_book_rating', type_='unique')
+    op.drop_index('ix_book_rating_summary_avg_book', table_name='book_rating_summary')
+    op.drop_table('book_rating_summary')
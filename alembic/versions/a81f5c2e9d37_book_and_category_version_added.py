@@ -0,0 +1,29 @@
+"""book and category version added
+
+Revision ID: a81f5c2e9d37
+Revises: d4a7c3f0b918
+Create Date: 2026-10-17 18:12:44.301527
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a81f5c2e9d37'
+down_revision = 'd4a7c3f0b918'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    for table in ('books', 'categories'):
+        # ``python -m models`` (create_schema) may have run first, a new database has the column already
+        if 'version' not in {column['name'] for column in inspector.get_columns(table)}:
+            op.add_column(table, sa.Column('version', sa.Integer(), server_default=sa.text('1'), nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('categories', 'version')
+    op.drop_column('books', 'version')
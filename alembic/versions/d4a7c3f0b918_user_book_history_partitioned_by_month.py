@@ -0,0 +1,156 @@
+"""user book history partitioned by month
+
+Revision ID: d4a7c3f0b918
+Revises: 5b8e2d41c7a9
+Create Date: 2026-10-17 16:40:05.118204
+
+"""
+from datetime import date
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a7c3f0b918'
+down_revision = '5b8e2d41c7a9'
+branch_labels = None
+depends_on = None
+
+# partitions created ahead of the current month, api/book/archive_history.py keeps adding them
+MONTHS_AHEAD = 3
+
+HOT_COLUMNS = (
+    "id integer NOT NULL DEFAULT nextval('user_book_history_id_seq'::regclass), "
+    "user_id integer REFERENCES users (id), "
+    "book_id integer REFERENCES books (id), "
+    "borrowed_date date NOT NULL, "
+    "returned_date date, "
+    "action action_type"
+)
+ARCHIVE_COLUMNS = (
+    "id integer NOT NULL, "
+    "user_id integer, "
+    "book_id integer, "
+    "borrowed_date date NOT NULL, "
+    "returned_date date, "
+    "action action_type"
+)
+HOT_INDEXES = (
+    ('ix_user_book_history_id', ['id'], None),
+    ('ix_user_book_history_user_id_id', ['user_id', 'id'], None),
+    ('ix_user_book_history_book_id_id', ['book_id', 'id'], None),
+    ('ix_user_book_history_borrowed_date_id', ['borrowed_date', 'id'], None),
+    ('ix_user_book_history_returned_date_id', ['returned_date', 'id'], None),
+    ('ix_user_book_history_open_loans', ['user_id', 'book_id'], 'returned_date IS NULL'),
+)
+ARCHIVE_INDEXES = (
+    ('ix_user_book_history_archive_user_id_id', ['user_id', 'id'], None),
+    ('ix_user_book_history_archive_book_id_id', ['book_id', 'id'], None),
+    ('ix_user_book_history_archive_borrowed_date_id', ['borrowed_date', 'id'], None),
+)
+
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def rebuild(table, columns, indexes, partitioned, months=()):
+    """
+    Recreate the table (partitioned by borrowed_date month or not) and copy its rows over.
+    The rows move once, in this transaction; schedule the upgrade for a quiet hour on large histories.
+    :param months: first days of the months to create partitions for
+    """
+    old = f"{table}_old"
+    op.execute(f"ALTER TABLE {table} RENAME TO {old}")
+    # index and primary key names are schema wide, free them for the new table
+    for name in sa.inspect(op.get_bind()).get_indexes(old):
+        op.drop_index(name['name'], table_name=old)
+    op.execute(f"ALTER TABLE {old} DROP CONSTRAINT IF EXISTS {table}_pkey")
+
+    if partitioned:
+        op.execute(f"CREATE TABLE {table} ({columns}, PRIMARY KEY (id, borrowed_date)) "
+                   f"PARTITION BY RANGE (borrowed_date)")
+        # rows outside every monthly partition, e.g. when partitions were not created ahead in time
+        op.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+        for month in months:
+            op.execute(f"CREATE TABLE {table}_y{month.year:04d}m{month.month:02d} PARTITION OF {table} "
+                       f"FOR VALUES FROM ('{month}') TO ('{next_month(month)}')")
+    else:
+        op.execute(f"CREATE TABLE {table} ({columns}, PRIMARY KEY (id))")
+
+    op.execute(f"INSERT INTO {table} (id, user_id, book_id, borrowed_date, returned_date, action) "
+               f"SELECT id, user_id, book_id, borrowed_date, returned_date, action FROM {old}")
+    if table == 'user_book_history':
+        # keep the id sequence alive when the old table is dropped
+        op.execute("ALTER SEQUENCE user_book_history_id_seq OWNED BY user_book_history.id")
+    op.execute(f"DROP TABLE {old}")
+    for name, index_columns, where in indexes:
+        op.create_index(name, table, index_columns, unique=False,
+                        postgresql_where=sa.text(where) if where else None)
+
+
+def hot_months():
+    """
+    every month from the first loan to MONTHS_AHEAD months from now
+    """
+    first = op.get_bind().execute(sa.text("SELECT MIN(borrowed_date) FROM user_book_history")).scalar()
+    month, last = (first or date.today()).replace(day=1), date.today().replace(day=1)
+    for _ in range(MONTHS_AHEAD):
+        last = next_month(last)
+    while month <= last:
+        yield month
+        month = next_month(month)
+
+
+def archived_months():
+    """
+    only the months already archived, the archival command attaches whole months as new partitions
+    """
+    return op.get_bind().execute(sa.text(
+        "SELECT DISTINCT CAST(date_trunc('month', borrowed_date) AS date) FROM user_book_history_archive"
+    )).scalars().all()
+
+
+def create_archive_table():
+    op.create_table('user_book_history_archive',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('book_id', sa.Integer(), nullable=True),
+    sa.Column('borrowed_date', sa.Date(), nullable=False),
+    sa.Column('returned_date', sa.Date(), nullable=True),
+    sa.Column('action', postgresql.ENUM('BORROW', 'RETURN', name='action_type', create_type=False), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    for name, index_columns, where in ARCHIVE_INDEXES:
+        op.create_index(name, 'user_book_history_archive', index_columns, unique=False)
+
+
+def upgrade() -> None:
+    # ``python -m models`` (create_schema) may have run first, the archive table may exist already (empty or not)
+    if not sa.inspect(op.get_bind()).has_table('user_book_history_archive'):
+        create_archive_table()
+
+    # the partition key can not be null
+    op.execute("UPDATE user_book_history SET borrowed_date = COALESCE(returned_date, CURRENT_DATE) "
+               "WHERE borrowed_date IS NULL")
+    if op.get_bind().dialect.name == 'sqlite':
+        # SQLite can not alter a column, batch mode copies the table
+        with op.batch_alter_table('user_book_history') as batch_op:
+            batch_op.alter_column('borrowed_date', existing_type=sa.Date(), nullable=False)
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    rebuild('user_book_history', HOT_COLUMNS, HOT_INDEXES, partitioned=True, months=list(hot_months()))
+    rebuild('user_book_history_archive', ARCHIVE_COLUMNS, ARCHIVE_INDEXES, partitioned=True,
+            months=archived_months())
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == 'postgresql':
+        rebuild('user_book_history', HOT_COLUMNS, HOT_INDEXES, partitioned=False)
+    # archived loans go back to the history table
+    op.execute("INSERT INTO user_book_history (id, user_id, book_id, borrowed_date, returned_date, action) "
+               "SELECT id, user_id, book_id, borrowed_date, returned_date, action FROM user_book_history_archive")
+    op.drop_table('user_book_history_archive')
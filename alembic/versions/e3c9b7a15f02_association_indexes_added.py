@@ -0,0 +1,31 @@
+"""association indexes added
+
+Revision ID: e3c9b7a15f02
+Revises: a81f5c2e9d37
+Create Date: 2026-10-17 19:05:27.418390
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3c9b7a15f02'
+down_revision = 'a81f5c2e9d37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # ``python -m models`` (create_schema) may have run first, a new database has the indexes already
+    existing = {index['name'] for index in sa.inspect(op.get_bind()).get_indexes('association')}
+    if 'ix_association_category_id_book_id' not in existing:
+        op.create_index('ix_association_category_id_book_id', 'association', ['category_id', 'book_id'],
+                        unique=False)
+    if 'ix_association_book_id' not in existing:
+        op.create_index('ix_association_book_id', 'association', ['book_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_association_book_id', table_name='association')
+    op.drop_index('ix_association_category_id_book_id', table_name='association')
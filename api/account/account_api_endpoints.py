@@ -1,64 +1,83 @@
-from datetime import timedelta
+from typing import List
 
 from fastapi import Depends, HTTPException, status, APIRouter
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from api.account.utils import get_password_hash, create_access_token, get_current_user, validate_email, verify_password
+from api.account.utils import hash_password, get_current_user, validate_email, verify_and_update_password, \
+    invalidate_principal, issue_tokens, redeem_refresh_token, get_user
 from models import User
-from schema import UserCreate, Token, UserLogin
-from settings import get_db, ACCESS_TOKEN_EXPIRE_MINUTES
+from schema import UserCreate, Token, UserLogin, UserOut, RefreshRequest
+from responses import ORJSONRoute
+from settings import get_async_db
 
 # router
-router = APIRouter()
+router = APIRouter(route_class=ORJSONRoute)
 
-@router.post("/api/user/register", response_model=UserCreate)
-async def register_user(user: UserCreate, db: Session = Depends(get_db)):
+@router.post("/api/user/register", response_model=UserOut)
+async def register_user(user: UserCreate, db: AsyncSession = Depends(get_async_db)):
     """
     :param user: name, email, password
     :raises: if username exist
     :return: user data
     """
     validate_email(user.email)
-    user_obj = db.query(User).filter(User.email == user.email).first()
+    result = await db.execute(select(User).where(User.email == user.email))
+    user_obj = result.scalars().first()
     try:
         if user_obj is not None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                                 detail="User with this email is already exist!")
-        hashed_password = get_password_hash(user.password)
+        hashed_password = await hash_password(user.password)
         new_user = User(name=user.name, email=user.email, password=hashed_password)
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        await db.commit()
+        await db.refresh(new_user)
+        await invalidate_principal(new_user.id)
     except Exception as e:
         raise e
-    return new_user.__dict__
+    return new_user
 
 
 @router.post("/api/user/login", response_model=Token)
-async def login_user(user: UserLogin, db: Session = Depends(get_db)):
+async def login_user(user: UserLogin, db: AsyncSession = Depends(get_async_db)):
     """
     :param user: email, password
     :raises: if user not registered
     :return: access token
     """
     validate_email(user.email)
-    hashed_pwd = get_password_hash(user.password)
-    # verify_password(user.password, hashed_pwd)
-    user_obj = db.query(User).filter_by(email=user.email).first()
+    result = await db.execute(select(User).filter_by(email=user.email))
+    user_obj = result.scalars().first()
     if user_obj is None:
         raise HTTPException(status_code=400, detail="Invalid email or password")
-    if not user or not verify_password(user.password, user_obj.password):
+    verified, new_hash = await verify_and_update_password(user.password, user_obj.password)
+    if not verified:
         raise HTTPException(status_code=401, detail="Invalid email or password")
+    if new_hash:
+        # stored hash uses a different bcrypt cost, upgrade it transparently
+        user_obj.password = new_hash
+        await db.commit()
 
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = await create_access_token(
-        data={"sub": user_obj.id}, expires_delta=access_token_expires
-    )
-    return {"access_token": access_token, "token_type": "bearer"}
+    return await issue_tokens(user_obj)
 
 
-@router.get("/api/users", response_model=None)
-async def get_all_users(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+@router.post("/api/user/token/refresh", response_model=Token)
+async def refresh_token(body: RefreshRequest, db: AsyncSession = Depends(get_async_db)):
+    """
+    :param body: refresh token of the login or of the previous refresh
+    :raises: if the refresh token is invalid, expired or already used, or the user no longer exists
+    :return: access token with the user's current claims and a new refresh token
+    """
+    user_id = await redeem_refresh_token(body.refresh_token)
+    user = await get_user(db, user_id)
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not authenticated!")
+    return await issue_tokens(user)
+
+
+@router.get("/api/users", response_model=List[UserOut])
+async def get_all_users(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """
     :param current_user: current requested user
     :raises: if user is not admin
@@ -69,5 +88,6 @@ async def get_all_users(current_user: User = Depends(get_current_user), db: Sess
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not authorized! ADMIN can only access",
         )
-    users = db.query(User).all()
+    result = await db.execute(select(User))
+    users = result.scalars().all()
     return users
@@ -6,12 +6,11 @@ Note: to create a admin user
 from api.account.utils import get_password_hash
 from models import User
 from settings import get_db
-session = get_db()
-hashed_password = get_password_hash("admin")
-admin_user = User(name="admin", email="admin@gmail.com", password=hashed_password, is_admin=True)
-session.add(admin_user)
-session.commit()
-session.close()
+with get_db() as session:
+    hashed_password = get_password_hash("admin")
+    admin_user = User(name="admin", email="admin@gmail.com", password=hashed_password, is_admin=True)
+    session.add(admin_user)
+    session.commit()
 """
 
 from api.account.utils import get_password_hash
@@ -24,15 +23,13 @@ def create_admin_user():
     To create the admin user
     :return: admin user
     """
-    session = get_db()  # Get the database session
-
-    # Create the admin user
-    hashed_password = get_password_hash("admin")
-    admin_user = User(name="admin", email="admin@gmail.com", password=hashed_password, is_admin=True)
+    with get_db() as session:  # Get the database session, closed at the end of the block
+        # Create the admin user
+        hashed_password = get_password_hash("admin")
+        admin_user = User(name="admin", email="admin@gmail.com", password=hashed_password, is_admin=True)
 
-    session.add(admin_user)  # Add the admin user to the session
-    session.commit()  # Commit the changes to the database
-    session.close()  # Close the session
+        session.add(admin_user)  # Add the admin user to the session
+        session.commit()  # Commit the changes to the database
 
     print("Admin user created successfully.")
     return admin_user
@@ -0,0 +1,81 @@
+import json
+import logging
+import time
+
+from cache import INVALIDATION_CHANNEL, get_redis, message_handlers
+
+logger = logging.getLogger(__name__)
+
+# Revoked tokens, checked on every request without a database or network round trip:
+#   user:<id>  tokens of the user issued up to this time (epoch seconds) are revoked, e.g. after a deactivation
+#   jti:<id>   a single refresh token, e.g. one already exchanged
+# Every worker holds the whole list in memory, it stays small since entries are dropped once the tokens they revoke
+# have expired. With Redis, revocations are stored there and broadcast so every worker applies them at once.
+REDIS_PREFIX = "revoked:"
+MESSAGE_NAME = "revocation"
+
+# key -> (revoked up to, expires at)
+_revoked = {}
+
+
+def _add(key: str, revoked_until: float, expires: float):
+    _revoked[key] = (max(revoked_until, _revoked.get(key, (0.0, 0.0))[0]), expires)
+
+
+def _prune():
+    now = time.time()
+    for key in [key for key, (_, expires) in _revoked.items() if expires < now]:
+        del _revoked[key]
+
+
+def is_revoked(key: str, issued_at: float) -> bool:
+    """
+    :param key: user:<id> or jti:<id>
+    :param issued_at: iat claim of the token
+    """
+    entry = _revoked.get(key)
+    return entry is not None and issued_at <= entry[0] and entry[1] >= time.time()
+
+
+async def revoke(key: str, ttl: float):
+    """
+    Revoke the tokens under the key issued until now, for `ttl` seconds (the lifetime of those tokens)
+    """
+    now = time.time()
+    _prune()
+    _add(key, now, now + ttl)
+    redis = get_redis()
+    if redis is not None:
+        try:
+            await redis.set(REDIS_PREFIX + key, json.dumps([now, now + ttl]), ex=max(int(ttl), 1))
+            await redis.publish(INVALIDATION_CHANNEL, json.dumps([MESSAGE_NAME, [[key, now, now + ttl]]]))
+        except Exception as e:
+            logger.warning("token revocation %s not shared through redis: %s", key, e)
+
+
+def apply_revocations(entries):
+    """
+    Revocations published by the other workers
+    """
+    for key, revoked_until, expires in entries:
+        _add(key, revoked_until, expires)
+
+
+async def load_revocations():
+    """
+    Startup hook: take over the revocations made before this worker started
+    """
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        async for name in redis.scan_iter(match=REDIS_PREFIX + "*"):
+            raw = await redis.get(name)
+            if raw is not None:
+                revoked_until, expires = json.loads(raw)
+                _add(name.decode()[len(REDIS_PREFIX):], revoked_until, expires)
+    except Exception as e:
+        logger.warning("token revocations not loaded from redis: %s", e)
+
+
+message_handlers[MESSAGE_NAME] = apply_revocations
@@ -1,18 +1,36 @@
+import asyncio
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
 import jwt
 from fastapi import Depends, HTTPException, status
 from jwt.exceptions import InvalidTokenError
 from passlib.context import CryptContext
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from api.account.revocation import is_revoked, revoke
+from cache import MISSING, TieredCache, get_redis
 from models import User
-from schema import TokenData
-from settings import SECRET_KEY, ALGORITHM, oauth2_scheme, get_db
-from datetime import datetime, timedelta
-from pydantic.class_validators import Optional
+from schema import TokenData, CurrentUser
+from settings import SECRET_KEY, ALGORITHM, oauth2_scheme, get_lazy_async_db, PRINCIPAL_CACHE_SIZE, \
+    PRINCIPAL_CACHE_TTL, PRINCIPAL_CACHE_REDIS_TTL, BCRYPT_ROUNDS, PASSWORD_HASH_CONCURRENCY, \
+    PASSWORD_HASH_QUEUE_TIMEOUT, ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS
 import re
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# min/max rounds pinned to the configured cost so hashes with any other cost need an update
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS,
+                           bcrypt__min_rounds=BCRYPT_ROUNDS, bcrypt__max_rounds=BCRYPT_ROUNDS)
+
+# bcrypt releases the GIL, so a thread pool is enough to keep it off the event loop
+_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_CONCURRENCY, thread_name_prefix="password-hash")
+# (event loop, semaphore) bounding the waiting hashes, created on first use in the loop serving requests
+_hash_slots = None
 
+# resolved principals keyed by user id, see get_current_user
+principal_cache = TieredCache("principal", maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL,
+                              redis=get_redis(), redis_ttl=PRINCIPAL_CACHE_REDIS_TTL)
 
 
 def validate_email(email):
@@ -30,31 +48,88 @@ def validate_email(email):
     return True
 
 
-def verify_password(plain_password, hashed_password):
+def get_password_hash(password):
     """
-    verify password
+    Password Hashing
     """
-    return pwd_context.verify(plain_password, hashed_password)
+    return pwd_context.hash(password)
 
 
-def get_password_hash(password):
+def get_hash_slots() -> asyncio.Semaphore:
     """
-    Password Hashing
+    Semaphore of the hashing pool for the running event loop, created when first needed
     """
-    return pwd_context.hash(password)
+    global _hash_slots
+    loop = asyncio.get_running_loop()
+    if _hash_slots is None or _hash_slots[0] is not loop:
+        _hash_slots = (loop, asyncio.Semaphore(PASSWORD_HASH_CONCURRENCY))
+    return _hash_slots[1]
+
+
+async def _run_password_hashing(func, *args):
+    """
+    Run a bcrypt call on the hashing pool, waiting at most PASSWORD_HASH_QUEUE_TIMEOUT for a free slot
+    :raises: 503 if the pool stays saturated
+    """
+    slots = get_hash_slots()
+    try:
+        await asyncio.wait_for(slots.acquire(), timeout=PASSWORD_HASH_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many password checks in progress, please try again",
+            headers={"Retry-After": "1"},
+        )
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_hash_executor, func, *args)
+    finally:
+        slots.release()
+
+
+async def hash_password(password: str) -> str:
+    """
+    Password Hashing on the hashing pool
+    """
+    return await _run_password_hashing(pwd_context.hash, password)
+
+
+async def verify_and_update_password(plain_password: str, hashed_password: str):
+    """
+    verify password on the hashing pool
+    :return: (verified, new hash if the stored hash must be upgraded to the configured cost else None)
+    """
+    return await _run_password_hashing(pwd_context.verify_and_update, plain_password, hashed_password)
 
 
-async def get_user(db: Session, user_id: int) -> User:
+async def get_user(db: AsyncSession, user_id: int) -> User:
     """
     return the user from user_id
     """
-    return db.query(User).filter(User.id == user_id).first()
+    result = await db.execute(select(User).where(User.id == user_id))
+    return result.scalars().first()
+
+
+async def invalidate_principal(user_id: int):
+    """
+    Drop the cached principal, must be called whenever a users row changes
+    """
+    await principal_cache.delete(user_id)
+
+
+async def revoke_user_tokens(user_id: int):
+    """
+    Revoke the access tokens issued to the user so far, their claims are stale once the users row changes.
+    The user gets fresh claims from the refresh endpoint, which re-reads the row.
+    """
+    await revoke(f"user:{user_id}", ACCESS_TOKEN_EXPIRE_MINUTES * 60)
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def decode_token(token: str, token_type: str) -> dict:
     """
     :param token: jwt token
-    :return: current requested user
+    :param token_type: expected typ claim, tokens without one are access tokens of the sub-only format
+    :raises: if the token is invalid, expired, of another type or revoked
+    :return: claims
     """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -63,42 +138,73 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     )
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: int = payload.get("sub")
-        if user_id is None:
-            raise credentials_exception
-        token_data = TokenData(user_id=user_id)
     except InvalidTokenError:
         raise credentials_exception
-    user = await get_user(db, token_data.user_id)
-    if user is None:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not authenticated!")
-
-    return user
+    if payload.get("sub") is None or payload.get("typ", "access") != token_type:
+        raise credentials_exception
+    issued_at = payload.get("iat", 0)
+    # refresh tokens are not revoked with the user's access tokens, redeeming one re-reads the users row
+    if token_type == "access" and is_revoked(f"user:{payload['sub']}", issued_at):
+        raise credentials_exception
+    if "jti" in payload and is_revoked(f"jti:{payload['jti']}", issued_at):
+        raise credentials_exception
+    return payload
 
 
-async def authenticate_user(email: str, password: str, db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_lazy_async_db)):
     """
-    :param email: user email address
-    :param password: password
-    :return: if user authenticated return user else None
+    :param token: jwt token
+    :return: current requested user (id, name, is_admin, is_active), taken from the token's claims, for tokens
+             without claims served from the principal cache when possible
     """
-    user = db.query(User).filter(User.email == email).first()
-    if not user or not verify_password(password, user.password):
-        return None
-    return user
-
-
-async def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    payload = decode_token(token, "access")
+    if "adm" in payload:
+        # signed claims, no database or cache lookup
+        return CurrentUser(id=payload["sub"], name=payload.get("name"), is_admin=payload["adm"],
+                           is_active=payload["act"])
+    token_data = TokenData(user_id=payload["sub"])
+    principal = await principal_cache.get(token_data.user_id)
+    if principal is MISSING:
+        user = await get_user(db, token_data.user_id)
+        # hand the connection back before the endpoint runs
+        await db.close()
+        if user is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not authenticated!")
+        principal = CurrentUser.from_orm(user).dict()
+        await principal_cache.set(token_data.user_id, principal)
+
+    return CurrentUser(**principal)
+
+
+async def issue_tokens(user: User) -> dict:
+    """
+    Access token carrying the user's claims (is_admin, is_active) and a refresh token to renew it
+    :param user: users row, read just now
+    :return: Token response
+    """
+    now = time.time()
+    access_token = jwt.encode({
+        "sub": user.id, "typ": "access", "name": user.name, "adm": bool(user.is_admin),
+        "act": bool(user.is_active), "iat": now, "exp": int(now + ACCESS_TOKEN_EXPIRE_MINUTES * 60),
+    }, SECRET_KEY, algorithm=ALGORITHM)
+    refresh_token = jwt.encode({
+        "sub": user.id, "typ": "refresh", "jti": uuid.uuid4().hex, "iat": now,
+        "exp": int(now + REFRESH_TOKEN_EXPIRE_DAYS * 86400),
+    }, SECRET_KEY, algorithm=ALGORITHM)
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token,
+            "expires_in": int(ACCESS_TOKEN_EXPIRE_MINUTES * 60)}
+
+
+async def redeem_refresh_token(token: str) -> int:
     """
-    Used for creating the access token
-    :param data: user data dict
-    :return: jwt token
+    Check a refresh token and revoke it, each one is exchanged once
+    :raises: if the token is invalid, expired or already used
+    :return: user id
     """
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+    payload = decode_token(token, "refresh")
+    if "jti" not in payload:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials",
+                            headers={"WWW-Authenticate": "Bearer"})
+    # revoked locally before the first await, two requests of this worker cannot both redeem it
+    await revoke(f"jti:{payload['jti']}", max(payload["exp"] - time.time(), 1))
+    return payload["sub"]
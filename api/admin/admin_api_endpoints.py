@@ -0,0 +1,60 @@
+import secrets
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, status
+from fastapi.responses import PlainTextResponse
+
+from api.account.utils import get_current_user
+from cache import get_cache_stats
+from metrics import render_metrics
+from models import User
+from settings import get_pool_status, METRICS_TOKEN
+
+# router
+router = APIRouter()
+
+
+@router.get("/api/admin/pool", response_model=None)
+async def get_pool_stats(current_user: User = Depends(get_current_user)):
+    """
+    :param current_user: current requested user
+    :raises: if user is not admin
+    :return: database pool state (size, idle, checked out, overflow) and acquire wait times of this worker
+    """
+    if not current_user.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You are not authorized! ADMIN can only access",
+        )
+    return get_pool_status()
+
+
+@router.get("/api/admin/cache", response_model=None)
+async def get_cache_metrics(current_user: User = Depends(get_current_user)):
+    """
+    :param current_user: current requested user
+    :raises: if user is not admin
+    :return: size and hit/miss counters of every cache in this worker
+    """
+    if not current_user.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You are not authorized! ADMIN can only access",
+        )
+    return get_cache_stats()
+
+
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics(authorization: Optional[str] = Header(None)):
+    """
+    :param authorization: "Bearer <METRICS_TOKEN>", required when METRICS_TOKEN is set
+    :raises: if the token does not match
+    :return: request, SQL, pool and cache metrics of this worker in the Prometheus text format
+    """
+    if METRICS_TOKEN and not secrets.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid metrics token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,211 @@
+"""
+Move closed loans borrowed before a cutoff date out of user_book_history into user_book_history_archive,
+and create the monthly user_book_history partitions of the coming months.
+
+On Postgres (partitioned by the d4a7c3f0b918 migration) a month before the cutoff without open loans is
+detached from user_book_history and attached to user_book_history_archive as it is, no rows are copied.
+The closed loans of the other months (and on other databases) are moved in batches.
+Open loans always stay in user_book_history. Run it regularly, e.g. monthly from cron:
+
+    python -m api.book.archive_history --before 2025-01-01
+"""
+import argparse
+import re
+from datetime import date
+
+from sqlalchemy import delete, func, insert, select, text
+
+from models import UserBookHistory, UserBookHistoryArchive, HISTORY_PARTITION_FORMAT
+from settings import get_engine
+
+# loans moved per transaction
+ARCHIVE_BATCH_SIZE = 10000
+# monthly partitions kept ready ahead of the current month
+PARTITION_MONTHS_AHEAD = 3
+
+HISTORY_COLUMNS = ("id", "user_id", "book_id", "borrowed_date", "returned_date", "action")
+hot = UserBookHistory.__table__
+archive = UserBookHistoryArchive.__table__
+
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def is_partitioned(connection, table) -> bool:
+    """
+    whether the table is a partitioned table (Postgres after the partitioning migration)
+    """
+    if connection.dialect.name != "postgresql":
+        return False
+    return connection.execute(
+        text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table))"),
+        {"table": table.name},
+    ).scalar()
+
+
+def monthly_partitions(connection, table) -> dict:
+    """
+    :return: first day of the month -> partition name, for the partitions following HISTORY_PARTITION_FORMAT
+    """
+    pattern = re.compile(rf"^{table.name}_y(\d{{4}})m(\d{{2}})$")
+    names = connection.execute(
+        text("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+             "WHERE i.inhparent = to_regclass(:table)"),
+        {"table": table.name},
+    ).scalars()
+    months = {}
+    for name in names:
+        match = pattern.match(name)
+        if match:
+            months[date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return months
+
+
+def create_partition(connection, table, month: date) -> str:
+    """
+    Create the partition of the month. Rows of the month in the default partition, written while the partition
+    was missing, would make the CREATE fail: the default partition is detached meanwhile and they are moved.
+    """
+    name = HISTORY_PARTITION_FORMAT.format(table=table.name, year=month.year, month=month.month)
+    bounds = f"FOR VALUES FROM ('{month}') TO ('{next_month(month)}')"
+    if connection.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar() is not None:
+        return name
+    default = f"{table.name}_default"
+    in_month = f"borrowed_date >= '{month}' AND borrowed_date < '{next_month(month)}'"
+    stranded = False
+    if connection.execute(text("SELECT to_regclass(:name)"), {"name": default}).scalar() is not None:
+        stranded = connection.execute(text(f"SELECT EXISTS (SELECT 1 FROM {default} WHERE {in_month})")).scalar()
+    if not stranded:
+        connection.execute(text(f"CREATE TABLE {name} PARTITION OF {table.name} {bounds}"))
+        return name
+    columns = ", ".join(HISTORY_COLUMNS)
+    connection.execute(text(f"ALTER TABLE {table.name} DETACH PARTITION {default}"))
+    connection.execute(text(f"CREATE TABLE {name} PARTITION OF {table.name} {bounds}"))
+    connection.execute(text(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {default} WHERE {in_month}"))
+    connection.execute(text(f"DELETE FROM {default} WHERE {in_month}"))
+    connection.execute(text(f"ALTER TABLE {table.name} ATTACH PARTITION {default} DEFAULT"))
+    return name
+
+
+def create_coming_partitions(months_ahead: int = PARTITION_MONTHS_AHEAD) -> list:
+    """
+    Partitions of user_book_history from the current month on, new loans never land in the default partition
+    :return: names of the partitions created
+    """
+    created = []
+    with get_engine().begin() as connection:
+        if not is_partitioned(connection, hot):
+            return created
+        existing = monthly_partitions(connection, hot)
+        month = date.today().replace(day=1)
+        for _ in range(months_ahead + 1):
+            if month not in existing:
+                created.append(create_partition(connection, hot, month))
+            month = next_month(month)
+    return created
+
+
+def detach_closed_months(before: date) -> list:
+    """
+    Move whole months borrowed before the cutoff without open loans from user_book_history to the archive
+    :return: names of the archived partitions
+    """
+    archived = []
+    with get_engine().connect() as connection:
+        if not (is_partitioned(connection, hot) and is_partitioned(connection, archive)):
+            return archived
+        months = monthly_partitions(connection, hot)
+    for month, name in sorted(months.items()):
+        if next_month(month) > before:
+            break
+        with get_engine().begin() as connection:
+            if month in monthly_partitions(connection, archive):
+                # partly archived already while it had open loans, its rows are moved one by one
+                continue
+            if connection.execute(text(f"SELECT EXISTS (SELECT 1 FROM {name} WHERE returned_date IS NULL)")).scalar():
+                continue
+            archive_name = HISTORY_PARTITION_FORMAT.format(table=archive.name, year=month.year, month=month.month)
+            connection.execute(text(f"ALTER TABLE {hot.name} DETACH PARTITION {name}"))
+            connection.execute(text(f"ALTER TABLE {name} RENAME TO {archive_name}"))
+            # archived rows never block deleting users or books
+            foreign_keys = connection.execute(
+                text("SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(:name) AND contype = 'f'"),
+                {"name": archive_name},
+            ).scalars().all()
+            for constraint in foreign_keys:
+                connection.execute(text(f'ALTER TABLE {archive_name} DROP CONSTRAINT "{constraint}"'))
+            connection.execute(text(f"ALTER TABLE {archive.name} ATTACH PARTITION {archive_name} "
+                                    f"FOR VALUES FROM ('{month}') TO ('{next_month(month)}')"))
+            # indexes of the hot table the archive does not have (open loans, returned date) are dead weight now
+            leftovers = connection.execute(
+                text("SELECT c.relname FROM pg_index x JOIN pg_class c ON c.oid = x.indexrelid "
+                     "WHERE x.indrelid = to_regclass(:name) "
+                     "AND NOT EXISTS (SELECT 1 FROM pg_inherits i WHERE i.inhrelid = x.indexrelid)"),
+                {"name": archive_name},
+            ).scalars().all()
+            for index in leftovers:
+                connection.execute(text(f'DROP INDEX "{index}"'))
+        archived.append(archive_name)
+    return archived
+
+
+def move_closed_loans(before: date, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """
+    Move the remaining closed loans borrowed before the cutoff to the archive, batch_size rows per transaction
+    :return: number of loans moved
+    """
+    closed = (hot.c.returned_date.isnot(None), hot.c.borrowed_date < before)
+    with get_engine().begin() as connection:
+        first = connection.execute(select(func.min(hot.c.borrowed_date)).where(*closed)).scalar()
+        if first is not None and is_partitioned(connection, archive):
+            existing = monthly_partitions(connection, archive)
+            month = first.replace(day=1)
+            while month < before:
+                # only months with loans to move, an archive partition stops the month from being detached later
+                in_month = (hot.c.borrowed_date >= month, hot.c.borrowed_date < next_month(month))
+                if month not in existing and connection.execute(
+                        select(select(hot.c.id).where(*closed, *in_month).exists())).scalar():
+                    create_partition(connection, archive, month)
+                month = next_month(month)
+    if first is None:
+        return 0
+
+    moved = 0
+    while True:
+        with get_engine().begin() as connection:
+            result = connection.execute(select(hot.c.id).where(*closed).order_by(hot.c.id).limit(batch_size))
+            ids = result.scalars().all()
+            if not ids:
+                return moved
+            # the borrowed_date condition keeps Postgres from visiting the partitions after the cutoff
+            rows = select(*(hot.c[name] for name in HISTORY_COLUMNS)).where(hot.c.id.in_(ids), *closed)
+            connection.execute(insert(archive).from_select(HISTORY_COLUMNS, rows))
+            connection.execute(delete(hot).where(hot.c.id.in_(ids), *closed))
+        moved += len(ids)
+
+
+def archive_history(before: date, batch_size: int = ARCHIVE_BATCH_SIZE,
+                    months_ahead: int = PARTITION_MONTHS_AHEAD) -> dict:
+    """
+    :param before: closed loans borrowed before this date are archived
+    :return: what was done
+    """
+    return {
+        "partitions_created": create_coming_partitions(months_ahead),
+        "partitions_archived": detach_closed_months(before),
+        "loans_moved": move_closed_loans(before, batch_size),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--before", type=date.fromisoformat, required=True,
+                        help="archive closed loans borrowed before this date (YYYY-MM-DD)")
+    parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    parser.add_argument("--months-ahead", type=int, default=PARTITION_MONTHS_AHEAD)
+    args = parser.parse_args()
+    report = archive_history(args.before, args.batch_size, args.months_ahead)
+    print(f"partitions created: {', '.join(report['partitions_created']) or '-'}")
+    print(f"partitions archived: {', '.join(report['partitions_archived']) or '-'}")
+    print(f"loans moved: {report['loans_moved']}")
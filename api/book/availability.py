@@ -0,0 +1,159 @@
+import asyncio
+import json
+import logging
+from typing import Dict, Iterable, Optional, Tuple
+
+from cache import INVALIDATION_CHANNEL, get_redis, message_handlers
+
+logger = logging.getLogger(__name__)
+
+# Availability push: clients subscribe to book ids over server-sent events and get the book's count whenever a
+# borrow, return, update or delete changes it. With Redis the changes are broadcast so every worker pushes them.
+# Every change carries the books.version it was written with: changes published by concurrent requests, or read
+# from a catalog cache entry older than a change already pushed, can arrive out of order and the older one is
+# dropped. Each event id is a resume token, the counts and versions the client has seen ("12:3:7,45:0:2"). A client
+# reconnecting with it in Last-Event-ID only gets the books changed since, on whichever worker it lands.
+MESSAGE_NAME = "availability"
+# seconds between keepalive comments on idle streams, keeps proxies from closing them
+KEEPALIVE_INTERVAL = 15
+# reconnect delay suggested to the client in milliseconds
+RETRY_MS = 3000
+
+
+class Subscriber:
+    """
+    One stream. Changes are coalesced per book until the stream sends them, so a slow or idle client holds at
+    most one pending count per subscribed book
+    """
+    __slots__ = ("book_ids", "pending", "versions", "wake")
+
+    def __init__(self, book_ids: Iterable[int]):
+        self.book_ids = tuple(book_ids)
+        # book id -> (count, None for a deleted book, version)
+        self.pending = {}
+        # book id -> highest version dispatched or sent
+        self.versions = {}
+        self.wake = asyncio.Event()
+
+
+class AvailabilityHub:
+    """
+    Subscribers of this worker by book id
+    """
+
+    def __init__(self):
+        self.subscribers = {}
+
+    def subscribe(self, book_ids: Iterable[int]) -> Subscriber:
+        subscriber = Subscriber(book_ids)
+        for book_id in subscriber.book_ids:
+            self.subscribers.setdefault(book_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        for book_id in subscriber.book_ids:
+            subscribers = self.subscribers.get(book_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.subscribers[book_id]
+
+    def dispatch(self, changes: Dict[int, Tuple[Optional[int], int]]):
+        """
+        :param changes: book id -> (count, None for a deleted book, version), older versions than a subscriber
+                        already has are dropped
+        """
+        for book_id, (count, version) in changes.items():
+            for subscriber in self.subscribers.get(book_id, ()):
+                if version <= subscriber.versions.get(book_id, 0):
+                    continue
+                subscriber.versions[book_id] = version
+                subscriber.pending[book_id] = (count, version)
+                subscriber.wake.set()
+
+    def stats(self) -> dict:
+        return {"subscribers": len({subscriber for subscribers in self.subscribers.values()
+                                    for subscriber in subscribers}),
+                "books": len(self.subscribers)}
+
+
+hub = AvailabilityHub()
+
+
+async def publish_availability(changes: Dict[int, Tuple[Optional[int], int]]):
+    """
+    After a write is committed: push the new counts to the subscribers of every worker
+    :param changes: book id -> (count, None for a deleted book, books.version written with it)
+    """
+    if not changes:
+        return
+    redis = get_redis()
+    if redis is not None:
+        try:
+            # the invalidation listener of every worker, this one included, dispatches it
+            message = [[book_id, count, version] for book_id, (count, version) in changes.items()]
+            await redis.publish(INVALIDATION_CHANNEL, json.dumps([MESSAGE_NAME, message]))
+            return
+        except Exception as e:
+            logger.warning("availability change not broadcast through redis: %s", e)
+    hub.dispatch(changes)
+
+
+def parse_resume_token(token: Optional[str]) -> Dict[int, Tuple[int, int]]:
+    """
+    :return: book id -> (count, version) the client has seen, empty for a missing or malformed token
+    """
+    seen = {}
+    for item in (token or "").split(","):
+        try:
+            book_id, count, version = map(int, item.split(":"))
+        except ValueError:
+            return {}
+        seen[book_id] = (count, version)
+    return seen
+
+
+def format_event(book_id: int, count: Optional[int], version: int, seen: Dict[int, tuple]) -> str:
+    data = {"book_id": book_id, "count": count or 0, "available": bool(count), "version": version}
+    if count is None:
+        data["deleted"] = True
+    token = ",".join(f"{seen_id}:{seen_count or 0}:{seen_version}"
+                     for seen_id, (seen_count, seen_version) in seen.items())
+    return f"id: {token}\nevent: availability\ndata: {json.dumps(data)}\n\n"
+
+
+async def availability_events(subscriber: Subscriber, current: Dict[int, Tuple[int, int]],
+                              resume_token: Optional[str]):
+    """
+    Server-sent events of a subscriber: first the books of a newer version than in the resume token (every book
+    without one), then each newer change as it is dispatched. Unsubscribes when the client goes away.
+    :param current: book id -> (count, version), read after subscribing so no change falls in between
+    """
+    token = parse_resume_token(resume_token)
+    seen = {book_id: token.get(book_id, (count, 0)) for book_id, (count, _) in current.items()}
+    # the client may have seen a newer version than a catalog cache entry holds
+    first = {book_id: change for book_id, change in current.items() if change[1] > seen[book_id][1]}
+    for book_id, (_, version) in seen.items():
+        subscriber.versions[book_id] = max(version, current[book_id][1], subscriber.versions.get(book_id, 0))
+    try:
+        yield f"retry: {RETRY_MS}\n\n"
+        pending = first
+        while True:
+            for book_id, (count, version) in pending.items():
+                # a change dispatched before the counts were read can be older than them
+                if version <= seen[book_id][1]:
+                    continue
+                seen[book_id] = (count, version)
+                yield format_event(book_id, count, version, seen)
+            try:
+                await asyncio.wait_for(subscriber.wake.wait(), KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+            subscriber.wake.clear()
+            pending, subscriber.pending = subscriber.pending, {}
+    finally:
+        hub.unsubscribe(subscriber)
+
+
+message_handlers[MESSAGE_NAME] = lambda changes: hub.dispatch(
+    {book_id: (count, version) for book_id, count, version in changes})
@@ -1,27 +1,41 @@
-from datetime import datetime, date
+from datetime import date
 from typing import List
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, status, Query, Response, Request, Header
 from pydantic.class_validators import Optional
-from sqlalchemy import select
-from sqlalchemy.orm import Session, joinedload
-from starlette.responses import JSONResponse
-
-from api.account.utils import get_current_user
-from api.book.utils import is_book_borrowed_by_user
+from sqlalchemy import select, tuple_, func, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.exc import StaleDataError
+from starlette.responses import JSONResponse, StreamingResponse
+
+from api.account.utils import get_current_user, invalidate_principal, revoke_user_tokens
+from api.book import catalog
+from api.book.availability import hub, publish_availability, availability_events
+from api.book.importer import import_books
+from api.book.recommendations import get_recommendations
+from api.book.search import book_search_query, in_category
+from api.book.utils import is_book_borrowed_by_user, book_keyset, book_cursor, BOOK_ORDERINGS, stream_books_ndjson, \
+    apply_rating_change, rating_summary, encode_cursor, decode_cursor, borrow_copy, return_copy, borrow_copies, \
+    return_copies, with_archived_history, make_etag, book_etag, category_etag, etag_matches, category_books_after
 from enums import ActionType, RatingEnum
-from models import User, Book, UserBookHistory, Category, UserBookRating
+from models import User, Book, UserBookHistory, Category, UserBookRating, BookRatingSummary
 from schema import BookCreate, BookUpdate, CategoryCreate, CategoryRead, CategoryUpdate, BookRead, RatingCreate, \
-    UserActivate
-from settings import get_db
+    UserActivate, RatingSummary, TopRatedBook, BookBatch, BookCreated, ImportReport, AllBooks, BookDetail, \
+    BookUpdated, BookBatchResult, UserBookHistorySchema, CategoryCreated, Message, RatingRead, UserActivated, \
+    CategoryBookCount, RecommendedBook
+from responses import ORJSONRoute
+from settings import get_async_db, get_lazy_async_db
 from fastapi import APIRouter
 
 # router
-router = APIRouter()
+router = APIRouter(route_class=ORJSONRoute)
 
 
-@router.post("/api/book", response_model=None)
-async def create_book(book: BookCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+@router.post("/api/book", response_model=BookCreated)
+async def create_book(book: BookCreate, current_user: User = Depends(get_current_user),
+                      db: AsyncSession = Depends(get_async_db)):
     """
     :param book: book data in request body
     :param current_user: current requested user
@@ -38,29 +52,56 @@ async def create_book(book: BookCreate, current_user: User = Depends(get_current
     category_id = book.category_id
 
     # Query the category with the provided category_id
-    category = db.query(Category).get(category_id)
+    category = await db.get(Category, category_id)
 
     if not category:
         # Handle the case where the category doesn't exist
-        return {"status": "error", "message": "Category not found"}
+        return JSONResponse({"status": "error", "message": "Category not found"})
 
     db_book = Book(title=book.title, description=book.description, author=book.author, count=book.count,
                    categories=[category])
     db.add(db_book)
-    db.commit()
-    db.refresh(db_book)
+    await db.commit()
+    await db.refresh(db_book)
+    await catalog.invalidate_books([db_book.id], [category_id])
     return {"status": "OK", "message": "Book created successfully", "Book": db_book}
 
 
-@router.get("/api/books", response_model=None)
-async def get_all_books(current_user: User = Depends(get_current_user), skip: int = 0, limit: int = 10,
-                        db: Session = Depends(get_db)):
+@router.post("/api/books/import", response_model=ImportReport)
+async def bulk_import_books(request: Request, format: Optional[str] = Query(None, regex="^(csv|ndjson)$"),
+                            current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    """
+    :param request: streamed CSV (header row: title,description,author,count,category_id|category) or NDJSON body
+    :param format: csv or ndjson, taken from the Content-Type when omitted
+    :param current_user: current requested user
+    :raises: if user is not admin
+    :return: imported and failed row counts with per row errors, invalid rows do not abort the import
+    """
+    if not current_user.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You are not authorized! ADMIN can only access",
+        )
+    data_format = format or ("ndjson" if "json" in request.headers.get("content-type", "") else "csv")
+    report = await import_books(db, request.stream(), data_format)
+    if report["imported"]:
+        await catalog.invalidate_books([], (await db.execute(select(Category.id))).scalars())
+    return {"Status": "OK", "message": f"{report['imported']} books imported", **report}
+
+
+@router.get("/api/books", response_model=List[BookRead])
+async def get_all_books(response: Response, current_user: User = Depends(get_current_user), skip: int = 0,
+                        limit: int = Query(10, ge=1, le=1000), cursor: Optional[str] = None,
+                        order_by: str = Query("id", regex=f"^({'|'.join(BOOK_ORDERINGS)})$"),
+                        db: AsyncSession = Depends(get_async_db)):
     """
     :param current_user: requested user
-    :param skip: omit the number of rows from beginning
+    :param skip: omit the number of rows from beginning (ignored when a cursor is given)
     :param limit: limit the number of rows
-    :raises: if user is not logged in
-    :return: books
+    :param cursor: X-Next-Cursor header value of the previous page
+    :param order_by: id or title
+    :raises: if user is not logged in or the cursor is invalid
+    :return: books, the X-Next-Cursor header is set when there is a next page
     """
     if not current_user:
         raise HTTPException(
@@ -68,14 +109,24 @@ async def get_all_books(current_user: User = Depends(get_current_user), skip: in
             detail="You are not Authorized to view books!",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    books = db.query(Book).offset(skip).limit(limit).all()
+    query = book_keyset(select(Book), order_by, cursor)
+    if cursor is None and skip:
+        query = query.offset(skip)
+    # one extra row tells whether there is a next page
+    result = await db.execute(query.limit(limit + 1))
+    books = result.scalars().all()
+    if len(books) > limit:
+        books = books[:limit]
+        response.headers["X-Next-Cursor"] = book_cursor(books[-1], order_by)
     return books
 
 
-@router.get("/api/all-books", response_model=None)
-async def get_all_books(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+@router.get("/api/all-books", response_model=AllBooks)
+async def get_all_books(current_user: User = Depends(get_current_user), stream: bool = False,
+                        db: AsyncSession = Depends(get_async_db)):
     """
     :param current_user: requested user
+    :param stream: stream the catalog as NDJSON (one book per line) with flat memory use
     :raises: if user is not logged in
     :return: books
     """
@@ -85,17 +136,21 @@ async def get_all_books(current_user: User = Depends(get_current_user), db: Sess
             detail="You are not Authorized to view books!",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if stream:
+        return StreamingResponse(stream_books_ndjson(db), media_type="application/x-ndjson")
     # return books along with their category instances
-    books = db.query(Book).options(joinedload(Book.categories)).all()
+    result = await db.execute(select(Book).options(joinedload(Book.categories)))
+    books = result.unique().scalars().all()
     return {"books": books}
 
 
-@router.get("/api/book/{book_id}", response_model=None)
-async def get_book(book_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+@router.get("/api/book/{book_id}", response_model=BookDetail)
+async def get_book(book_id: int, response: Response, current_user: User = Depends(get_current_user),
+                   db: AsyncSession = Depends(get_lazy_async_db), if_none_match: Optional[str] = Header(None)):
     """
-    :param: book_id (int)
+    :param: book_id (int), If-None-Match header with the ETag of a copy the client has
     :raises: if user not authenticated or invalid book id
-    :return: single book data
+    :return: single book data, 304 when the client's copy is still current
     """
     if not current_user:
         raise HTTPException(
@@ -104,18 +159,23 @@ async def get_book(book_id: int, current_user: User = Depends(get_current_user),
             headers={"WWW-Authenticate": "Bearer"},
         )
     # book along with its category
-    book = db.query(Book).filter(Book.id == book_id).options(joinedload(Book.categories)).first()
+    book = await catalog.get_book(db, book_id)
     if not book:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Book not found")
+    etag = book_etag(book)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
     return book
 
 
-@router.put("/api/book/{book_id}", response_model=None)
-async def update_book(book_id: int, book_update: BookUpdate, current_user: User = Depends(get_current_user),
-                      db: Session = Depends(get_db)):
+@router.put("/api/book/{book_id}", response_model=BookUpdated)
+async def update_book(book_id: int, book_update: BookUpdate, response: Response,
+                      current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db),
+                      if_match: Optional[str] = Header(None)):
     """
-    :param: book_id, fields to be updated given in request body
-    :raises: if user is not admin
+    :param: book_id, fields to be updated given in request body, If-Match header with the ETag the update is based on
+    :raises: if user is not admin, 412 if the book changed since the If-Match ETag, 409 on a concurrent update
     :return: book data
     """
     if not current_user.is_admin:
@@ -123,25 +183,44 @@ async def update_book(book_id: int, book_update: BookUpdate, current_user: User
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not authorized! ADMIN can only access",
         )
-    book = db.query(Book).filter(Book.id == book_id).first()
+    # categories are loaded up front so replacing them below does not lazy load
+    result = await db.execute(select(Book).where(Book.id == book_id).options(selectinload(Book.categories)))
+    book = result.scalars().first()
     # find book
     if not book:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Book not found")
     # find category
-    category = db.query(Category).filter(Category.id == book_update.category_id).first()
+    category = await db.get(Category, book_update.category_id)
     if not category:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Category not found")
+    old_category_ids = [old.id for old in book.categories]
+    if if_match is not None:
+        current = make_etag(["book", book.id, book.version],
+                            *(["category", old.id, old.version] for old in sorted(book.categories, key=lambda c: c.id)))
+        if not etag_matches(if_match, current, weak=False):
+            raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Book was modified")
     # update dict
     for key, value in book_update.dict(exclude_unset=True).items():
         setattr(book, key, value)
     book.categories = [category]  # Update the book's category
-    db.commit()
-    db.refresh(book)
+    book.version += 1
+    try:
+        # the UPDATE only matches the version read above
+        await db.commit()
+    except StaleDataError:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED if if_match is not None
+                            else status.HTTP_409_CONFLICT, detail="Book was modified")
+    await db.refresh(book)
+    await catalog.invalidate_books([book_id], old_category_ids + [category.id])
+    await publish_availability({book_id: (book.count, book.version)})
+    response.headers["ETag"] = make_etag(["book", book.id, book.version], ["category", category.id, category.version])
     return {"Status": "OK", "message": "Book updated successfully", "Book": book}
 
 
 @router.delete("/api/book/{book_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_book(book_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def delete_book(book_id: int, current_user: User = Depends(get_current_user),
+                      db: AsyncSession = Depends(get_async_db)):
     """
     :param: book_id
     :raises: if book not exists
@@ -152,91 +231,194 @@ async def delete_book(book_id: int, current_user: User = Depends(get_current_use
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not authorized! ADMIN can only access",
         )
-    book = db.query(Book).filter(Book.id == book_id).first()
+    result = await db.execute(select(Book).where(Book.id == book_id).options(selectinload(Book.categories)))
+    book = result.scalars().first()
     if not book:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Book not found")
-    db.delete(book)
-    db.commit()
+    category_ids = [category.id for category in book.categories]
+    # the deletion is the book's last change, newer than its last version
+    version = book.version + 1
+    await db.delete(book)
+    try:
+        await db.commit()
+    except StaleDataError:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Book was modified")
+    await catalog.invalidate_books([book_id], category_ids)
+    await publish_availability({book_id: (None, version)})
     return JSONResponse({"Status": "OK", "message": "Book deleted successfully!"})
 
 
 # Borrow Book
 @router.post("/api/book/{book_id}/borrow", status_code=status.HTTP_204_NO_CONTENT)
 async def borrow_book(book_id: int, current_user: User = Depends(get_current_user),
-                      db: Session = Depends(get_db)):
+                      db: AsyncSession = Depends(get_async_db)):
     """
     :param: book_id
     :raises: if book not exists or book not available
     :return: success response
     """
-    book = db.query(Book).filter(Book.id == book_id).first()
-    if not book:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Book not found")
-    if book.count <= 0:
+    borrowed = await borrow_copy(db, book_id, current_user.id)
+    if borrowed is None:
+        # nothing was taken, find out why
+        if not await db.get(Book, book_id):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Book not found")
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Book is not available for borrowing")
-    try:
-        history = UserBookHistory(user_id=current_user.id, book_id=book_id, borrowed_date=datetime.utcnow(),
-                                  action=ActionType.BORROW)
-        db.add(history)
-        book.count -= 1
-        db.commit()
-    except Exception as e:
-        print(e)
+    await db.commit()
+    await catalog.invalidate_books([book_id])
+    await publish_availability({book_id: borrowed})
     return JSONResponse({"Status": "OK", "message": "The book was successfully borrowed"})
 
 
 @router.post("/api/book/{book_id}/return", status_code=status.HTTP_204_NO_CONTENT)
-async def return_book(book_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def return_book(book_id: int, current_user: User = Depends(get_current_user),
+                      db: AsyncSession = Depends(get_async_db)):
     """
     :param: book_id
     :raises: if book not found or book is not borrowed already
     :return: success response
     """
-    book = db.query(Book).filter(Book.id == book_id).first()
-    if not book:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Book not found")
-    history = db.query(UserBookHistory).filter(
-        UserBookHistory.user_id == current_user.id,
-        UserBookHistory.book_id == book_id,
-        UserBookHistory.returned_date.is_(None),
-    ).first()
-    if not history:
+    returned = await return_copy(db, book_id, current_user.id)
+    if returned is None:
+        if not await db.get(Book, book_id):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Book not found")
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Book is not borrowed by the user")
-    history.returned_date = datetime.utcnow()
-    history.action = ActionType.RETURN
-    book.count += 1
-    db.commit()
+    await db.commit()
+    await catalog.invalidate_books([book_id])
+    await publish_availability({book_id: returned})
 
     return JSONResponse({"Status": "OK", "message": "The book was successfully returned"})
 
 
-@router.get("/api/user/book", response_model=None)
-async def get_books_borrowed_by_user(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+@router.post("/api/books/borrow", response_model=BookBatchResult, response_model_exclude_none=True)
+async def borrow_books(batch: BookBatch, current_user: User = Depends(get_current_user),
+                       db: AsyncSession = Depends(get_async_db)):
+    """
+    :param batch: book_ids to borrow one copy each (at most 100)
+    :return: per book outcome (borrowed, unavailable or not_found), all loans are written in one transaction
+    """
+    book_ids = list(dict.fromkeys(batch.book_ids))
+    borrowed = await borrow_copies(db, book_ids, current_user.id)
+    await db.commit()
+    await catalog.invalidate_books(borrowed)
+    await publish_availability(borrowed)
+    missing = [book_id for book_id in book_ids if book_id not in borrowed]
+    existing = set()
+    if missing:
+        existing = set((await db.execute(select(Book.id).where(Book.id.in_(missing)))).scalars())
+    results = [
+        {"book_id": book_id, "status": "borrowed", "count": borrowed[book_id][0]} if book_id in borrowed else
+        {"book_id": book_id, "status": "unavailable" if book_id in existing else "not_found"}
+        for book_id in book_ids
+    ]
+    return {"Status": "OK", "message": f"{len(borrowed)} of {len(book_ids)} books borrowed", "results": results}
+
+
+@router.post("/api/books/return", response_model=BookBatchResult, response_model_exclude_none=True)
+async def return_books(batch: BookBatch, current_user: User = Depends(get_current_user),
+                       db: AsyncSession = Depends(get_async_db)):
+    """
+    :param batch: book_ids to return (at most 100)
+    :return: per book outcome (returned or not_borrowed), all returns are written in one transaction
+    """
+    book_ids = list(dict.fromkeys(batch.book_ids))
+    returned = await return_copies(db, book_ids, current_user.id)
+    await db.commit()
+    await catalog.invalidate_books(returned)
+    await publish_availability(returned)
+    results = [
+        {"book_id": book_id, "status": "returned", "count": returned[book_id][0]} if book_id in returned else
+        {"book_id": book_id, "status": "not_borrowed"}
+        for book_id in book_ids
+    ]
+    return {"Status": "OK", "message": f"{len(returned)} of {len(book_ids)} books returned", "results": results}
+
+
+@router.get("/api/books/availability", response_class=StreamingResponse)
+async def stream_availability(book_ids: List[int] = Query(..., max_items=100),
+                              last_event_id: Optional[str] = Header(None),
+                              current_user: User = Depends(get_current_user),
+                              db: AsyncSession = Depends(get_lazy_async_db)):
+    """
+    :param book_ids: books to watch (at most 100)
+    :param last_event_id: id of the last event received, sent by EventSource when it reconnects
+    :param current_user: requested user
+    :raises: if user is not authenticated or a book does not exist
+    :return: server-sent "availability" events ({book_id, count, available, version}) of the books, the current
+             counts first (only the changed ones when resuming), then every newer change
+    """
+    if not current_user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You are not Authorized to view books!",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    book_ids = list(dict.fromkeys(book_ids))
+    # subscribed before the counts are read, a change in between is pushed after them
+    subscriber = hub.subscribe(book_ids)
+    try:
+        books = await catalog.get_books(db, book_ids)
+    finally:
+        # the stream holds no connection
+        await db.close()
+    if len(books) < len(book_ids):
+        hub.unsubscribe(subscriber)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Book not found")
+    current = {book_id: (books[book_id]["count"], books[book_id]["version"]) for book_id in book_ids}
+    return StreamingResponse(availability_events(subscriber, current, last_event_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@router.get("/api/user/book", response_model=List[BookRead])
+async def get_books_borrowed_by_user(current_user: User = Depends(get_current_user),
+                                     db: AsyncSession = Depends(get_async_db)):
     """
     :param: current requested user
     :return: books list borrowed by the user
     """
-    history = db.query(UserBookHistory).filter(
+    result = await db.execute(select(UserBookHistory).where(
         UserBookHistory.user_id == current_user.id,
         UserBookHistory.returned_date.is_(None),
-    ).all()
+    ))
+    history = result.scalars().all()
     book_ids = [h.book_id for h in history]
-    books = db.query(Book).filter(Book.id.in_(book_ids)).all()
+    result = await db.execute(select(Book).where(Book.id.in_(book_ids)))
+    books = result.scalars().all()
     return books
 
 
-@router.get("/api/history/", response_model=None)
+@router.get("/api/history/", response_model=List[UserBookHistorySchema])
 async def retrieve_history(
+        response: Response,
         email: Optional[str] = None,
         book_title: Optional[str] = None,
+        user_id: Optional[int] = None,
+        book_id: Optional[int] = None,
         action_type: Optional[ActionType] = None,
         borrowed_date: Optional[date] = None,
         returned_date: Optional[date] = None,
+        borrowed_from: Optional[date] = None,
+        borrowed_to: Optional[date] = None,
+        returned_from: Optional[date] = None,
+        returned_to: Optional[date] = None,
+        open_only: bool = False,
+        limit: int = Query(100, ge=1, le=1000),
+        cursor: Optional[str] = None,
+        include_total: bool = False,
+        include_archived: bool = False,
         current_user: User = Depends(get_current_user),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_async_db)
 ):
     """
-    Retrieve book history data based on provided filters
+    Retrieve book history data based on provided filters, newest first
+    :param borrowed_from: borrowed on or after this date, borrowed_to/returned_from/returned_to alike (inclusive)
+    :param open_only: only loans that are not returned yet
+    :param limit: limit the number of rows
+    :param cursor: X-Next-Cursor header value of the previous page
+    :param include_total: also count every matching row into the X-Total-Count header (costly on large ranges)
+    :param include_archived: also search the loans moved to user_book_history_archive
+    :raises: if user is not admin or the cursor is invalid
+    :return: history rows, the X-Next-Cursor header is set when there is a next page
     """
 
     if not current_user.is_admin:
@@ -245,34 +427,70 @@ async def retrieve_history(
             detail="You are not authorized! Only admins can access this endpoint.",
         )
 
-    query = db.query(UserBookHistory)
+    history = with_archived_history() if include_archived else UserBookHistory
+    conditions = []
 
+    # filter on ids through subqueries, the history indexes start with user_id/book_id
     if email:
-        query = query.join(User).filter(User.email == email)
+        conditions.append(history.user_id.in_(select(User.id).where(User.email == email)))
 
     if book_title:
-        query = query.join(Book).filter(Book.title == book_title)
+        conditions.append(history.book_id.in_(select(Book.id).where(Book.title == book_title)))
+
+    if user_id is not None:
+        conditions.append(history.user_id == user_id)
+
+    if book_id is not None:
+        conditions.append(history.book_id == book_id)
 
     if action_type:
-        if action_type == ActionType.BORROW:
-            query = query.filter(UserBookHistory.action == action_type)
-        elif action_type == ActionType.RETURN:
-            query = query.filter(UserBookHistory.action == action_type)
+        conditions.append(history.action == action_type)
 
     if borrowed_date:
-        query = query.filter(UserBookHistory.borrowed_date == borrowed_date)
+        conditions.append(history.borrowed_date == borrowed_date)
 
     if returned_date:
-        query = query.filter(UserBookHistory.returned_date == returned_date)
+        conditions.append(history.returned_date == returned_date)
+
+    if borrowed_from:
+        conditions.append(history.borrowed_date >= borrowed_from)
+
+    if borrowed_to:
+        conditions.append(history.borrowed_date <= borrowed_to)
+
+    if returned_from:
+        conditions.append(history.returned_date >= returned_from)
+
+    if returned_to:
+        conditions.append(history.returned_date <= returned_to)
+
+    if open_only:
+        conditions.append(history.returned_date.is_(None))
+
+    if include_total:
+        total = await db.execute(select(func.count()).select_from(history).where(*conditions))
+        response.headers["X-Total-Count"] = str(total.scalar())
 
-    book_history = query.all()
+    query = select(history).where(*conditions).order_by(history.id.desc())
+    if cursor is not None:
+        position = decode_cursor(cursor)
+        if position.get("o") != "history" or not isinstance(position.get("id"), int):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+        query = query.where(history.id < position["id"])
+
+    # one extra row tells whether there is a next page
+    result = await db.execute(query.limit(limit + 1))
+    book_history = result.scalars().all()
+    if len(book_history) > limit:
+        book_history = book_history[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor({"o": "history", "id": book_history[-1].id})
     return book_history
 
 
-@router.post("/api/category", response_model=None)
-def create_category(
+@router.post("/api/category", response_model=CategoryCreated)
+async def create_category(
         category: CategoryCreate,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_async_db),
         current_user: User = Depends(get_current_user),
 ):
     """
@@ -286,18 +504,21 @@ def create_category(
 
     new_category = Category(title=category.title, description=category.description)
     db.add(new_category)
-    db.commit()
-    db.refresh(new_category)
+    await db.commit()
+    await db.refresh(new_category)
+    await catalog.invalidate_category()
     return {"Status": "OK", "message": "The category successfully created",
             "Category": new_category}
 
 
 @router.get("/api/categories", response_model=List[CategoryRead])
-def read_categories(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def read_categories(response: Response, db: AsyncSession = Depends(get_lazy_async_db),
+                          current_user: User = Depends(get_current_user),
+                          if_none_match: Optional[str] = Header(None)):
     """
     :current_user: requested user
     :raises: if user not authenticated
-    :return: return all categories
+    :return: return all categories, 304 when the client's copy (If-None-Match) is still current
     """
     if not current_user:
         raise HTTPException(
@@ -305,16 +526,22 @@ def read_categories(db: Session = Depends(get_db), current_user: User = Depends(
             detail="You are not Authorized to view categories!",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    categories = db.query(Category).all()
+    categories = await catalog.get_categories(db)
+    etag = make_etag(*(["category", category["id"], category["version"]] for category in categories))
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
     return categories
 
 
 @router.get("/api/category/{category_id}", response_model=CategoryRead)
-def get_category(category_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def get_category(category_id: int, response: Response,
+                       db: AsyncSession = Depends(get_lazy_async_db), current_user: User = Depends(get_current_user),
+                       if_none_match: Optional[str] = Header(None)):
     """
     :current_user: requested user
     :raises: if user not authenticated
-    :return: return all categories
+    :return: the category, 304 when the client's copy (If-None-Match) is still current
     """
     if not current_user:
         raise HTTPException(
@@ -322,44 +549,63 @@ def get_category(category_id: int, db: Session = Depends(get_db), current_user:
             detail="You are not Authorized to view category!",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    category = db.query(Category).filter(Category.id == category_id).first()
+    category = await catalog.get_category(db, category_id)
     if not category:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Category not Exist")
+    etag = category_etag(category)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
     return category
 
 
 @router.put("/api/category/{category_id}", response_model=CategoryRead)
-def update_category(
+async def update_category(
         category_id: int,
         category: CategoryUpdate,
-        db: Session = Depends(get_db),
+        response: Response,
+        db: AsyncSession = Depends(get_async_db),
         current_user: User = Depends(get_current_user),
+        if_match: Optional[str] = Header(None),
 ):
     """
     :param category_id: int
     :param category: response schema
     :param current_user: requested user
-    :raises: if user not admin or not authenticated
+    :param if_match: ETag the update is based on
+    :raises: if user not admin or not authenticated, 412 if the category changed since the If-Match ETag,
+             409 on a concurrent update
     :return: updated category instance
     """
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Only admin can update category")
 
-    existing_category = db.query(Category).get(category_id)
+    existing_category = await db.get(Category, category_id)
     if not existing_category:
         raise HTTPException(status_code=404, detail="Category not Exist")
 
+    if if_match is not None and not etag_matches(if_match, category_etag(existing_category), weak=False):
+        raise HTTPException(status_code=412, detail="Category was modified")
+
     existing_category.title = category.title
     existing_category.description = category.description
-    db.commit()
-    db.refresh(existing_category)
+    existing_category.version += 1
+    try:
+        # the UPDATE only matches the version read above
+        await db.commit()
+    except StaleDataError:
+        await db.rollback()
+        raise HTTPException(status_code=412 if if_match is not None else 409, detail="Category was modified")
+    await db.refresh(existing_category)
+    await catalog.invalidate_category(category_id)
+    response.headers["ETag"] = category_etag(existing_category)
     return existing_category
 
 
-@router.delete("/api/category/{category_id}")
-def delete_category(
+@router.delete("/api/category/{category_id}", response_model=Message)
+async def delete_category(
         category_id: int,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_async_db),
         current_user: User = Depends(get_current_user),
 ):
     """
@@ -371,24 +617,32 @@ def delete_category(
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Only admin can delete category")
 
-    category = db.query(Category).get(category_id)
+    category = await db.get(Category, category_id)
     if not category:
         raise HTTPException(status_code=404, detail="Category not Exist")
 
-    db.delete(category)
-    db.commit()
+    await db.delete(category)
+    try:
+        await db.commit()
+    except StaleDataError:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Category was modified")
+    await catalog.invalidate_category(category_id)
     return {"message": "Category deleted successfully"}
 
 
 # Category search to get all books related to a category
 @router.get("/api/category/{category_id}/books", response_model=List[BookRead])
-def get_books_by_category(category_id: int, db: Session = Depends(get_db),
-                          current_user: User = Depends(get_current_user)):
+async def get_books_by_category(category_id: int, response: Response, limit: int = Query(100, ge=1, le=1000),
+                                cursor: Optional[str] = None, db: AsyncSession = Depends(get_lazy_async_db),
+                                current_user: User = Depends(get_current_user)):
     """
     :param category_id: int
+    :param limit: limit the number of books
+    :param cursor: X-Next-Cursor header value of the previous page
     :param current_user: requested user
-    :raises: if user is not authenticated
-    :return: books related with the category
+    :raises: if user is not authenticated or the cursor is invalid
+    :return: books related with the category by id, the X-Next-Cursor header is set when there is a next page
     """
     if not current_user:
         raise HTTPException(
@@ -396,20 +650,76 @@ def get_books_by_category(category_id: int, db: Session = Depends(get_db),
             detail="You are not Authorized to view books!",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    category = db.query(Category).get(category_id)
-    if not category:
+    # one extra book tells whether there is a next page
+    books = await catalog.get_category_books(db, category_id, category_books_after(cursor), limit + 1)
+    if books is None:
         raise HTTPException(status_code=404, detail="Category not exist")
+    if len(books) > limit:
+        books = books[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor({"o": "category_books", "id": books[-1]["id"]})
+    return books
 
-    books = category.books
+
+@router.get("/api/categories/books", response_model=List[BookRead])
+async def get_books_by_categories(response: Response, category_ids: List[int] = Query(..., max_items=50),
+                                  match: str = Query("any", regex="^(any|all)$"),
+                                  limit: int = Query(100, ge=1, le=1000), cursor: Optional[str] = None,
+                                  db: AsyncSession = Depends(get_lazy_async_db),
+                                  current_user: User = Depends(get_current_user)):
+    """
+    :param category_ids: repeated query parameter, ?category_ids=1&category_ids=2
+    :param match: any - books in at least one of the categories, all - books in every one of them
+    :param limit: limit the number of books
+    :param cursor: X-Next-Cursor header value of the previous page
+    :raises: if user is not authenticated, a category does not exist or the cursor is invalid
+    :return: books by id, the X-Next-Cursor header is set when there is a next page
+    """
+    if not current_user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You are not Authorized to view books!",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    known = {category["id"] for category in await catalog.get_categories(db)}
+    unknown = sorted(set(category_ids) - known)
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Category not exist: {', '.join(map(str, unknown))}")
+    books = await catalog.get_books_in_categories(db, category_ids, match == "all", category_books_after(cursor),
+                                                  limit + 1)
+    if len(books) > limit:
+        books = books[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor({"o": "category_books", "id": books[-1]["id"]})
     return books
 
 
+@router.get("/api/categories/counts", response_model=List[CategoryBookCount])
+async def get_category_book_counts(category_ids: Optional[List[int]] = Query(None),
+                                   db: AsyncSession = Depends(get_lazy_async_db),
+                                   current_user: User = Depends(get_current_user)):
+    """
+    :param category_ids: repeated query parameter, every category when omitted
+    :raises: if user is not authenticated
+    :return: number of books of each category, from one aggregate query
+    """
+    if not current_user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You are not Authorized to view categories!",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    counts = await catalog.get_category_counts(db)
+    if category_ids is None:
+        category_ids = [category["id"] for category in await catalog.get_categories(db)]
+    return [{"category_id": category_id, "books": counts.get(category_id, 0)}
+            for category_id in dict.fromkeys(category_ids)]
+
+
 # Book rating by borrowed user
-@router.post("/api/book/{book_id}/rating", response_model=None)
-def rate_book(
+@router.post("/api/book/{book_id}/rating", response_model=RatingRead)
+async def rate_book(
         book_id: int,
         rating: RatingCreate,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_async_db),
         current_user: User = Depends(get_current_user),
 ):
     """
@@ -425,57 +735,151 @@ def rate_book(
             detail="You are not Authorized to view books!",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    print(rating.rating)
-    print(RatingEnum)
     if rating.rating not in RatingEnum:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail="Invalid rating value. Allowed values: [1, 2, 3, 4, 5]",
         )
 
-    book = db.query(Book).get(book_id)
+    book = await db.get(Book, book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
 
-    if not is_book_borrowed_by_user(book_id, current_user.id, db):
+    if not await is_book_borrowed_by_user(book_id, current_user.id, db):
         raise HTTPException(
             status_code=403, detail="Only borrowed users can rate books"
         )
     try:
         rating_value = RatingEnum(rating.rating)  # Convert the rating to the enum value
-        print(f"RATING VALUE ======================================== {rating_value}")
-        print(f"RATING VALUE ======================================== {rating_value.name}")
-        print(f"RATING VALUE ======================================== {rating_value.value}")
 
-        new_rating = UserBookRating(
-            user_id=current_user.id, book_id=book_id, rating=rating_value.name
+        # one rating per user and book: rating again replaces the previous value
+        result = await db.execute(
+            select(UserBookRating).where(UserBookRating.user_id == current_user.id, UserBookRating.book_id == book_id)
         )
-        db.add(new_rating)
-        db.commit()
-        db.refresh(new_rating)
+        new_rating = result.scalars().first()
+        if new_rating is None:
+            new_rating = UserBookRating(
+                user_id=current_user.id, book_id=book_id, rating=rating_value.name
+            )
+            db.add(new_rating)
+            # a concurrent first rating of the same user fails here, before the aggregate changes (409)
+            await db.flush()
+            await apply_rating_change(db, book_id, rating_value.value)
+        elif new_rating.rating != rating_value:
+            old_value = new_rating.rating.value
+            # only while the rating is still the one read, of two concurrent changes by the same user the second
+            # one updates no row (409) instead of taking the old value off the aggregate twice
+            changed = await db.execute(
+                update(UserBookRating)
+                .where(UserBookRating.id == new_rating.id, UserBookRating.rating == new_rating.rating)
+                .values(rating=rating_value.name)
+                .execution_options(synchronize_session=False)
+            )
+            if not changed.rowcount:
+                await db.rollback()
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                    detail="Rating was changed concurrently, try again")
+            await apply_rating_change(db, book_id, rating_value.value, old_value)
+        await db.commit()
+        await db.refresh(new_rating)
     except ValueError:
         raise HTTPException(
             status_code=422,
             detail="Invalid rating value provided",
         )
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Rating was changed concurrently, try again")
     except Exception as e:
         raise e
     return {
         "id": new_rating.id,
         "book_id": new_rating.book_id,
-        "book_name": new_rating.book.title,
+        "book_name": book.title,
         "user_id": new_rating.user_id,
-        "user_name": new_rating.user.name,
+        "user_name": current_user.name,
         "rating": new_rating.rating.name,
     }
 
 
+@router.get("/api/book/{book_id}/rating", response_model=RatingSummary)
+async def get_book_rating(book_id: int, db: AsyncSession = Depends(get_async_db),
+                          current_user: User = Depends(get_current_user)):
+    """
+    :param book_id: int
+    :param current_user: requested user
+    :raises: if book not found
+    :return: average, count and 1-5 star histogram of the book's ratings
+    """
+    summary = await db.get(BookRatingSummary, book_id)
+    if summary is None and not await db.get(Book, book_id):
+        raise HTTPException(status_code=404, detail="Book not found")
+    return rating_summary(book_id, summary)
+
+
+@router.get("/api/books/top-rated", response_model=List[TopRatedBook])
+async def get_top_rated_books(response: Response, limit: int = Query(10, ge=1, le=100), min_ratings: int = 1,
+                              cursor: Optional[str] = None, db: AsyncSession = Depends(get_async_db),
+                              current_user: User = Depends(get_current_user)):
+    """
+    :param limit: limit the number of books
+    :param min_ratings: only books with at least this many ratings
+    :param cursor: X-Next-Cursor header value of the previous page
+    :return: books by descending average rating, served from the rating aggregates
+    """
+    query = (
+        select(Book, BookRatingSummary)
+        .join(BookRatingSummary, BookRatingSummary.book_id == Book.id)
+        .where(BookRatingSummary.rating_count >= max(min_ratings, 1))
+        .order_by(BookRatingSummary.rating_avg.desc(), BookRatingSummary.book_id.desc())
+    )
+    if cursor is not None:
+        position = decode_cursor(cursor)
+        if position.get("o") != "rating":
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+        query = query.where(tuple_(BookRatingSummary.rating_avg, BookRatingSummary.book_id) <
+                            tuple_(position["avg"], position["id"]))
+    result = await db.execute(query.limit(limit + 1))
+    rows = result.all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1].BookRatingSummary
+        response.headers["X-Next-Cursor"] = encode_cursor({"o": "rating", "avg": last.rating_avg, "id": last.book_id})
+    return [{"book": book, "average": round(summary.rating_avg, 2), "count": summary.rating_count}
+            for book, summary in rows]
+
+
+@router.get("/api/book/{book_id}/recommendations", response_model=List[RecommendedBook])
+async def get_book_recommendations(book_id: int, limit: int = Query(10, ge=1, le=100),
+                                   db: AsyncSession = Depends(get_lazy_async_db),
+                                   current_user: User = Depends(get_current_user)):
+    """
+    :param book_id: id of the book
+    :param limit: limit the number of books
+    :raises: if user is not authenticated or the book does not exist
+    :return: books most often borrowed by the readers of the book ("readers who borrowed this also borrowed"),
+             with the number of readers who borrowed both
+    """
+    if not current_user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You are not Authorized to view books!",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    if not await catalog.get_books(db, [book_id]):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Book not found")
+    recommended = get_recommendations(book_id, limit)
+    books = await catalog.get_books(db, [other_id for other_id, _ in recommended])
+    # deleted books are left out
+    return [{"book": books[other_id], "readers": readers} for other_id, readers in recommended if other_id in books]
+
+
 # Activate/Deactivate user (admin only)
-@router.put("/api/user/{user_id}/activate", response_model=None)
-def activate_user(
+@router.put("/api/user/{user_id}/activate", response_model=UserActivated)
+async def activate_user(
         user_id: int,
         user_activate: UserActivate,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_async_db),
         current_user: User = Depends(get_current_user),
 ):
     """
@@ -487,13 +891,16 @@ def activate_user(
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Only admin can activate/deactivate users")
 
-    user = db.query(User).get(user_id)
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
     user.is_active = user_activate.is_active
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
+    await invalidate_principal(user.id)
+    # tokens carrying the previous is_active claim stop working now
+    await revoke_user_tokens(user.id)
     if user_activate.is_active:
         msg = f"User - {user.name} activated successfully"
     else:
@@ -502,11 +909,17 @@ def activate_user(
 
 
 @router.get("/api/search-books", response_model=List[BookRead])
-async def search_books(title: Optional[str] = None, author: Optional[str] = None, category_id: Optional[int] = None,
-                       db: Session = Depends(get_db), current_user: User = Depends(get_current_user),
+async def search_books(q: Optional[str] = None, title: Optional[str] = None, author: Optional[str] = None,
+                       category_id: Optional[int] = None, fuzzy: bool = True, skip: int = 0,
+                       limit: int = Query(50, ge=1, le=500),
+                       db: AsyncSession = Depends(get_async_db), current_user: User = Depends(get_current_user),
                        ):
     """
     Search books by title, author, and/or category.
+    :param q: free text over title, author and description, results ranked by relevance
+    :param fuzzy: tolerate typos in q (trigram matching)
+    :param skip: omit the number of results from beginning
+    :param limit: limit the number of results
     """
     if not current_user:
         raise HTTPException(
@@ -514,12 +927,17 @@ async def search_books(title: Optional[str] = None, author: Optional[str] = None
             detail="You are not Authorized to view books!",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    query = db.query(Book)
+    if q:
+        query = book_search_query(db.bind.dialect.name, q, fuzzy)
+    else:
+        query = select(Book).order_by(Book.id)
+    # substring filters, served by the trigram indexes on Postgres
     if title:
         query = query.filter(Book.title.ilike(f"%{title}%"))
     if author:
         query = query.filter(Book.author.ilike(f"%{author}%"))
     if category_id:
-        query = query.join(Book.categories).filter(Category.id == category_id)
-    books = query.all()
+        query = query.filter(in_category(category_id))
+    result = await db.execute(query.offset(skip).limit(limit))
+    books = result.scalars().all()
     return books
@@ -0,0 +1,190 @@
+import time
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api.book.search import category_book_counts, category_book_ids
+from cache import MISSING, TieredCache, get_redis
+from models import Book, Category, association_table
+from settings import CATALOG_CACHE_SIZE, CATALOG_CACHE_TTL, CATALOG_CACHE_REDIS_TTL
+
+# Read-through cache of the catalog. Entries are normalized so a write invalidates few keys:
+#   book:<id>            book columns and its category ids, availability (count) changes touch only this key
+#   category:<id>        category columns
+#   categories           every category
+#   category_books:<id>  generation of a category listing, its pages are cached under
+#                        category_books:<id>:<generation>:<after>:<limit> and dropped with it
+#   category_counts      number of books of every category
+catalog_cache = TieredCache("catalog", maxsize=CATALOG_CACHE_SIZE, ttl=CATALOG_CACHE_TTL, redis=get_redis(),
+                            redis_ttl=CATALOG_CACHE_REDIS_TTL)
+
+
+def book_key(book_id: int) -> str:
+    return f"book:{book_id}"
+
+
+def category_key(category_id: int) -> str:
+    return f"category:{category_id}"
+
+
+def category_books_key(category_id: int) -> str:
+    return f"category_books:{category_id}"
+
+
+def row_entry(obj) -> dict:
+    return {column.name: getattr(obj, column.name) for column in obj.__table__.columns}
+
+
+async def load_books(db: AsyncSession, book_ids: Iterable[int]) -> Dict[int, dict]:
+    """
+    book entries straight from the database, two queries for any number of books
+    """
+    book_ids = list(book_ids)
+    books = {book.id: {**row_entry(book), "category_ids": []}
+             for book in (await db.execute(select(Book).where(Book.id.in_(book_ids)))).scalars()}
+    links = await db.execute(
+        select(association_table.c.book_id, association_table.c.category_id)
+        .where(association_table.c.book_id.in_(book_ids))
+        .order_by(association_table.c.category_id)
+    )
+    for book_id, category_id in links:
+        if book_id in books:
+            books[book_id]["category_ids"].append(category_id)
+    return books
+
+
+async def get_entries(ids: List[int], key, load) -> Dict[int, dict]:
+    """
+    Entries by id from the cache, the misses are loaded together by `await load(missing ids)`; unknown ids are left
+    out. An entry invalidated while it was loaded is returned but not stored.
+    """
+    entries = {}
+    missing = []
+    for entry_id in ids:
+        entry = await catalog_cache.get(key(entry_id))
+        if entry is MISSING:
+            missing.append(entry_id)
+        else:
+            entries[entry_id] = entry
+    if missing:
+        generations = {entry_id: catalog_cache.generation(key(entry_id)) for entry_id in missing}
+        loaded = await load(missing)
+        for entry_id, entry in loaded.items():
+            if catalog_cache.generation(key(entry_id)) == generations[entry_id]:
+                await catalog_cache.set(key(entry_id), entry)
+        entries.update(loaded)
+    return entries
+
+
+async def get_books(db: AsyncSession, book_ids: List[int]) -> Dict[int, dict]:
+    """
+    Book entries by id from the cache, the misses are loaded together; unknown ids are left out
+    """
+    return await get_entries(book_ids, book_key, lambda missing: load_books(db, missing))
+
+
+async def get_categories_by_id(db: AsyncSession, category_ids: List[int]) -> Dict[int, dict]:
+    """
+    Category entries by id from the cache, the misses are loaded with one query; unknown ids are left out
+    """
+    async def load(missing):
+        categories = await db.execute(select(Category).where(Category.id.in_(missing)))
+        return {category.id: row_entry(category) for category in categories.scalars()}
+
+    return await get_entries(category_ids, category_key, load)
+
+
+async def get_category(db: AsyncSession, category_id: int) -> Optional[dict]:
+    async def load():
+        category = await db.get(Category, category_id)
+        return row_entry(category) if category else None
+
+    return await catalog_cache.get_or_load(category_key(category_id), load)
+
+
+async def get_categories(db: AsyncSession) -> List[dict]:
+    async def load():
+        return [row_entry(category) for category in (await db.execute(select(Category))).scalars()]
+
+    return await catalog_cache.get_or_load("categories", load)
+
+
+async def get_book(db: AsyncSession, book_id: int) -> Optional[dict]:
+    """
+    :return: the book with its categories, as GET /api/book/{book_id} returns it, None if it does not exist
+    """
+    async def load():
+        return (await load_books(db, [book_id])).get(book_id)
+
+    entry = await catalog_cache.get_or_load(book_key(book_id), load)
+    if entry is None:
+        return None
+    book = {key: value for key, value in entry.items() if key != "category_ids"}
+    # a category deleted meanwhile is skipped
+    categories = await get_categories_by_id(db, entry["category_ids"])
+    book["categories"] = [categories[category_id] for category_id in entry["category_ids"] if category_id in categories]
+    return book
+
+
+async def new_generation() -> int:
+    return time.time_ns()
+
+
+async def get_category_books(db: AsyncSession, category_id: int, after: int = 0,
+                             limit: int = 100) -> Optional[List[dict]]:
+    """
+    :param after: book id the page starts after
+    :return: a page of the books of a category by id, None if the category does not exist
+    """
+    if await get_category(db, category_id) is None:
+        return None
+    # invalidating the listing replaces its generation, which orphans every cached page at once
+    generation = await catalog_cache.get_or_load(category_books_key(category_id), new_generation)
+
+    async def load():
+        return list((await db.execute(category_book_ids([category_id], after=after, limit=limit))).scalars())
+
+    book_ids = await catalog_cache.get_or_load(f"{category_books_key(category_id)}:{generation}:{after}:{limit}", load)
+    books = await get_books(db, book_ids)
+    return [books[book_id] for book_id in book_ids if book_id in books]
+
+
+async def get_books_in_categories(db: AsyncSession, category_ids: List[int], match_all: bool = False,
+                                  after: int = 0, limit: int = 100) -> List[dict]:
+    """
+    A page of the books in any (match_all: every one) of the categories by id, the books come from the cache
+    """
+    book_ids = list((await db.execute(category_book_ids(category_ids, match_all, after, limit))).scalars())
+    books = await get_books(db, book_ids)
+    return [books[book_id] for book_id in book_ids if book_id in books]
+
+
+async def get_category_counts(db: AsyncSession) -> Dict[int, int]:
+    """
+    :return: number of books by category id, categories without books are left out
+    """
+    async def load():
+        # pairs, the JSON of the Redis tier has no int keys
+        return [list(row) for row in await db.execute(category_book_counts())]
+
+    return dict(await catalog_cache.get_or_load("category_counts", load))
+
+
+async def invalidate_books(book_ids: Iterable[int], category_ids: Iterable[int] = ()):
+    """
+    After a book write is committed: the books, and the listings of the categories they joined or left
+    """
+    category_keys = [category_books_key(category_id) for category_id in set(category_ids)]
+    await catalog_cache.delete(*(book_key(book_id) for book_id in book_ids), *category_keys,
+                               *(["category_counts"] if category_keys else []))
+
+
+async def invalidate_category(category_id: int = None):
+    """
+    After a category write is committed, without an id only the list of categories
+    """
+    keys = ["categories"]
+    if category_id is not None:
+        keys += [category_key(category_id), category_books_key(category_id), "category_counts"]
+    await catalog_cache.delete(*keys)
@@ -0,0 +1,206 @@
+import csv
+import json
+from typing import AsyncIterator, Callable, List, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy import insert, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Book, Category, association_table
+from schema import BookImportRow
+
+# rows written per transaction
+IMPORT_BATCH_SIZE = 5000
+# a rejected batch is retried in this many chunks, each of those likewise down to single rows
+IMPORT_RETRY_SPLIT = 10
+# per row errors returned in the response, the rest are only counted
+IMPORT_MAX_REPORTED_ERRORS = 100
+
+BOOK_COLUMNS = ("id", "title", "description", "author", "count")
+
+
+async def read_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """
+    Split a streamed request body into lines without buffering the whole body
+    """
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8-sig").rstrip("\r")
+    if pending:
+        yield pending.decode("utf-8-sig").rstrip("\r")
+
+
+async def read_records(chunks: AsyncIterator[bytes], data_format: str) -> AsyncIterator[Tuple[int, object]]:
+    """
+    Yield (line number, dict or error message) from a streamed CSV (with header) or NDJSON body
+    """
+    header = None
+    record_line, record = 0, ""
+    line_number = 0
+    async for line in read_lines(chunks):
+        line_number += 1
+        if data_format == "ndjson":
+            if not line.strip():
+                continue
+            try:
+                value = json.loads(line)
+            except ValueError as e:
+                yield line_number, f"invalid JSON: {e}"
+                continue
+            yield line_number, value if isinstance(value, dict) else "expected a JSON object"
+            continue
+
+        # CSV: a quoted field may span lines, keep reading while the quotes are unbalanced
+        record_line = record_line or line_number
+        record = f"{record}\n{line}" if record else line
+        if record.count('"') % 2:
+            continue
+        start, complete = record_line, record
+        record_line, record = 0, ""
+        if not complete.strip():
+            continue
+        fields = next(csv.reader([complete]))
+        if header is None:
+            header = [name.strip().lower() for name in fields]
+            continue
+        if len(fields) != len(header):
+            yield start, f"expected {len(header)} fields, got {len(fields)}"
+            continue
+        yield start, dict(zip(header, fields))
+    if record:
+        yield record_line, "unterminated quoted field"
+
+
+async def load_categories(db: AsyncSession) -> Tuple[dict, dict]:
+    """
+    Every category once per import: (ids, lower case title -> id)
+    """
+    rows = (await db.execute(select(Category.id, Category.title))).all()
+    return {row.id for row in rows}, {(row.title or "").strip().lower(): row.id for row in rows}
+
+
+async def allocate_book_ids(db: AsyncSession, n: int) -> List[int]:
+    """
+    Reserve ids from the books sequence on Postgres, so books and their association rows can be copied without
+    RETURNING
+    """
+    result = await db.execute(
+        text("SELECT nextval(pg_get_serial_sequence('books', 'id')) FROM generate_series(1, :n)"), {"n": n}
+    )
+    return list(result.scalars())
+
+
+async def insert_books(db: AsyncSession, rows: List[BookImportRow]) -> List[int]:
+    """
+    Insert books and return the ids the database assigned them, in order
+    """
+    values = [{"title": row.title, "description": row.description, "author": row.author, "count": row.count}
+              for row in rows]
+    if db.bind.dialect.name == "sqlite":
+        # one writer at a time: the first insert takes the write lock, so the rows get consecutive rowids after
+        # the largest one and the last is last_insert_rowid()
+        await db.execute(insert(Book.__table__), values)
+        last = (await db.execute(text("SELECT last_insert_rowid()"))).scalar()
+        return list(range(last - len(rows) + 1, last + 1))
+    # concurrent writers may interleave, each book reports its own id
+    return [(await db.execute(insert(Book.__table__).values(value))).inserted_primary_key[0] for value in values]
+
+
+async def write_batch(db: AsyncSession, rows: List[BookImportRow], category_ids: List[int]):
+    """
+    Insert a batch of validated books with COPY on Postgres and INSERT elsewhere, then commit
+    """
+    if db.bind.dialect.name == "postgresql":
+        ids = await allocate_book_ids(db, len(rows))
+        books = [(book_id, row.title, row.description, row.author, row.count) for book_id, row in zip(ids, rows)]
+        connection = await db.connection()
+        raw = await connection.get_raw_connection()
+        # asyncpg connection, already inside the session's transaction
+        driver = raw.driver_connection
+        await driver.copy_records_to_table("books", records=books, columns=list(BOOK_COLUMNS))
+        await driver.copy_records_to_table("association", records=list(zip(category_ids, ids)),
+                                           columns=["category_id", "book_id"])
+    else:
+        ids = await insert_books(db, rows)
+        links = [{"category_id": category_id, "book_id": book_id} for book_id, category_id in zip(ids, category_ids)]
+        await db.execute(insert(association_table), links)
+    await db.commit()
+
+
+async def write_rows(db: AsyncSession, rows: List[BookImportRow], category_ids: List[int], lines: List[int],
+                     fail: Callable[[int, str], None]) -> int:
+    """
+    Write the rows in one transaction. When the database rejects it the rows are retried in IMPORT_RETRY_SPLIT
+    smaller chunks, down to single rows, so only the rejected rows fail, each with its own error.
+    :return: number of rows imported
+    """
+    try:
+        await write_batch(db, rows, category_ids)
+        return len(rows)
+    except Exception as e:
+        await db.rollback()
+        if len(rows) == 1:
+            fail(lines[0], f"rejected by the database: {database_error(e)}")
+            return 0
+    size = -(-len(rows) // IMPORT_RETRY_SPLIT)
+    imported = 0
+    for start in range(0, len(rows), size):
+        end = start + size
+        imported += await write_rows(db, rows[start:end], category_ids[start:end], lines[start:end], fail)
+    return imported
+
+
+def database_error(error: Exception) -> str:
+    """
+    First line of the driver's message, without SQLAlchemy's statement and parameters
+    """
+    return str(getattr(error, "orig", None) or error).strip().splitlines()[0]
+
+
+async def import_books(db: AsyncSession, chunks: AsyncIterator[bytes], data_format: str) -> dict:
+    """
+    Validate and insert books from a streamed upload in batches of IMPORT_BATCH_SIZE.
+    A row that fails validation is reported and skipped, a batch the database rejects is retried in smaller chunks
+    so only its rejected rows are reported, with the database's error; neither stops the import.
+    :return: imported/failed counts and the first IMPORT_MAX_REPORTED_ERRORS errors by line
+    """
+    known_ids, ids_by_title = await load_categories(db)
+    report = {"imported": 0, "failed": 0, "errors": []}
+    batch, batch_categories, batch_lines = [], [], []
+
+    def fail(line_number, message):
+        report["failed"] += 1
+        if len(report["errors"]) < IMPORT_MAX_REPORTED_ERRORS:
+            report["errors"].append({"line": line_number, "error": message})
+
+    async def flush():
+        report["imported"] += await write_rows(db, batch, batch_categories, batch_lines, fail)
+        batch.clear()
+        batch_categories.clear()
+        batch_lines.clear()
+
+    async for line_number, record in read_records(chunks, data_format):
+        if isinstance(record, str):
+            fail(line_number, record)
+            continue
+        try:
+            row = BookImportRow(**record)
+        except ValidationError as e:
+            fail(line_number, "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()))
+            continue
+        category_id = row.category_id if row.category_id in known_ids else ids_by_title.get(
+            (row.category or "").strip().lower())
+        if category_id is None:
+            fail(line_number, "Category not found")
+            continue
+        batch.append(row)
+        batch_categories.append(category_id)
+        batch_lines.append(line_number)
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await flush()
+    if batch:
+        await flush()
+    return report
@@ -0,0 +1,222 @@
+import asyncio
+import logging
+from typing import List, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api.book.utils import with_archived_history
+from models import UserBookHistory
+from settings import AsyncSessionLocal, RECOMMENDATIONS_REFRESH_SECONDS, RECOMMENDATIONS_READER_BOOKS
+
+logger = logging.getLogger(__name__)
+
+# "Readers who borrowed this also borrowed": a sparse book x book co-occurrence matrix of the loan history, the
+# number of readers who borrowed both books, held in memory by every worker. A background task started with the
+# application builds it from user_book_history and its archive, then applies the loans recorded since every
+# RECOMMENDATIONS_REFRESH_SECONDS, with a session of its own: requests only read the matrix, they never wait for a
+# build nor hold their connection during one (until the first build is done they get no recommendations). Each
+# reader counts with their RECOMMENDATIONS_READER_BOOKS most recently borrowed books, which bounds both the memory
+# and the work of one loan. The matrices are built with numpy and scipy.sparse on a worker thread, requests keep
+# answering from the current matrix meanwhile.
+
+# history rows read per batch
+BUILD_BATCH_SIZE = 10000
+# history ids re-read on every refresh, so a loan committed after one with a higher id is still applied; the ids
+# applied within this window are remembered and skipped, a loan is never counted twice
+REFRESH_OVERLAP = 1000
+
+
+def recent_loans(users, books, ids, reader_books: int):
+    """
+    Every reader's `reader_books` most recently borrowed distinct books
+    :return: (user ids, book ids, history ids of their latest loans)
+    """
+    import numpy as np  # imported on first use, keeps importing the app fast
+
+    # latest loan of every (reader, book)
+    order = np.lexsort((-ids, books, users))
+    users, books, ids = users[order], books[order], ids[order]
+    first = np.ones(len(users), dtype=bool)
+    first[1:] = (users[1:] != users[:-1]) | (books[1:] != books[:-1])
+    users, books, ids = users[first], books[first], ids[first]
+    # rank of each book among its reader's books, most recent first
+    order = np.lexsort((-ids, users))
+    users, books, ids = users[order], books[order], ids[order]
+    starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]]) if len(users) else np.zeros(0, dtype=np.int64)
+    rank = np.arange(len(users)) - np.repeat(starts, np.diff(np.r_[starts, len(users)]))
+    keep = rank < reader_books
+    return users[keep], books[keep], ids[keep]
+
+
+def co_occurrences(users, books, size: int):
+    """
+    :return: size x size CSR matrix, readers of both books by book ids, readers of the book on the diagonal
+    """
+    import numpy as np
+    from scipy import sparse
+
+    readers, rows = np.unique(users, return_inverse=True)
+    borrowed = sparse.csr_matrix((np.ones(len(users), dtype=np.int32), (rows, books)), shape=(len(readers), size))
+    return (borrowed.T @ borrowed).tocsr()
+
+
+class CoBorrowIndex:
+    """
+    Co-occurrence counts by book id, with the loans they are counted from
+    """
+
+    def __init__(self, reader_books: int = RECOMMENDATIONS_READER_BOOKS):
+        self.reader_books = reader_books
+        # book x book CSR matrix, None until built
+        self.matrix = None
+        # (user ids, book ids, history ids) of the loans counted, see recent_loans
+        self.loans = None
+        # highest history id applied, and the applied ids above watermark - REFRESH_OVERLAP
+        self.watermark = 0
+        self.applied = None
+        self.built = False
+
+    def updated(self, users, books, ids) -> tuple:
+        """
+        Apply loans not applied yet, runs on a worker thread and leaves the index as it is
+        :return: (matrix, loans, watermark, applied) to swap in
+        """
+        import numpy as np
+
+        if self.applied is not None:
+            fresh = ~np.isin(ids, self.applied)
+            users, books, ids = users[fresh], books[fresh], ids[fresh]
+        watermark = max(self.watermark, int(ids.max())) if len(ids) else self.watermark
+        applied = ids if self.applied is None else np.union1d(self.applied, ids)
+        applied = applied[applied > watermark - REFRESH_OVERLAP]
+        if self.loans is None:
+            kept_users, kept_books, kept_ids = (np.zeros(0, dtype=np.int64),) * 3
+        else:
+            kept_users, kept_books, kept_ids = self.loans
+        matrix = self.matrix if self.matrix is not None else co_occurrences(kept_users, kept_books, 0)
+        size = max(matrix.shape[0], int(books.max()) + 1 if len(books) else 0)
+        if size > matrix.shape[0]:
+            # the current matrix is still being read, grow a copy
+            matrix = matrix.copy()
+            matrix.resize((size, size))
+        if len(ids):
+            # only the readers with new loans change: their old books out, their new most recent books in
+            affected = np.isin(kept_users, np.unique(users))
+            old = (kept_users[affected], kept_books[affected], kept_ids[affected])
+            new = recent_loans(np.r_[old[0], users], np.r_[old[1], books], np.r_[old[2], ids], self.reader_books)
+            matrix = matrix - co_occurrences(old[0], old[1], size) + co_occurrences(new[0], new[1], size)
+            matrix.eliminate_zeros()
+            kept_users, kept_books, kept_ids = (np.r_[column[~affected], added]
+                                                for column, added in zip((kept_users, kept_books, kept_ids), new))
+        return matrix, (kept_users, kept_books, kept_ids), watermark, applied
+
+    def add(self, user_ids, book_ids, history_ids):
+        """
+        Apply loans on the calling thread, see updated
+        """
+        import numpy as np
+
+        columns = (np.asarray(column, dtype=np.int64) for column in (user_ids, book_ids, history_ids))
+        self.matrix, self.loans, self.watermark, self.applied = self.updated(*columns)
+
+    def similar(self, book_id: int, limit: int) -> List[Tuple[int, int]]:
+        """
+        :return: up to `limit` (book id, readers of both) pairs, most readers first then oldest book
+        """
+        import numpy as np
+
+        matrix = self.matrix
+        if matrix is None or not 0 <= book_id < matrix.shape[0]:
+            return []
+        start, end = matrix.indptr[book_id], matrix.indptr[book_id + 1]
+        others, readers = matrix.indices[start:end], matrix.data[start:end]
+        other = others != book_id
+        others, readers = others[other], readers[other]
+        best = np.lexsort((others, -readers))[:limit]
+        return [(int(others[i]), int(readers[i])) for i in best]
+
+    def updated_from_rows(self, batches: list) -> tuple:
+        """
+        updated from the (user id, book id, history id) rows read by refresh, runs on a worker thread
+        """
+        import numpy as np
+
+        rows = np.concatenate([np.array(batch, dtype=np.int64).reshape(-1, 3) for batch in batches]) if batches \
+            else np.zeros((0, 3), dtype=np.int64)
+        return self.updated(rows[:, 0], rows[:, 1], rows[:, 2])
+
+    async def refresh(self, db: AsyncSession):
+        """
+        Build the index, or apply the loans recorded since the last refresh once it is built
+        """
+        history = UserBookHistory if self.built else with_archived_history()
+        query = select(history.user_id, history.book_id, history.id).where(
+            history.user_id.isnot(None), history.book_id.isnot(None))
+        if self.built:
+            query = query.where(history.id > self.watermark - REFRESH_OVERLAP)
+        result = await db.stream(query)
+        batches = [batch async for batch in result.partitions(BUILD_BATCH_SIZE)]
+        # numpy, scipy and the matrices stay off the event loop, the result is swapped in at once
+        update = await asyncio.get_running_loop().run_in_executor(None, self.updated_from_rows, batches)
+        self.matrix, self.loans, self.watermark, self.applied = update
+        self.built = True
+
+    def stats(self) -> dict:
+        import numpy as np
+
+        if self.matrix is None:
+            return {"readers": 0, "books": 0, "pairs": 0, "watermark": self.watermark}
+        return {"readers": len(np.unique(self.loans[0])), "books": int((self.matrix.getnnz(axis=1) > 1).sum()),
+                "pairs": (self.matrix.nnz - int((self.matrix.diagonal() > 0).sum())) // 2,
+                "watermark": self.watermark}
+
+
+index = CoBorrowIndex()
+_refresher = None
+
+
+async def keep_refreshed():
+    """
+    Build the index, then refresh it every RECOMMENDATIONS_REFRESH_SECONDS, runs until cancelled
+    """
+    while True:
+        try:
+            async with AsyncSessionLocal() as db:
+                await index.refresh(db)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("recommendations refresh failed, retrying: %s", e)
+        await asyncio.sleep(RECOMMENDATIONS_REFRESH_SECONDS)
+
+
+async def start_recommendations():
+    """
+    Startup hook, builds and refreshes the index in the background
+    """
+    global _refresher
+    if _refresher is None:
+        _refresher = asyncio.create_task(keep_refreshed())
+
+
+async def stop_recommendations():
+    """
+    Shutdown hook
+    """
+    global _refresher
+    if _refresher is not None:
+        _refresher.cancel()
+        try:
+            await _refresher
+        except asyncio.CancelledError:
+            pass
+        _refresher = None
+
+
+def get_recommendations(book_id: int, limit: int) -> List[Tuple[int, int]]:
+    """
+    :return: (book id, readers of both) of the books most often borrowed by the readers of the book, from the
+             index as last refreshed
+    """
+    return index.similar(book_id, limit)
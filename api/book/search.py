@@ -0,0 +1,135 @@
+import math
+import re
+
+from typing import List
+
+from sqlalchemy import and_, case, column, distinct, false, func, literal, literal_column, or_, select, table, text
+
+from models import Book, association_table
+
+# only word characters reach the full text query syntax
+SEARCH_TERM = re.compile(r"\w+", re.UNICODE)
+
+# sqlite FTS5 index of books, see models.BOOK_SEARCH_DDL
+books_fts = table("books_fts", column("rowid"))
+# sqlite FTS5 trigram index of titles and authors, the typo tolerant side of fuzzy search
+books_trgm = table("books_trgm", column("rowid"), column("books_trgm"))
+# share of a term's trigrams a title or author must contain for a fuzzy match on sqlite,
+# the default word_similarity_threshold of pg_trgm
+TRIGRAM_THRESHOLD = 0.6
+
+
+def trigram_match(terms: List[str]):
+    """
+    SQLite fuzzy match: every term of three characters or more shares TRIGRAM_THRESHOLD of its trigrams with the
+    title or author, each trigram is one lookup in the books_trgm index
+    :return: (condition, number of shared trigrams) or None when every term is shorter
+    """
+    every_gram, conditions, shared = set(), [], literal(0)
+    for term in terms:
+        grams = sorted({term[i:i + 3] for i in range(len(term) - 2)})
+        if not grams:
+            continue
+        hits = literal(0)
+        for gram in grams:
+            every_gram.add(gram)
+            books = select(books_trgm.c.rowid).where(books_trgm.c.books_trgm.op("MATCH")(f'"{gram}"'))
+            hits = hits + case((Book.id.in_(books), 1), else_=0)
+        conditions.append(hits >= math.ceil(len(grams) * TRIGRAM_THRESHOLD))
+        shared = shared + hits
+    if not conditions:
+        return None
+    # books sharing no trigram are skipped without counting
+    candidates = select(books_trgm.c.rowid).where(
+        books_trgm.c.books_trgm.op("MATCH")(" OR ".join(f'"{gram}"' for gram in sorted(every_gram))))
+    return and_(Book.id.in_(candidates), *conditions), shared
+
+
+def book_search_query(dialect: str, q: str, fuzzy: bool = True):
+    """
+    Ranked full text search over title (highest weight), author and description
+    Every term is prefix matched. With fuzzy, trigram (typo tolerant) matches on title/author are also accepted,
+    by the pg_trgm indexes on Postgres and the books_trgm FTS5 trigram index on SQLite.
+    :param dialect: database dialect name of the session
+    :return: select(Book) filtered and ordered by relevance
+    """
+    terms = SEARCH_TERM.findall(q.lower())
+    if not terms:
+        return select(Book).where(false())
+
+    if dialect == "postgresql":
+        # the text search config must reach Postgres as an untyped literal to resolve to regconfig
+        ts_query = func.to_tsquery(literal_column("'simple'"), " & ".join(f"{term}:*" for term in terms))
+        search_vector = literal_column("books.search_vector")
+        matched = search_vector.op("@@")(ts_query)
+        score = func.ts_rank_cd(search_vector, ts_query)
+        if fuzzy:
+            # word similarity operators are served by the gin_trgm_ops indexes
+            matched = or_(matched, literal(q).op("<%")(Book.title), literal(q).op("<%")(Book.author))
+            score = score + func.word_similarity(q, Book.title) + func.word_similarity(q, Book.author) / 2
+        return select(Book).where(matched).order_by(score.desc(), Book.id)
+
+    if dialect == "sqlite":
+        ranked = (
+            select(books_fts.c.rowid.label("book_id"),
+                   # bm25 is lower for better matches, column weights follow title > author > description
+                   literal_column("bm25(books_fts, 10.0, 5.0, 1.0)").label("rank"))
+            .where(text("books_fts MATCH :match").bindparams(match=" ".join(f'"{term}"*' for term in terms)))
+            .subquery("ranked")
+        )
+        fuzzy_match = trigram_match(terms) if fuzzy else None
+        if fuzzy_match is None:
+            return select(Book).join(ranked, ranked.c.book_id == Book.id).order_by(ranked.c.rank, Book.id)
+        matched, shared = fuzzy_match
+        return (
+            select(Book)
+            .outerjoin(ranked, ranked.c.book_id == Book.id)
+            # both sides are lookups of book ids, the books table is not scanned
+            .where(or_(Book.id.in_(select(ranked.c.book_id)), matched))
+            # full text matches first, then the books sharing the most trigrams
+            .order_by(ranked.c.book_id.is_(None), ranked.c.rank, shared.desc(), Book.id)
+        )
+
+    # no search index for this database, substring match every term
+    return select(Book).where(
+        *(or_(Book.title.ilike(f"%{term}%"), Book.author.ilike(f"%{term}%")) for term in terms)
+    ).order_by(Book.id)
+
+
+def in_category(category_id: int):
+    """
+    Book filter on the association table, avoids joining categories and duplicating rows
+    """
+    return Book.id.in_(select(association_table.c.book_id).where(association_table.c.category_id == category_id))
+
+
+def category_book_ids(category_ids: List[int], match_all: bool = False, after: int = 0, limit: int = 100):
+    """
+    Page of the ids of the books in any (or with match_all, every one) of the categories, after the id `after`.
+    Served by the association (category_id, book_id) index, no books or categories are read.
+    """
+    category_ids = set(category_ids)
+    query = (
+        select(association_table.c.book_id)
+        .where(association_table.c.category_id.in_(category_ids), association_table.c.book_id > after)
+        .order_by(association_table.c.book_id)
+        .limit(limit)
+    )
+    if len(category_ids) == 1:
+        # a book is linked to a category once, a plain range scan of the index
+        return query
+    query = query.group_by(association_table.c.book_id)
+    if match_all:
+        query = query.having(func.count(distinct(association_table.c.category_id)) == len(category_ids))
+    return query
+
+
+def category_book_counts(category_ids: List[int] = None):
+    """
+    (category id, number of books) of the categories with books, in one aggregate over the association table
+    """
+    query = select(association_table.c.category_id, func.count(distinct(association_table.c.book_id))) \
+        .group_by(association_table.c.category_id)
+    if category_ids is not None:
+        query = query.where(association_table.c.category_id.in_(set(category_ids)))
+    return query
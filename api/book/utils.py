@@ -1,14 +1,342 @@
-from fastapi import HTTPException
-from sqlalchemy.orm import Session
+import base64
+import hashlib
+import json
+from datetime import datetime
+from typing import Dict, List, Tuple
 
-from models import UserBookHistory
+from fastapi import HTTPException, status
+from sqlalchemy import select, tuple_, update, insert, cast, Float, literal, func, union_all, literal_column
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 
+from enums import ActionType
+from models import UserBookHistory, Book, Category, association_table, BookRatingSummary, UserBookHistoryArchive
 
-def is_book_borrowed_by_user(book_id: int, user_id: int, db: Session):
+# supported keyset orderings for book listings, each ends with Book.id as the tie breaker
+BOOK_ORDERINGS = ("id", "title")
+
+# title ordering key, the expression of the ix_books_title_id index. A NULL title would make the (title, id) row value
+# comparison NULL and skip rows or stall the cursor, so NULLs sort as empty titles. The '' is a literal, with a bind
+# parameter the planner could not match the index.
+BOOK_TITLE_KEY = func.coalesce(Book.title, literal_column("''"))
+
+# rows fetched per round trip when streaming the whole catalog
+BOOK_STREAM_BATCH_SIZE = 500
+
+
+async def is_book_borrowed_by_user(book_id: int, user_id: int, db: AsyncSession):
     # Check if the book is borrowed by the user
-    is_borrowed = db.query(UserBookHistory).filter_by(book_id=book_id, user_id=user_id, returned_date=None).first()
+    result = await db.execute(
+        select(UserBookHistory).filter_by(book_id=book_id, user_id=user_id, returned_date=None)
+    )
+    is_borrowed = result.scalars().first()
 
     if not is_borrowed:
         raise HTTPException(status_code=404, detail="Book is not borrowed by the user")
 
-    return True
\ No newline at end of file
+    return True
+
+
+def make_etag(*versions) -> str:
+    """
+    Strong ETag of a representation from the (kind, id, version) of every row it is built from
+    """
+    return '"%s"' % hashlib.sha1(json.dumps(versions, separators=(",", ":")).encode()).hexdigest()[:20]
+
+
+def book_etag(book: dict) -> str:
+    """
+    ETag of a catalog.get_book result, the embedded categories are part of it
+    """
+    return make_etag(["book", book["id"], book["version"]],
+                     *(["category", category["id"], category["version"]] for category in book["categories"]))
+
+
+def category_etag(category) -> str:
+    """
+    ETag of a category entry or Category row
+    """
+    if isinstance(category, dict):
+        return make_etag(["category", category["id"], category["version"]])
+    return make_etag(["category", category.id, category.version])
+
+
+def etag_matches(header: str, etag: str, weak: bool = True) -> bool:
+    """
+    Whether an If-None-Match (weak comparison) or If-Match (strong comparison) header matches the ETag
+    """
+    if header is None:
+        return False
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            if not weak:
+                continue
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def encode_cursor(position: dict) -> str:
+    """
+    Opaque pagination cursor from the last row's sort key
+    """
+    return base64.urlsafe_b64encode(json.dumps(position, separators=(",", ":")).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> dict:
+    """
+    :raises: if the cursor was not produced by encode_cursor
+    :return: the sort key the cursor was built from
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        position = None
+    if not isinstance(position, dict):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    return position
+
+
+def category_books_after(cursor: str = None) -> int:
+    """
+    :raises: if the cursor is not one of a category listing
+    :return: book id the category listing page starts after
+    """
+    if cursor is None:
+        return 0
+    position = decode_cursor(cursor)
+    if position.get("o") != "category_books" or not isinstance(position.get("id"), int):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    return position["id"]
+
+
+def book_keyset(query, order_by: str, cursor: str = None):
+    """
+    Apply a stable ordering and, when a cursor is given, the keyset condition to a Book query
+    :raises: if the cursor belongs to another ordering
+    """
+    if order_by == "title":
+        query = query.order_by(BOOK_TITLE_KEY, Book.id)
+    else:
+        query = query.order_by(Book.id)
+    if cursor is None:
+        return query
+    position = decode_cursor(cursor)
+    if position.get("o") != order_by or not isinstance(position.get("id"), int) or \
+            order_by == "title" and not isinstance(position.get("t"), str):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    if order_by == "title":
+        # row value comparison so the (title, id) index drives the scan
+        return query.where(tuple_(BOOK_TITLE_KEY, Book.id) > tuple_(position["t"], position["id"]))
+    return query.where(Book.id > position["id"])
+
+
+def book_cursor(book: Book, order_by: str) -> str:
+    """
+    cursor pointing just after the given book in the given ordering
+    """
+    position = {"o": order_by, "id": book.id}
+    if order_by == "title":
+        position["t"] = book.title or ""
+    return encode_cursor(position)
+
+
+async def stream_books_ndjson(db: AsyncSession, batch_size: int = BOOK_STREAM_BATCH_SIZE):
+    """
+    Yield every book with its categories as one JSON document per line.
+    Books come from a server side cursor in batches and their categories from one query per batch,
+    plain rows are used instead of ORM instances so nothing accumulates in the session.
+    """
+    result = await db.stream(
+        select(Book.id, Book.title, Book.description, Book.author, Book.count).order_by(Book.id)
+    )
+    async for batch in result.partitions(batch_size):
+        categories = {}
+        category_rows = await db.execute(
+            select(association_table.c.book_id, Category.id, Category.title, Category.description)
+            .join(Category, Category.id == association_table.c.category_id)
+            .where(association_table.c.book_id.in_([row.id for row in batch]))
+        )
+        for book_id, category_id, title, description in category_rows:
+            categories.setdefault(book_id, []).append({"id": category_id, "title": title, "description": description})
+        yield "".join(
+            json.dumps({**row._asdict(), "categories": categories.get(row.id, [])}) + "\n" for row in batch
+        )
+
+
+async def apply_rating_change(db: AsyncSession, book_id: int, stars: int, old_stars: int = None):
+    """
+    Update the book's rating aggregate in the caller's transaction with a single UPDATE, the rating itself must be
+    flushed already so its own conflicts surface before the aggregate changes
+    :param stars: new rating value 1-5
+    :param old_stars: previous rating of the same user when the rating is changed, None for a new rating
+    """
+    if stars == old_stars:
+        return
+    summary = BookRatingSummary.__table__
+    sum_delta, count_delta = (stars, 1) if old_stars is None else (stars - old_stars, 0)
+    values = {
+        "rating_sum": summary.c.rating_sum + sum_delta,
+        "rating_count": summary.c.rating_count + count_delta,
+        "rating_avg": cast(summary.c.rating_sum + sum_delta, Float) / (summary.c.rating_count + count_delta),
+        f"stars_{stars}": summary.c[f"stars_{stars}"] + 1,
+    }
+    if old_stars is not None:
+        values[f"stars_{old_stars}"] = summary.c[f"stars_{old_stars}"] - 1
+    change = update(summary).where(summary.c.book_id == book_id).values(values)
+
+    result = await db.execute(change)
+    if result.rowcount:
+        return
+    # first rating of this book
+    try:
+        async with db.begin_nested():
+            await db.execute(insert(summary).values(
+                book_id=book_id, rating_sum=stars, rating_count=1, rating_avg=stars,
+                **{f"stars_{value}": int(value == stars) for value in range(1, 6)}
+            ))
+    except IntegrityError as e:
+        if not is_unique_violation(e, summary.name):
+            raise
+        # a concurrent first rating created the row meanwhile, the savepoint kept the transaction usable
+        await db.execute(change)
+
+
+def is_unique_violation(error: IntegrityError, table: str) -> bool:
+    """
+    Whether the error is a duplicate key in the table, on Postgres (its constraint names start with the table name)
+    or SQLite
+    """
+    message = str(error.orig)
+    if getattr(error.orig, "pgcode", None) == "23505":
+        return table in message
+    return f"UNIQUE constraint failed: {table}." in message
+
+
+def rating_summary(book_id: int, summary: BookRatingSummary = None) -> dict:
+    """
+    rating summary response of a book, zeros when the book has no ratings yet
+    """
+    return {
+        "book_id": book_id,
+        "average": round(summary.rating_avg, 2) if summary else 0.0,
+        "count": summary.rating_count if summary else 0,
+        "histogram": {value: getattr(summary, f"stars_{value}") if summary else 0 for value in range(1, 6)},
+    }
+
+
+async def borrow_copies(db: AsyncSession, book_ids: List[int], user_id: int) -> Dict[int, Tuple[int, int]]:
+    """
+    Take one copy of every given book that has one left and record the loans, without reading the books first.
+    Counts are decremented by a conditional UPDATE so concurrent borrowers can never oversell.
+    On Postgres the update and the history inserts are one statement (data modifying CTEs).
+    :return: (remaining count, version) by book id for the books that were borrowed
+    """
+    books = Book.__table__
+    history = UserBookHistory.__table__
+    borrowed_date = datetime.utcnow().date()
+
+    if db.bind.dialect.name == "postgresql":
+        taken = update(books).where(books.c.id.in_(book_ids), books.c.count > 0).values(
+            count=books.c.count - 1, version=books.c.version + 1
+        ).returning(books.c.id, books.c.count, books.c.version).cte("taken")
+        recorded = insert(history).from_select(
+            ["user_id", "book_id", "borrowed_date", "action"],
+            # bind parameters in a select list are untyped for asyncpg, cast them to the column types
+            select(cast(literal(user_id), history.c.user_id.type), taken.c.id,
+                   cast(literal(borrowed_date), history.c.borrowed_date.type),
+                   cast(literal(ActionType.BORROW), history.c.action.type)),
+        ).returning(history.c.book_id).cte("recorded")
+        result = await db.execute(
+            select(taken.c.id, taken.c.count, taken.c.version).join(recorded, recorded.c.book_id == taken.c.id)
+        )
+        return {book_id: (count, version) for book_id, count, version in result}
+
+    taken = []
+    for book_id in book_ids:
+        result = await db.execute(
+            update(books).where(books.c.id == book_id, books.c.count > 0).values(
+                count=books.c.count - 1, version=books.c.version + 1
+            )
+        )
+        if result.rowcount:
+            taken.append(book_id)
+    if not taken:
+        return {}
+    await db.execute(insert(history), [
+        {"user_id": user_id, "book_id": book_id, "borrowed_date": borrowed_date, "action": ActionType.BORROW}
+        for book_id in taken
+    ])
+    result = await db.execute(select(books.c.id, books.c.count, books.c.version).where(books.c.id.in_(taken)))
+    return {book_id: (count, version) for book_id, count, version in result}
+
+
+async def return_copies(db: AsyncSession, book_ids: List[int], user_id: int) -> Dict[int, Tuple[int, int]]:
+    """
+    Close the user's open loan of every given book and put the copies back.
+    Loans are closed by a conditional UPDATE so a copy can only be returned once.
+    :return: (new count, version) by book id for the books that were returned
+    """
+    books = Book.__table__
+    history = UserBookHistory.__table__
+    open_loans = select(func.min(history.c.id)).where(
+        history.c.user_id == user_id, history.c.book_id.in_(book_ids), history.c.returned_date.is_(None)
+    ).group_by(history.c.book_id)
+    close = update(history).where(history.c.id.in_(open_loans), history.c.returned_date.is_(None)).values(
+        returned_date=datetime.utcnow().date(), action=ActionType.RETURN
+    )
+    put_back = update(books).values(count=books.c.count + 1, version=books.c.version + 1)
+
+    if db.bind.dialect.name == "postgresql":
+        closed = close.returning(history.c.book_id).cte("closed")
+        restocked = put_back.where(books.c.id.in_(select(closed.c.book_id))).returning(
+            books.c.id, books.c.count, books.c.version
+        ).cte("restocked")
+        result = await db.execute(select(restocked.c.id, restocked.c.count, restocked.c.version))
+        return {book_id: (count, version) for book_id, count, version in result}
+
+    closed = []
+    for book_id in book_ids:
+        result = await db.execute(close.where(history.c.book_id == book_id))
+        if result.rowcount:
+            closed.append(book_id)
+    if not closed:
+        return {}
+    await db.execute(put_back.where(books.c.id.in_(closed)))
+    result = await db.execute(select(books.c.id, books.c.count, books.c.version).where(books.c.id.in_(closed)))
+    return {book_id: (count, version) for book_id, count, version in result}
+
+
+async def borrow_copy(db: AsyncSession, book_id: int, user_id: int):
+    """
+    Take one copy of the book, see borrow_copies
+    :return: (remaining count, version), None if the book does not exist or has no copy left
+    """
+    return (await borrow_copies(db, [book_id], user_id)).get(book_id)
+
+
+async def return_copy(db: AsyncSession, book_id: int, user_id: int):
+    """
+    Put back the user's copy of the book, see return_copies
+    :return: (new count, version), None if the user has no open loan of the book
+    """
+    return (await return_copies(db, [book_id], user_id)).get(book_id)
+
+
+def with_archived_history():
+    """
+    UserBookHistory over the union of user_book_history and user_book_history_archive, filters on it reach
+    both tables and their indexes
+    """
+    columns = ("id", "user_id", "book_id", "borrowed_date", "returned_date", "action")
+    hot, archived = UserBookHistory.__table__, UserBookHistoryArchive.__table__
+    history = union_all(
+        select(*(hot.c[name] for name in columns)),
+        select(*(archived.c[name] for name in columns)),
+    ).subquery("history")
+    return aliased(UserBookHistory, history)
@@ -0,0 +1,96 @@
+"""
+Offset vs keyset pagination benchmark for GET /api/books
+
+Seeds the catalog to cover the requested page and compares the latency of fetching that page with
+?skip= (offset) against ?cursor= (keyset). Offset cost grows with the page number, keyset stays flat.
+
+Usage:
+    DATABASE_URL=sqlite:///./bench.db SECRET_KEY=bench python benchmarks/books_pagination.py --page 1000
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///./bench.db")
+os.environ.setdefault("SECRET_KEY", "bench")
+# measures the code path, not the admission control and rate limits in front of it
+os.environ.setdefault("ADMISSION_CONTROL", "false")
+
+import httpx  # noqa: E402
+
+from legacy_tokens import create_access_token  # noqa: E402
+from api.book.utils import book_cursor, BOOK_TITLE_KEY  # noqa: E402
+from main import app  # noqa: E402
+from models import Book, User, create_schema  # noqa: E402
+from settings import SessionLocal  # noqa: E402
+
+
+def seed(books: int):
+    """
+    Make sure there are at least `books` books and a reader, return (reader id, db session)
+    """
+    create_schema()
+    db = SessionLocal()
+    user = db.query(User).filter(User.email == "bench@example.com").first()
+    if user is None:
+        user = User(name="bench", email="bench@example.com", password="-", is_active=True)
+        db.add(user)
+    missing = books - db.query(Book).count()
+    if missing > 0:
+        db.bulk_insert_mappings(Book, [{"title": f"Book {i:08d}", "description": "-", "author": "-", "count": 1}
+                                       for i in range(missing)])
+    db.commit()
+    return user.id, db
+
+
+async def timed(client: httpx.AsyncClient, url: str, headers: dict, repeat: int) -> float:
+    """
+    median latency in ms
+    """
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = await client.get(url, headers=headers)
+        samples.append(time.perf_counter() - start)
+        response.raise_for_status()
+    return statistics.median(samples) * 1000
+
+
+async def main(args):
+    skip = (args.page - 1) * args.limit
+    user_id, db = seed(skip + args.limit)
+    token = create_access_token({"sub": user_id}, expires_delta=timedelta(hours=1))
+    headers = {"Authorization": f"Bearer {token}"}
+    results = {}
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        for order_by, order in (("id", [Book.id]), ("title", [BOOK_TITLE_KEY, Book.id])):
+            # the cursor a client would hold after reading the previous page
+            previous = db.query(Book).order_by(*order).offset(skip - 1).first()
+            cursor = book_cursor(previous, order_by)
+            offset_url = f"/api/books?limit={args.limit}&order_by={order_by}&skip={skip}"
+            keyset_url = f"/api/books?limit={args.limit}&order_by={order_by}&cursor={cursor}"
+            offset_page = (await client.get(offset_url, headers=headers)).json()
+            keyset_page = (await client.get(keyset_url, headers=headers)).json()
+            assert offset_page == keyset_page, "offset and keyset pages differ"
+            results[order_by] = (await timed(client, offset_url, headers, args.repeat),
+                                 await timed(client, keyset_url, headers, args.repeat))
+    db.close()
+
+    print(f"page {args.page} of {args.limit} books (skip={skip}), median of {args.repeat} requests")
+    print(f"{'order_by':>8} {'offset ms':>10} {'keyset ms':>10} {'speedup':>8}")
+    for order_by, (offset_ms, keyset_ms) in results.items():
+        print(f"{order_by:>8} {offset_ms:>10.2f} {keyset_ms:>10.2f} {offset_ms / keyset_ms:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--page", type=int, default=1000)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
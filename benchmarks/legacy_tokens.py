@@ -0,0 +1,18 @@
+"""
+Access tokens of the original sub-only format, for the benchmarks: they carry no claims, so get_current_user
+resolves every request's user through the principal cache and, on a miss, the users table.
+Imported by the benchmark scripts once they have set up the environment.
+"""
+from datetime import datetime, timedelta
+
+import jwt
+
+from settings import SECRET_KEY, ALGORITHM
+
+
+def create_access_token(data: dict, expires_delta: timedelta = timedelta(minutes=15)) -> str:
+    """
+    :param data: claims, {"sub": user id}
+    :return: jwt token
+    """
+    return jwt.encode({**data, "exp": datetime.utcnow() + expires_delta}, SECRET_KEY, algorithm=ALGORITHM)
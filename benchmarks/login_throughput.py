@@ -0,0 +1,92 @@
+"""
+Login throughput benchmark
+
+Fires concurrent POST /api/user/login requests through the ASGI app and reports logins/second
+together with the worst event loop stall seen meanwhile. With bcrypt on the event loop the stall
+is roughly one hash per queued login; on the hashing pool it stays in the low milliseconds.
+
+Usage:
+    DATABASE_URL=sqlite:///./bench.db SECRET_KEY=bench python benchmarks/login_throughput.py
+    BCRYPT_ROUNDS=10 PASSWORD_HASH_CONCURRENCY=8 ... python benchmarks/login_throughput.py --logins 400
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///./bench.db")
+os.environ.setdefault("SECRET_KEY", "bench")
+# measures the code path, not the admission control and rate limits in front of it
+os.environ.setdefault("ADMISSION_CONTROL", "false")
+
+import httpx  # noqa: E402
+
+from api.account.utils import get_password_hash  # noqa: E402
+from main import app  # noqa: E402
+from models import User, create_schema  # noqa: E402
+from settings import SessionLocal, BCRYPT_ROUNDS, PASSWORD_HASH_CONCURRENCY  # noqa: E402
+
+EMAIL = "login-bench@example.com"
+PASSWORD = "bench-password"
+
+
+def seed():
+    """
+    Create (or reset) the benchmark user with a hash at the configured cost
+    """
+    create_schema()
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.email == EMAIL).first()
+        if user is None:
+            user = User(name="login-bench", email=EMAIL, is_active=True)
+            db.add(user)
+        user.password = get_password_hash(PASSWORD)
+        db.commit()
+    finally:
+        db.close()
+
+
+async def watch_loop(stop: asyncio.Event, interval: float = 0.005) -> float:
+    """
+    Measure the longest delay of a periodic tick, i.e. how long the event loop was blocked
+    """
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - start - interval)
+    return worst
+
+
+async def main(args):
+    seed()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    async with httpx.AsyncClient(app=app, base_url="http://bench", timeout=60) as client:
+
+        async def login():
+            async with semaphore:
+                response = await client.post("/api/user/login", json={"email": EMAIL, "password": PASSWORD})
+                response.raise_for_status()
+
+        stop = asyncio.Event()
+        watcher = asyncio.create_task(watch_loop(stop))
+        start = time.perf_counter()
+        await asyncio.gather(*(login() for _ in range(args.logins)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        stall = await watcher
+
+    print(f"bcrypt rounds={BCRYPT_ROUNDS} hashing pool={PASSWORD_HASH_CONCURRENCY} in-flight={args.concurrency}")
+    print(f"{args.logins} logins in {elapsed:.2f}s -> {args.logins / elapsed:.1f} logins/s")
+    print(f"worst event loop stall: {stall * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=32)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,136 @@
+"""
+Serialization micro-benchmark: CPU cost of turning an endpoint's return value into response bytes
+
+For each endpoint a typical return value is built in memory (ORM instances as the handler gets them from the
+session, catalog entries as they come from the cache) and rendered two ways:
+    before  untyped route: jsonable_encoder walks the objects, JSONResponse (stdlib json) renders them
+    after   the route as declared: its response model's compiled serializer shapes the value, the response model
+            validates it (not with --no-validation, as with RESPONSE_VALIDATION=false), orjson renders it
+No database is involved, only serialization is measured.
+
+Usage:
+    python benchmarks/serialization.py --rows 100
+    python benchmarks/serialization.py --rows 100 --no-validation
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///./bench.db")
+os.environ.setdefault("SECRET_KEY", "bench")
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.routing import APIRoute  # noqa: E402
+from sqlalchemy.orm.attributes import set_committed_value  # noqa: E402
+from starlette.responses import JSONResponse  # noqa: E402
+
+from api.book.catalog import row_entry  # noqa: E402
+from enums import ActionType  # noqa: E402
+from main import app  # noqa: E402
+from models import Book, Category, User, UserBookHistory  # noqa: E402
+from responses import ORJSONResponse, ORJSONResponseWithoutNone, field_serializer  # noqa: E402
+
+
+def payloads(rows: int) -> dict:
+    """
+    (method, path) -> a return value of the endpoint's handler
+    """
+    categories = [Category(id=i, title=f"Shelf {i}", description="-", version=1) for i in range(1, 21)]
+    books = [Book(id=i, title=f"Book {i}", description="A description of a few words", author=f"Author {i % 97}",
+                  count=i % 5, version=1) for i in range(1, rows + 1)]
+    for book in books:
+        # loaded like joinedload(Book.categories) does, without filling the other side (Category.books)
+        set_committed_value(book, "categories", [categories[book.id % 20]])
+    # catalog entries as the cache holds them
+    category_entries = [row_entry(category) for category in categories]
+    book_entries = [{**row_entry(book), "category_ids": [book.categories[0].id]} for book in books]
+    book_entry = {**book_entries[0], "categories": [category_entries[1]]}
+    history = [UserBookHistory(id=i, user_id=i % 13, book_id=i, borrowed_date=date(2024, 1, 1),
+                               returned_date=date(2024, 1, 9) if i % 3 else None, action=ActionType.BORROW)
+               for i in range(1, rows + 1)]
+    users = [User(id=i, name=f"Reader {i}", email=f"reader{i}@example.com", password="$2b$12$" + "x" * 53,
+                  is_active=True, is_admin=False) for i in range(1, rows + 1)]
+    return {
+        ("GET", "/api/books"): books,
+        ("GET", "/api/all-books"): {"books": books},
+        ("GET", "/api/book/{book_id}"): book_entry,
+        ("POST", "/api/book"): {"status": "OK", "message": "Book created successfully", "Book": books[0]},
+        ("PUT", "/api/book/{book_id}"): {"Status": "OK", "message": "Book updated successfully", "Book": books[0]},
+        ("POST", "/api/books/borrow"): {"Status": "OK", "message": "2 of 3 books borrowed", "results": [
+            {"book_id": 1, "status": "borrowed", "count": 3}, {"book_id": 2, "status": "borrowed", "count": 0},
+            {"book_id": 3, "status": "unavailable"}]},
+        ("GET", "/api/user/book"): books[:10],
+        ("GET", "/api/history/"): history,
+        ("GET", "/api/categories"): category_entries,
+        ("GET", "/api/category/{category_id}/books"): book_entries,
+        ("GET", "/api/users"): users,
+    }
+
+
+def find_route(method: str, path: str) -> APIRoute:
+    for route in app.routes:
+        if isinstance(route, APIRoute) and route.path == path and method in route.methods:
+            return route
+    raise LookupError(f"{method} {path}")
+
+
+async def before(route: APIRoute, content) -> bytes:
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def renderer(route: APIRoute, validate: bool):
+    """
+    The body ORJSONRoute serves for a return value of the route's handler
+    """
+    field = route.response_field
+    serializer = field_serializer(field, route.response_model_exclude_none)
+    response_class = ORJSONResponseWithoutNone if route.response_model_exclude_none else ORJSONResponse
+
+    async def render(route: APIRoute, content) -> bytes:
+        data = serializer(content)
+        if validate:
+            data, errors = field.validate(data, {}, loc=("response",))
+            assert not errors, errors
+        return response_class(data).body
+
+    return render
+
+
+async def measure(render, route: APIRoute, content, seconds: float):
+    """
+    :return: (microseconds per response, response size)
+    """
+    body = await render(route, content)
+    n, start = 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for _ in range(10):
+            await render(route, content)
+        n += 10
+    return (time.perf_counter() - start) / n * 1e6, len(body)
+
+
+async def main(args):
+    print(f"{'endpoint':<42}{'before us':>11}{'after us':>11}{'speedup':>9}{'bytes':>15}")
+    total_before = total_after = 0
+    for (method, path), content in payloads(args.rows).items():
+        route = find_route(method, path)
+        cost_before, size_before = await measure(before, route, content, args.seconds)
+        cost_after, size_after = await measure(renderer(route, not args.no_validation), route, content, args.seconds)
+        total_before += cost_before
+        total_after += cost_after
+        print(f"{method + ' ' + path:<42}{cost_before:>11.1f}{cost_after:>11.1f}{cost_before / cost_after:>8.2f}x"
+              f"{f'{size_before}->{size_after}':>15}")
+    print(f"{'all endpoints':<42}{total_before:>11.1f}{total_after:>11.1f}{total_before / total_after:>8.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100, help="rows in the list responses")
+    parser.add_argument("--no-validation", action="store_true", help="skip the response model validation")
+    parser.add_argument("--seconds", type=float, default=0.5, help="time spent on each measurement")
+    asyncio.run(main(parser.parse_args()))
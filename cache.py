@@ -0,0 +1,275 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from settings import REDIS_URL
+
+logger = logging.getLogger(__name__)
+
+# sentinel for a cache miss, None is a valid cached value
+MISSING = object()
+
+# every named cache, used by the admin stats endpoint
+caches = {}
+
+# deletes are published here so every worker drops its local copy
+INVALIDATION_CHANNEL = "cache:invalidate"
+
+# handlers of the other messages on the channel by name, called with the payload, e.g. token revocations
+message_handlers = {}
+
+# keys whose last delete is remembered per cache, see TieredCache.generation
+GENERATIONS_SIZE = 10000
+
+_redis_client = None
+_listener = None
+
+
+def get_redis():
+    """
+    Shared async Redis client, None when REDIS_URL is not configured
+    """
+    global _redis_client
+    if _redis_client is None and REDIS_URL:
+        import redis.asyncio as redis  # optional dependency, only needed with REDIS_URL
+
+        _redis_client = redis.from_url(REDIS_URL)
+    return _redis_client
+
+
+class LRUCache:
+    """
+    In-process LRU cache whose entries expire after `ttl` seconds
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return MISSING
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TieredCache:
+    """
+    Local LRU tier in front of an optional shared Redis tier.
+    Values must be JSON serializable. Redis errors are logged and treated as misses.
+    With Redis, deletes are also broadcast to the local tier of the other workers (see listen_for_invalidations).
+    """
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 60, redis=None, redis_ttl: float = None):
+        self.name = name
+        self.local = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.redis = redis
+        self.redis_ttl = int(redis_ttl or ttl)
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.coalesced = 0
+        self.invalidations = 0
+        # loads in flight by key, concurrent misses of a key wait for the same load
+        self._loading = {}
+        # key -> generation of its last delete, a load that raced a delete of its key is returned but not stored.
+        # Generations only grow; a key dropped from here reads as the latest generation dropped, so a load in
+        # flight meanwhile is never stored by mistake, at worst not stored.
+        self._generations = OrderedDict()
+        self._last_generation = 0
+        self._dropped_generation = 0
+        caches[name] = self
+
+    def generation(self, key) -> int:
+        """
+        Changes whenever the key is deleted: read it before loading a value and store the value only if it is
+        unchanged, so a value loaded before a write is not cached after the write invalidated it
+        """
+        return self._generations.get(key, self._dropped_generation)
+
+    def _invalidate(self, keys):
+        for key in keys:
+            self._last_generation += 1
+            self._generations[key] = self._last_generation
+            self._generations.move_to_end(key)
+            self.local.delete(key)
+        while len(self._generations) > GENERATIONS_SIZE:
+            _, self._dropped_generation = self._generations.popitem(last=False)
+
+    def _redis_key(self, key) -> str:
+        return f"{self.name}:{key}"
+
+    async def get(self, key):
+        value = self.local.get(key)
+        if value is not MISSING:
+            self.hits += 1
+            return value
+        if self.redis is not None:
+            try:
+                raw = await self.redis.get(self._redis_key(key))
+            except Exception as e:
+                logger.warning("cache %s: redis get failed: %s", self.name, e)
+                raw = None
+            if raw is not None:
+                value = json.loads(raw)
+                self.local.set(key, value)
+                self.redis_hits += 1
+                return value
+        self.misses += 1
+        return MISSING
+
+    async def set(self, key, value):
+        self.local.set(key, value)
+        if self.redis is not None:
+            try:
+                await self.redis.set(self._redis_key(key), json.dumps(value), ex=self.redis_ttl)
+            except Exception as e:
+                logger.warning("cache %s: redis set failed: %s", self.name, e)
+
+    async def get_or_load(self, key, loader):
+        """
+        Read through: on a miss `await loader()` once per worker however many requests miss at the same time
+        (stampede protection). A None result is returned but not cached.
+        """
+        value = await self.get(key)
+        if value is not MISSING:
+            return value
+        pending = self._loading.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                # the request loading it went away, load it here instead
+                return await self.get_or_load(key, loader)
+        pending = asyncio.get_running_loop().create_future()
+        self._loading[key] = pending
+        generation = self.generation(key)
+        try:
+            self.loads += 1
+            value = await loader()
+            if value is not None and generation == self.generation(key):
+                await self.set(key, value)
+        except asyncio.CancelledError:
+            pending.cancel()
+            raise
+        except Exception as e:
+            pending.set_exception(e)
+            # retrieved here so an unawaited failure is not reported, waiters still get the exception
+            pending.exception()
+            raise
+        else:
+            pending.set_result(value)
+        finally:
+            del self._loading[key]
+        return value
+
+    async def delete(self, *keys):
+        """
+        Drop the keys from both tiers and, through Redis, from the local tier of every worker
+        """
+        if not keys:
+            return
+        self.invalidations += len(keys)
+        self._invalidate(keys)
+        if self.redis is not None:
+            try:
+                await self.redis.delete(*(self._redis_key(key) for key in keys))
+                await self.redis.publish(INVALIDATION_CHANNEL, json.dumps([self.name, list(keys)]))
+            except Exception as e:
+                logger.warning("cache %s: redis delete failed: %s", self.name, e)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.redis_hits + self.misses
+        return {
+            "size": len(self.local),
+            "hits": self.hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.redis_hits) / lookups, 4) if lookups else 0.0,
+            "loads": self.loads,
+            "coalesced": self.coalesced,
+            "invalidations": self.invalidations,
+            "redis": self.redis is not None,
+        }
+
+
+async def listen_for_invalidations(redis):
+    """
+    Drop the keys other workers delete from the local tier of this worker's caches, runs until cancelled
+    """
+    while True:
+        try:
+            pubsub = redis.pubsub()
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                name, keys = json.loads(message["data"])
+                cache = caches.get(name)
+                if cache is not None:
+                    cache._invalidate(keys)
+                elif name in message_handlers:
+                    message_handlers[name](keys)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("cache invalidation listener failed, resubscribing: %s", e)
+            await asyncio.sleep(1)
+
+
+async def start_invalidation_listener():
+    """
+    Startup hook, subscribes to the invalidations of the other workers when Redis is configured
+    """
+    global _listener
+    redis = get_redis()
+    if redis is not None and _listener is None:
+        _listener = asyncio.create_task(listen_for_invalidations(redis))
+
+
+async def stop_invalidation_listener():
+    """
+    Shutdown hook
+    """
+    global _listener
+    if _listener is not None:
+        _listener.cancel()
+        try:
+            await _listener
+        except asyncio.CancelledError:
+            pass
+        _listener = None
+
+
+def get_cache_stats() -> dict:
+    """
+    hit/miss counters of every named cache in this worker
+    """
+    return {name: cache.stats() for name, cache in caches.items()}
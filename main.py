@@ -1,15 +1,52 @@
 from fastapi import FastAPI
 
+from admission import AdmissionMiddleware
 from api.account import account_api_endpoints
+from api.account.revocation import load_revocations
+from api.admin import admin_api_endpoints
+from api.book import book_api_endpoints
+from api.book.recommendations import start_recommendations, stop_recommendations
+from cache import start_invalidation_listener, stop_invalidation_listener
+from metrics import MetricsMiddleware
+from responses import ORJSONResponse
+from settings import open_pool, close_pool, QUERY_PROFILER, ADMISSION_CONTROL
 
 
 # FastAPI App
-from api.book import book_api_endpoints
+def create_app() -> FastAPI:
+    """
+    Build the application. Nothing here touches the database: the engine is created on first use and the schema
+    is created by its own command (python -m models), so a worker starts without a database round trip.
+    :return: FastAPI app
+    """
+    # the database pool lives for the whole application, not per request
+    app = FastAPI(on_startup=[open_pool, start_invalidation_listener, load_revocations, start_recommendations],
+                  on_shutdown=[stop_recommendations, stop_invalidation_listener, close_pool],
+                  default_response_class=ORJSONResponse)
+
+    if ADMISSION_CONTROL:
+        # adaptive concurrency limit per route and per user rate limits, the excess gets 503/429 right away
+        app.add_middleware(AdmissionMiddleware, routes=app.routes)
+
+    # latency, in flight requests and SQL work per route, served on /metrics
+    app.add_middleware(MetricsMiddleware)
+
+    if QUERY_PROFILER:
+        from query_profiler import QueryProfilerMiddleware
+
+        # statements per request, N+1 and slow statement warnings (development and staging)
+        app.add_middleware(QueryProfilerMiddleware)
+
+    # Include routers for account-related API endpoints
+    app.include_router(account_api_endpoints.router)
+
+    # Include routers for book-related API endpoints
+    app.include_router(book_api_endpoints.router)
 
-app = FastAPI()
+    # Include routers for admin-only operational endpoints
+    app.include_router(admin_api_endpoints.router)
+    return app
 
-# Include routers for account-related API endpoints
-app.include_router(account_api_endpoints.router)
 
-# Include routers for book-related API endpoints
-app.include_router(book_api_endpoints.router)
+# uvicorn main:app (or uvicorn main:create_app --factory)
+app = create_app()
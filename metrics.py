@@ -0,0 +1,199 @@
+import bisect
+import contextvars
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from api.book.availability import hub
+from cache import get_cache_stats
+from settings import get_pool_status
+
+# Prometheus metrics of this worker process, scrape every worker (or aggregate) behind a multi worker server
+
+# latency buckets in seconds, requests and single statements
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# statements run by one request
+STATEMENT_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    """
+    Cumulative Prometheus histogram of one label set, bucket counts are kept per bucket and summed on scrape
+    """
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    """
+    Counter, gauge or histogram family, one value (or Histogram) per label values tuple
+    """
+
+    def __init__(self, name: str, kind: str, help_text: str, labels=(), buckets=None):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def set(self, *label_values, value: float):
+        self.values[label_values] = value
+
+    def observe(self, *label_values, value: float):
+        histogram = self.values.get(label_values)
+        if histogram is None:
+            histogram = self.values[label_values] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, value in sorted(self.values.items()):
+            labels = [f'{name}="{escape(label)}"' for name, label in zip(self.labels, label_values)]
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{format_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip((*value.buckets, "+Inf"), value.counts):
+                cumulative += count
+                bucket_labels = format_labels([*labels, f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {value.sum}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {value.count}")
+        return lines
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels: list) -> str:
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+requests_total = Metric("http_requests_total", "counter", "Requests by route and status code",
+                        ("method", "route", "status"))
+request_duration = Metric("http_request_duration_seconds", "histogram", "Request latency by route",
+                          ("method", "route"), LATENCY_BUCKETS)
+requests_in_progress = Metric("http_requests_in_progress", "gauge", "Requests being served", ("method",))
+request_statements = Metric("http_request_db_statements", "histogram", "SQL statements run by one request",
+                            ("method", "route"), STATEMENT_COUNT_BUCKETS)
+request_db_time = Metric("http_request_db_seconds", "histogram", "Time one request spent in SQL statements",
+                         ("method", "route"), LATENCY_BUCKETS)
+statements_total = Metric("db_statements_total", "counter", "SQL statements executed", ("engine",))
+statement_duration = Metric("db_statement_duration_seconds", "histogram", "SQL statement latency", ("engine",),
+                            LATENCY_BUCKETS)
+admission_rejected = Metric("http_requests_rejected_total", "counter",
+                            "Requests shed by admission control (overload) or rate limited (rate_limit)",
+                            ("method", "route", "reason"))
+admission_limit = Metric("http_route_concurrency_limit", "gauge", "Adaptive concurrency limit of the route",
+                         ("route",))
+metrics = [requests_total, request_duration, requests_in_progress, request_statements, request_db_time,
+           statements_total, statement_duration, admission_rejected, admission_limit]
+
+# [statements, seconds] of the request being served, None outside requests
+request_sql = contextvars.ContextVar("request_sql", default=None)
+
+
+# every engine, also the ones created later; the async engine runs its statements through a sync Engine
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """
+    Count and time every statement, also into the current request's totals
+    """
+    elapsed = time.perf_counter() - context._metrics_start
+    name = "async" if conn.dialect.is_async else "sync"
+    statements_total.inc(name)
+    statement_duration.observe(name, value=elapsed)
+    totals = request_sql.get()
+    if totals is not None:
+        totals[0] += 1
+        totals[1] += elapsed
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency, in flight requests and SQL work per route.
+    The route is the matched path template (/api/book/{book_id}), so label values stay bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        method = scope["method"]
+        status_code = 500
+        totals = [0, 0.0]
+        token = request_sql.set(totals)
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        requests_in_progress.inc(method)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            requests_in_progress.inc(method, amount=-1)
+            request_sql.reset(token)
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            requests_total.inc(method, path, str(status_code))
+            request_duration.observe(method, path, value=elapsed)
+            request_statements.observe(method, path, value=totals[0])
+            request_db_time.observe(method, path, value=totals[1])
+
+
+def collect_gauges() -> list:
+    """
+    Pool, cache and availability stream state, read at scrape time
+    """
+    lines = []
+    pool = get_pool_status()
+    for key in ("size", "idle", "checked_out", "overflow"):
+        if key in pool:
+            lines += [f"# TYPE db_pool_{key} gauge", f"db_pool_{key} {pool[key]}"]
+    lines += ["# TYPE db_pool_acquire_timeouts_total counter",
+              f"db_pool_acquire_timeouts_total {pool['stats']['timeouts']}"]
+    caches = get_cache_stats()
+    for key, kind in (("size", "gauge"), ("hits", "counter"), ("misses", "counter")):
+        name = f"cache_{key}" if kind == "gauge" else f"cache_{key}_total"
+        lines.append(f"# TYPE {name} {kind}")
+        lines += [f'{name}{{cache="{cache}"}} {stats[key]}' for cache, stats in sorted(caches.items())]
+    availability = hub.stats()
+    lines += ["# TYPE availability_subscribers gauge", f"availability_subscribers {availability['subscribers']}",
+              "# TYPE availability_watched_books gauge", f"availability_watched_books {availability['books']}"]
+    return lines
+
+
+def render_metrics() -> str:
+    """
+    Every metric in the Prometheus text exposition format
+    """
+    lines = [line for metric in metrics for line in metric.render()]
+    return "\n".join(lines + collect_gauges()) + "\n"
@@ -1,10 +1,11 @@
 import enum
 
-from sqlalchemy import Column, Integer, String, ForeignKey, Date, Boolean, create_engine, Table
+from sqlalchemy import Column, Integer, String, ForeignKey, Date, Boolean, create_engine, Table, Index, DDL, event, \
+    Float, UniqueConstraint, text, func, literal_column
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy import Enum as SQLAlchemyEnum
 
-from settings import engine
+from settings import get_engine
 
 Base = declarative_base()
 
@@ -43,7 +44,10 @@ class User(Base):
 
 association_table = Table('association', Base.metadata,
     Column('category_id', Integer, ForeignKey('categories.id')),
-    Column('book_id', Integer, ForeignKey('books.id'))
+    Column('book_id', Integer, ForeignKey('books.id')),
+    # category listings page by book id; loading the categories of books goes by book id
+    Index('ix_association_category_id_book_id', 'category_id', 'book_id'),
+    Index('ix_association_book_id', 'book_id'),
 )
 
 class Category(Base):
@@ -52,9 +56,14 @@ class Category(Base):
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String)
     description = Column(String)
+    # bumped by every update, source of the category ETags
+    version = Column(Integer, nullable=False, default=1, server_default=text("1"))
 
     books = relationship("Book", secondary=association_table, back_populates="categories")
 
+    # updates and deletes only apply to the version that was read (optimistic concurrency)
+    __mapper_args__ = {"version_id_col": version, "version_id_generator": False}
+
 
 class Book(Base):
     """
@@ -67,12 +76,21 @@ class Book(Base):
     description = Column(String)
     author = Column(String)
     count = Column(Integer)
+    # bumped by every update including borrow/return, source of the book ETags
+    version = Column(Integer, nullable=False, default=1, server_default=text("1"))
 
     # Relationship with UserBookHistory model
     user_history = relationship("UserBookHistory", back_populates="book")
     categories = relationship("Category", secondary=association_table, back_populates="books")
     user_ratings = relationship("UserBookRating", back_populates="book")
 
+    __table_args__ = (
+        # keyset pagination ordered by title, NULL titles sort as empty ones (api/book/utils.BOOK_TITLE_KEY)
+        Index("ix_books_title_id", func.coalesce(title, literal_column("''")), id),
+    )
+    # updates and deletes only apply to the version that was read (optimistic concurrency)
+    __mapper_args__ = {"version_id_col": version, "version_id_generator": False}
+
 
 
 class UserBookHistory(Base):
@@ -80,11 +98,22 @@ class UserBookHistory(Base):
     UserBookHistory model representing the 'user_book_history' table in the database
     """
     __tablename__ = "user_book_history"
+    __table_args__ = (
+        # history listings are newest first (id descending) within a reader, a book or a date range
+        Index("ix_user_book_history_user_id_id", "user_id", "id"),
+        Index("ix_user_book_history_book_id_id", "book_id", "id"),
+        Index("ix_user_book_history_borrowed_date_id", "borrowed_date", "id"),
+        Index("ix_user_book_history_returned_date_id", "returned_date", "id"),
+        # open loans only, a small fraction of the table: borrowed checks, returns and "my books"
+        Index("ix_user_book_history_open_loans", "user_id", "book_id",
+              postgresql_where=text("returned_date IS NULL"), sqlite_where=text("returned_date IS NULL")),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     book_id = Column(Integer, ForeignKey("books.id"))
-    borrowed_date = Column(Date)
+    # partition key of the table on Postgres (monthly ranges, see HISTORY_PARTITION_FORMAT)
+    borrowed_date = Column(Date, nullable=False)
     returned_date = Column(Date)
     action = Column(SQLAlchemyEnum(ActionType, name="action_type"))
 
@@ -92,6 +121,32 @@ class UserBookHistory(Base):
     user = relationship("User", back_populates="book_history")
     book = relationship("Book", back_populates="user_history")
 
+
+class UserBookHistoryArchive(Base):
+    """
+    UserBookHistoryArchive model representing the 'user_book_history_archive' table in the database,
+    closed loans moved out of user_book_history by api/book/archive_history.py
+    """
+    __tablename__ = "user_book_history_archive"
+    __table_args__ = (
+        Index("ix_user_book_history_archive_user_id_id", "user_id", "id"),
+        Index("ix_user_book_history_archive_book_id_id", "book_id", "id"),
+        Index("ix_user_book_history_archive_borrowed_date_id", "borrowed_date", "id"),
+    )
+
+    # ids are kept from user_book_history, no foreign keys so archived rows never block deletes
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer)
+    book_id = Column(Integer)
+    borrowed_date = Column(Date, nullable=False)
+    returned_date = Column(Date)
+    action = Column(SQLAlchemyEnum(ActionType, name="action_type"))
+
+
+# monthly partitions of user_book_history and user_book_history_archive on Postgres are named
+# <table>_y<year>m<month>, e.g. user_book_history_y2024m01 holds loans borrowed in January 2024
+HISTORY_PARTITION_FORMAT = "{table}_y{year:04d}m{month:02d}"
+
 class UserBookRating(Base):
     """
     UserBookRating model representing the 'user_book_rating' table in the database
@@ -108,7 +163,94 @@ class UserBookRating(Base):
     user = relationship("User", back_populates="book_ratings")
     book = relationship("Book", back_populates="user_ratings")
 
+    __table_args__ = (
+        # one rating per user and book, rating again updates it
+        UniqueConstraint("user_id", "book_id", name="uq_user_book_rating_user_book"),
+    )
+
+
+class BookRatingSummary(Base):
+    """
+    BookRatingSummary model representing the 'book_rating_summary' table in the database,
+    per book rating aggregates maintained on every rating insert/change
+    """
+    __tablename__ = "book_rating_summary"
+
+    book_id = Column(Integer, ForeignKey("books.id", ondelete="CASCADE"), primary_key=True)
+    rating_sum = Column(Integer, nullable=False, default=0)
+    rating_count = Column(Integer, nullable=False, default=0)
+    rating_avg = Column(Float, nullable=False, default=0)
+    # histogram of 1-5 star ratings
+    stars_1 = Column(Integer, nullable=False, default=0)
+    stars_2 = Column(Integer, nullable=False, default=0)
+    stars_3 = Column(Integer, nullable=False, default=0)
+    stars_4 = Column(Integer, nullable=False, default=0)
+    stars_5 = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        # top rated listing, scanned backwards
+        Index("ix_book_rating_summary_avg_book", "rating_avg", "book_id"),
+    )
+
+
+# Full text search on books, kept in sync by the database itself.
+# Postgres: weighted tsvector generated column + GIN, trigram GIN indexes for fuzzy/ILIKE matching
+# (alembic revision 3f1d2c9a7b64). SQLite: external content FTS5 tables maintained by triggers, a word index and a
+# trigram index of titles and authors for fuzzy matching.
+BOOK_SEARCH_DDL = {
+    "postgresql": [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "ALTER TABLE books ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ("
+        "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+        "setweight(to_tsvector('simple', coalesce(author, '')), 'B') || "
+        "setweight(to_tsvector('simple', coalesce(description, '')), 'C')) STORED",
+        "CREATE INDEX IF NOT EXISTS ix_books_search_vector ON books USING gin (search_vector)",
+        "CREATE INDEX IF NOT EXISTS ix_books_title_trgm ON books USING gin (title gin_trgm_ops)",
+        "CREATE INDEX IF NOT EXISTS ix_books_author_trgm ON books USING gin (author gin_trgm_ops)",
+    ],
+    "sqlite": [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5("
+        "title, author, description, content='books', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        "CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN "
+        "INSERT INTO books_fts(rowid, title, author, description) "
+        "VALUES (new.id, new.title, new.author, new.description); END",
+        "CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN "
+        "INSERT INTO books_fts(books_fts, rowid, title, author, description) "
+        "VALUES ('delete', old.id, old.title, old.author, old.description); END",
+        # only when indexed columns change, borrows and returns update count and version on the hot path
+        "CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author, description ON books BEGIN "
+        "INSERT INTO books_fts(books_fts, rowid, title, author, description) "
+        "VALUES ('delete', old.id, old.title, old.author, old.description); "
+        "INSERT INTO books_fts(rowid, title, author, description) "
+        "VALUES (new.id, new.title, new.author, new.description); END",
+        # trigram index of titles and authors for fuzzy search
+        # (alembic revision 8d2f6a1c4e90 creates both indexes on older databases)
+        "CREATE VIRTUAL TABLE IF NOT EXISTS books_trgm USING fts5("
+        "title, author, content='books', content_rowid='id', tokenize='trigram')",
+        "CREATE TRIGGER IF NOT EXISTS books_trgm_insert AFTER INSERT ON books BEGIN "
+        "INSERT INTO books_trgm(rowid, title, author) VALUES (new.id, new.title, new.author); END",
+        "CREATE TRIGGER IF NOT EXISTS books_trgm_delete AFTER DELETE ON books BEGIN "
+        "INSERT INTO books_trgm(books_trgm, rowid, title, author) VALUES ('delete', old.id, old.title, old.author); "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS books_trgm_update AFTER UPDATE OF title, author ON books BEGIN "
+        "INSERT INTO books_trgm(books_trgm, rowid, title, author) VALUES ('delete', old.id, old.title, old.author); "
+        "INSERT INTO books_trgm(rowid, title, author) VALUES (new.id, new.title, new.author); END",
+    ],
+}
+for dialect, statements in BOOK_SEARCH_DDL.items():
+    for statement in statements:
+        event.listen(Book.__table__, "after_create", DDL(statement).execute_if(dialect=dialect))
+
+
+def create_schema(bind=None):
+    """
+    Create the missing tables along with their indexes and search DDL, run once per deployment and not on every
+    import or worker start (python -m models), schema changes go through alembic migrations
+    :param bind: engine or connection, the sync engine of settings by default
+    """
+    Base.metadata.create_all(bind or get_engine())
 
 
-# Create tables in the database
-Base.metadata.create_all(engine)
+if __name__ == "__main__":
+    create_schema()
+    print("Schema created successfully.")
@@ -0,0 +1,202 @@
+import contextlib
+import contextvars
+import logging
+import re
+import time
+from collections import Counter
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from settings import QUERY_PROFILER_EXPLAIN, QUERY_PROFILER_REPEATS, SLOW_QUERY_MS
+
+# Opt-in statement profiler for development and staging (QUERY_PROFILER=1): statements are grouped per request,
+# identical statement shapes repeated within one request (N+1 queries) and slow statements are logged
+
+logger = logging.getLogger(__name__)
+
+EXPLAINABLE = ("select", "with", "insert", "update", "delete")
+
+NUMBER = re.compile(r"\b\d+(\.\d+)?\b")
+STRING = re.compile(r"'(?:[^']|'')*'")
+PLACEHOLDER = r"\s*(\?|\$\d+|%s|%\(\w+\)s|:\w+)\s*"
+PLACEHOLDER_LIST = re.compile(rf"\(({PLACEHOLDER},)*{PLACEHOLDER}\)")
+WHITESPACE = re.compile(r"\s+")
+
+
+def statement_shape(statement: str) -> str:
+    """
+    Statement with literals and the length of IN lists blanked out, the same query for another id has the same shape
+    """
+    shape = PLACEHOLDER_LIST.sub("(?...)", STRING.sub("?", statement))
+    shape = NUMBER.sub("?", shape)
+    return WHITESPACE.sub(" ", shape).strip()
+
+
+class RequestProfile:
+    """
+    Statements run while serving one request (or inside one capture_queries block outside requests)
+    """
+
+    def __init__(self, method: str = "", route: str = ""):
+        self.method = method
+        self.route = route
+        # (statement, parameters, seconds)
+        self.statements = []
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+    @property
+    def seconds(self) -> float:
+        return sum(seconds for _, _, seconds in self.statements)
+
+    def repeated(self, threshold: int = QUERY_PROFILER_REPEATS) -> dict:
+        """
+        :return: statement shape -> times run, for shapes run at least `threshold` times
+        """
+        shapes = Counter(statement_shape(statement) for statement, _, _ in self.statements)
+        return {shape: count for shape, count in shapes.items() if count >= threshold}
+
+    def report(self) -> str:
+        lines = [f"{self.method} {self.route}: {self.count} statements in {self.seconds * 1000:.1f} ms"]
+        lines += [f"  {seconds * 1000:8.2f} ms  {WHITESPACE.sub(' ', statement)}"
+                  for statement, _, seconds in self.statements]
+        return "\n".join(lines)
+
+
+class QueryCapture:
+    """
+    Profiles of the requests served inside a capture_queries block, with assertions for tests
+    """
+
+    def __init__(self):
+        self.profiles = []
+
+    def select(self, route: str = None) -> list:
+        return [profile for profile in self.profiles if route is None or profile.route == route]
+
+    def assert_max_queries(self, limit: int, route: str = None):
+        """
+        :param limit: statements allowed per request
+        :param route: only check requests of this route template (/api/book/{book_id})
+        :raises: AssertionError listing the statements of the first request over the limit
+        """
+        for profile in self.select(route):
+            if profile.count > limit:
+                raise AssertionError(f"expected at most {limit} statements\n{profile.report()}")
+
+    def assert_no_repeats(self, threshold: int = QUERY_PROFILER_REPEATS, route: str = None):
+        """
+        :raises: AssertionError when a request ran the same statement shape `threshold` times or more
+        """
+        for profile in self.select(route):
+            repeated = profile.repeated(threshold)
+            if repeated:
+                shapes = "\n".join(f"  {count}x {shape}" for shape, count in repeated.items())
+                raise AssertionError(f"repeated statements (N+1?)\n{shapes}\n{profile.report()}")
+
+
+current_profile = contextvars.ContextVar("current_profile", default=None)
+# open capture_queries blocks, finished request profiles are added to each
+captures = []
+
+
+@contextlib.contextmanager
+def capture_queries():
+    """
+    Collect the profiles of the requests served inside the block, the app must run with QUERY_PROFILER=1:
+
+        with capture_queries() as captured:
+            client.get("/api/user/book", headers=headers)
+        captured.assert_max_queries(2)
+
+    Statements run directly in the block (outside a request) are collected into one more profile.
+    """
+    install()
+    capture = QueryCapture()
+    direct = RequestProfile(route="<direct>")
+    token = current_profile.set(direct)
+    captures.append(capture)
+    try:
+        yield capture
+    finally:
+        captures.remove(capture)
+        current_profile.reset(token)
+        if direct.statements:
+            capture.profiles.append(direct)
+
+
+def explain(conn, statement: str, parameters) -> str:
+    """
+    Plan of a statement that just ran, on the same connection and transaction through a plain DBAPI cursor
+    (no engine events fire for it)
+    """
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return "\n".join(" ".join(str(column) for column in row) for row in cursor.fetchall())
+    finally:
+        cursor.close()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._profiler_start = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._profiler_start
+    profile = current_profile.get()
+    if profile is not None:
+        profile.statements.append((statement, parameters, elapsed))
+    if elapsed * 1000 < SLOW_QUERY_MS:
+        return
+    plan = "-"
+    if QUERY_PROFILER_EXPLAIN and not executemany and statement.lstrip().lower().startswith(EXPLAINABLE):
+        try:
+            plan = explain(conn, statement, parameters)
+        except Exception as e:
+            plan = f"unavailable: {e}"
+    where = f"{profile.method} {profile.route}".strip() if profile is not None else "outside requests"
+    logger.warning("slow statement (%.1f ms, %s): %s\nparameters: %r\nplan:\n%s",
+                   elapsed * 1000, where, WHITESPACE.sub(" ", statement), parameters, plan)
+
+
+def install():
+    """
+    Listen to the statements of every engine, the async engine runs them through its sync Engine
+    """
+    if not event.contains(Engine, "after_cursor_execute", after_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+
+class QueryProfilerMiddleware:
+    """
+    ASGI middleware giving every request its own profile, logs repeated statement shapes when the request ends
+    """
+
+    def __init__(self, app):
+        self.app = app
+        install()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        profile = RequestProfile(scope["method"], scope["path"])
+        token = current_profile.set(profile)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_profile.reset(token)
+            route = scope.get("route")
+            if route is not None:
+                profile.route = route.path
+            repeated = profile.repeated()
+            if repeated:
+                shapes = "\n".join(f"  {count}x {shape}" for shape, count in repeated.items())
+                logger.warning("repeated statements in %s %s (N+1?):\n%s", profile.method, profile.route, shapes)
+            for capture in captures:
+                capture.profiles.append(profile)
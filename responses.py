@@ -0,0 +1,120 @@
+import asyncio
+from typing import Any, Callable
+
+import orjson
+from fastapi import Response
+from fastapi.responses import ORJSONResponse as BaseORJSONResponse
+from fastapi.routing import APIRoute
+from pydantic import BaseModel, ValidationError
+from pydantic.fields import ModelField, SHAPE_SINGLETON, SHAPE_LIST, SHAPE_SET, SHAPE_TUPLE_ELLIPSIS, SHAPE_SEQUENCE, \
+    SHAPE_ITERABLE
+from pydantic.utils import lenient_issubclass
+
+from settings import RESPONSE_VALIDATION
+
+SEQUENCE_SHAPES = (SHAPE_LIST, SHAPE_SET, SHAPE_TUPLE_ELLIPSIS, SHAPE_SEQUENCE, SHAPE_ITERABLE)
+
+
+def model_fields(value):
+    """
+    orjson default: the field values of a pydantic model, e.g. the validated response
+    """
+    if isinstance(value, BaseModel):
+        return value.__dict__
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def model_fields_without_none(value):
+    """
+    model_fields leaving out the fields that are None (response_model_exclude_none)
+    """
+    return {name: item for name, item in model_fields(value).items() if item is not None}
+
+
+class ORJSONResponse(BaseORJSONResponse):
+    """
+    orjson rendering, also of dicts with int keys (rating histograms) and of pydantic models
+    """
+    default = staticmethod(model_fields)
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class ORJSONResponseWithoutNone(ORJSONResponse):
+    default = staticmethod(model_fields_without_none)
+
+
+def identity(value):
+    return value
+
+
+def field_serializer(field: ModelField, exclude_none: bool = False) -> Callable[[Any], Any]:
+    """
+    Compile a response model field into a function that copies the declared fields of an ORM object or dict
+    into plain data orjson renders natively. Values are not validated here, see ORJSONRoute.
+    """
+    if field.shape in SEQUENCE_SHAPES:
+        item = field_serializer(field.sub_fields[0], exclude_none)
+        return lambda values: [item(value) for value in values]
+    if field.shape != SHAPE_SINGLETON or not lenient_issubclass(field.type_, BaseModel):
+        # scalars, enums, dates and mappings of them
+        return identity
+
+    fields = [(name, field_serializer(sub_field, exclude_none)) for name, sub_field in field.type_.__fields__.items()]
+
+    def serialize(value):
+        if value is None:
+            return None
+        if isinstance(value, BaseModel):
+            value = value.__dict__
+        get = value.get if isinstance(value, dict) else lambda name: getattr(value, name, None)
+        data = {name: serializer(get(name)) for name, serializer in fields}
+        if exclude_none:
+            return {name: item for name, item in data.items() if item is not None}
+        return data
+
+    return serialize
+
+
+class ORJSONRoute(APIRoute):
+    """
+    Route whose response model is applied by a compiled serializer and rendered with orjson, instead of walking
+    the return value with jsonable_encoder. The serialized value is still validated against the response model
+    (unless RESPONSE_VALIDATION is off), a wrong type or a missing field fails the request as it does on a plain
+    route instead of reaching the client; the model also limits the output to its fields (no password hashes or
+    ORM state leak out). orjson renders the validated models as they are, with the values the model coerced.
+
+    The handler is wrapped by rewriting ``dependant.call`` and ``dependant.response_param_name``, FastAPI 0.92
+    internals (see the pin in requirements.txt): check this route when upgrading FastAPI.
+    """
+
+    def get_route_handler(self):
+        if self.response_field is None or not asyncio.iscoroutinefunction(self.endpoint):
+            return super().get_route_handler()
+        call = self.endpoint
+        field = self.response_field
+        serializer = field_serializer(field, self.response_model_exclude_none)
+        status_code = self.status_code
+        response_class = ORJSONResponseWithoutNone if self.response_model_exclude_none else ORJSONResponse
+        # the sub response carries the headers and status code set by the handler
+        own_response_param = self.dependant.response_param_name is None
+        response_param = self.dependant.response_param_name or "_response"
+        self.dependant.response_param_name = response_param
+
+        async def endpoint(**values):
+            sub_response = values.pop(response_param) if own_response_param else values[response_param]
+            content = await call(**values)
+            if isinstance(content, Response):
+                return content
+            data = serializer(content)
+            if RESPONSE_VALIDATION:
+                data, errors = field.validate(data, {}, loc=("response",))
+                if errors:
+                    raise ValidationError(errors if isinstance(errors, list) else [errors], field.type_)
+            response = response_class(data, status_code=sub_response.status_code or status_code or 200)
+            response.headers.raw.extend(sub_response.headers.raw)
+            return response
+
+        self.dependant.call = endpoint
+        return super().get_route_handler()
@@ -1,8 +1,10 @@
-from pydantic import BaseModel
+from typing import Dict, List
+
+from pydantic import BaseModel, conint, conlist, validator
 from pydantic.class_validators import Optional
 from datetime import date
 
-from enums import RatingEnum
+from enums import ActionType, RatingEnum
 
 
 class UserCreate(BaseModel):
@@ -21,8 +23,21 @@ class UserOut(BaseModel):
     id: int
     name: str
     email: str
+    is_active: Optional[bool] = False
+    is_admin: Optional[bool] = False
+
+    class Config:
+        orm_mode = True
 
 
+class UserActivated(BaseModel):
+    """
+    User activation response model schema
+    """
+    Status: str
+    message: str
+    User: UserOut
+
 
 class UserLogin(BaseModel):
     """
@@ -38,6 +53,28 @@ class Token(BaseModel):
     """
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+    expires_in: Optional[int] = None  # seconds the access token is valid
+
+
+class RefreshRequest(BaseModel):
+    """
+    Refresh token request model schema
+    """
+    refresh_token: str
+
+
+class CurrentUser(BaseModel):
+    """
+    Authenticated principal resolved from the access token (cached)
+    """
+    id: int
+    name: Optional[str] = None
+    is_admin: Optional[bool] = False
+    is_active: Optional[bool] = False
+
+    class Config:
+        orm_mode = True
 
 
 class TokenData(BaseModel):
@@ -58,6 +95,22 @@ class BookCreate(BaseModel):
     count: int
     category_id:int
 
+class BookImportRow(BaseModel):
+    """
+    Bulk import row schema (CSV column or NDJSON key per field), category by id or title
+    """
+    title: str
+    description: str = ""
+    author: str
+    count: conint(ge=0)
+    category_id: Optional[int] = None
+    category: Optional[str] = None
+
+    @validator("category_id", "category", pre=True)
+    def empty_as_missing(cls, value):
+        return None if value == "" else value
+
+
 class BookOut(BaseModel):
     """
     Book response model for listing all books schema
@@ -69,6 +122,22 @@ class BookOut(BaseModel):
     count: int
 
 
+class ImportRowError(BaseModel):
+    line: int
+    error: str
+
+
+class ImportReport(BaseModel):
+    """
+    Bulk import response model schema
+    """
+    Status: str
+    message: str
+    imported: int
+    failed: int
+    errors: List[ImportRowError]
+
+
 # Update Book (Admin Only)
 class BookUpdate(BaseModel):
     """
@@ -86,14 +155,37 @@ class UserBookHistorySchema(BaseModel):
     User book history response model schema
     """
     id: int
-    user_id: int
-    book_id: int
-    borrowed_date: date
-    returned_date: date
+    user_id: Optional[int]
+    book_id: Optional[int]
+    borrowed_date: Optional[date]
+    returned_date: Optional[date]
+    action: Optional[ActionType]
 
     class Config:
         orm_mode = True
 
+class BookBatch(BaseModel):
+    """
+    Batch borrow/return request model schema
+    """
+    book_ids: conlist(int, min_items=1, max_items=100)
+
+
+class BookBatchItem(BaseModel):
+    book_id: int
+    status: str
+    count: Optional[int]
+
+
+class BookBatchResult(BaseModel):
+    """
+    Batch borrow/return response model schema, count is the number of copies left on the shelf
+    """
+    Status: str
+    message: str
+    results: List[BookBatchItem]
+
+
 # Category Schemas
 class CategoryBase(BaseModel):
     title: str
@@ -116,6 +208,24 @@ class CategoryUpdate(BaseModel):
     description: Optional[str]
 
 
+class CategoryBookCount(BaseModel):
+    """
+    Number of books in a category response model schema
+    """
+    category_id: int
+    books: int
+
+
+class CategoryCreated(BaseModel):
+    Status: str
+    message: str
+    Category: CategoryRead
+
+
+class Message(BaseModel):
+    message: str
+
+
 # Book Schemas
 class BookBase(BaseModel):
     title: str
@@ -131,11 +241,70 @@ class BookRead(BookBase):
         orm_mode = True
 
 
+class BookDetail(BookRead):
+    categories: List[CategoryRead]
+
+
+class BookCreated(BaseModel):
+    status: str
+    message: str
+    Book: BookRead
+
+
+class BookUpdated(BaseModel):
+    Status: str
+    message: str
+    Book: BookDetail
+
+
+class AllBooks(BaseModel):
+    books: List[BookDetail]
+
+
 # Rating Schema
 class RatingCreate(BaseModel):
     rating: RatingEnum
 
 
+class RatingRead(BaseModel):
+    """
+    Rating response model schema
+    """
+    id: int
+    book_id: int
+    book_name: Optional[str]
+    user_id: int
+    user_name: Optional[str]
+    rating: str
+
+
+class RatingSummary(BaseModel):
+    """
+    Book rating aggregate response model schema
+    """
+    book_id: int
+    average: float
+    count: int
+    histogram: Dict[int, int]
+
+
+class TopRatedBook(BaseModel):
+    """
+    Top rated books response model schema
+    """
+    book: BookRead
+    average: float
+    count: int
+
+
+class RecommendedBook(BaseModel):
+    """
+    "Borrowed together" recommendation response model schema
+    """
+    book: BookRead
+    readers: int
+
+
 # User Activation Schema
 class UserActivate(BaseModel):
     is_active: bool
\ No newline at end of file
@@ -1,7 +1,14 @@
+import contextlib
+import functools
 import os
-from databases import Database
+import time
+
+from fastapi import HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.orm import Session
 from sqlalchemy.orm import sessionmaker
 
@@ -13,41 +20,277 @@ DB_HOST = os.environ.get('DB_HOST')
 DB_PORT = os.environ.get('DB_PORT', "5432")
 
 # Set up the database connection URL using environment variables
-DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-database = Database(DATABASE_URL)
+# (DATABASE_URL may be given directly, e.g. sqlite:///./book_inventory.db for local runs)
+DATABASE_URL = os.environ.get(
+    "DATABASE_URL", f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+)
+
+
+def get_async_database_url(url: str) -> str:
+    """
+    Map a sync database URL onto its asyncio driver
+    postgresql -> asyncpg, sqlite -> aiosqlite
+    """
+    scheme, _, rest = url.partition("://")
+    if "+" in scheme:
+        return url
+    if scheme in ("postgresql", "postgres"):
+        return f"postgresql+asyncpg://{rest}"
+    if scheme == "sqlite":
+        return f"sqlite+aiosqlite://{rest}"
+    return url
+
+
+ASYNC_DATABASE_URL = os.environ.get("ASYNC_DATABASE_URL", get_async_database_url(DATABASE_URL))
+
+# Connection pool sizing (per worker process)
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "0"))  # connections opened at startup
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))  # connections kept open
+DB_POOL_MAX_OVERFLOW = int(os.environ.get("DB_POOL_MAX_OVERFLOW", "10"))  # extra connections under burst
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))  # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", "1800"))  # seconds before a connection is replaced
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes")
+
+
+def get_pool_options(url: str) -> dict:
+    """
+    Pool keyword arguments for create_engine, sqlite uses a non queue pool and takes none
+    """
+    if url.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_POOL_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+
+# Engines are created on first use: importing settings, models or main neither loads a database driver nor
+# connects, so workers, alembic commands and scripts start without touching the database
+@functools.lru_cache(maxsize=None)
+def get_engine() -> Engine:
+    """
+    SQLAlchemy engine for sync database operations (scripts, maintenance commands)
+    """
+    return create_engine(DATABASE_URL, **get_pool_options(DATABASE_URL))
+
+
+@functools.lru_cache(maxsize=None)
+def get_async_engine() -> AsyncEngine:
+    """
+    Async engine used by the API endpoints, its pool is the application pool
+    """
+    return create_async_engine(ASYNC_DATABASE_URL, **get_pool_options(ASYNC_DATABASE_URL))
+
+
+class LazySessionmaker:
+    """
+    sessionmaker bound to its engine when the first session is made
+    """
+
+    def __init__(self, get_bind, **options):
+        self.get_bind = get_bind
+        self.options = options
+        self.factory = None
+
+    def __call__(self, **options):
+        if self.factory is None:
+            self.factory = sessionmaker(self.get_bind(), **self.options)
+        return self.factory(**options)
 
-# Create a SQLAlchemy engine for database operations
-engine = create_engine(DATABASE_URL)
 
 # Create a SessionLocal class for getting a database session
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = LazySessionmaker(get_engine, autocommit=False, autoflush=False)
+
+class TimedSession(Session):
+    """
+    Session recording in pool_stats how long each of its connections took to check out of the pool, whether it
+    connects up front (get_async_db) or with its first query (get_lazy_async_db)
+    """
+
+    def get_bind(self, *args, **kwargs):
+        # called right before a connection is checked out for the session's next transaction
+        if not self.in_transaction():
+            self.info.setdefault("checkout_started", time.perf_counter())
+        return super().get_bind(*args, **kwargs)
+
+
+@event.listens_for(TimedSession, "after_begin")
+def record_checkout(session, transaction, connection):
+    started = session.info.pop("checkout_started", None)
+    if started is not None:
+        pool_stats.record(time.perf_counter() - started)
+
+
+# Async session factory used by the API endpoints
+AsyncSessionLocal = LazySessionmaker(get_async_engine, class_=AsyncSession, sync_session_class=TimedSession,
+                                     autocommit=False, autoflush=False, expire_on_commit=False)
+
+
+def __getattr__(name: str):
+    # settings.engine and settings.async_engine, created when first asked for
+    if name == "engine":
+        return get_engine()
+    if name == "async_engine":
+        return get_async_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 # Authentication Scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/token")
 SECRET_KEY = os.environ.get("SECRET_KEY")
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# access tokens carry the user's claims and are short lived, refresh tokens re-read the user when exchanged
+ACCESS_TOKEN_EXPIRE_MINUTES = float(os.environ.get("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
+REFRESH_TOKEN_EXPIRE_DAYS = float(os.environ.get("REFRESH_TOKEN_EXPIRE_DAYS", "7"))
 
+# Password hashing, bcrypt runs on a bounded thread pool off the event loop
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))  # stored hashes with other costs are rehashed on login
+PASSWORD_HASH_CONCURRENCY = int(os.environ.get("PASSWORD_HASH_CONCURRENCY", str(os.cpu_count() or 1)))
+PASSWORD_HASH_QUEUE_TIMEOUT = float(os.environ.get("PASSWORD_HASH_QUEUE_TIMEOUT", "5"))  # seconds
 
+# Cache Configuration, the Redis tier is optional and shared between workers
+REDIS_URL = os.environ.get("REDIS_URL")
+PRINCIPAL_CACHE_SIZE = int(os.environ.get("PRINCIPAL_CACHE_SIZE", "10000"))
+PRINCIPAL_CACHE_TTL = float(os.environ.get("PRINCIPAL_CACHE_TTL", "30"))  # bounds staleness across workers
+PRINCIPAL_CACHE_REDIS_TTL = float(os.environ.get("PRINCIPAL_CACHE_REDIS_TTL", "300"))
+CATALOG_CACHE_SIZE = int(os.environ.get("CATALOG_CACHE_SIZE", "50000"))  # books, categories and category listings
+CATALOG_CACHE_TTL = float(os.environ.get("CATALOG_CACHE_TTL", "60"))  # writes invalidate, the TTL is a backstop
+CATALOG_CACHE_REDIS_TTL = float(os.environ.get("CATALOG_CACHE_REDIS_TTL", "3600"))
+
+# Responses are validated against the route's response model, false skips it to save its CPU cost
+RESPONSE_VALIDATION = os.environ.get("RESPONSE_VALIDATION", "true").lower() in ("1", "true", "yes")
+
+# Metrics, /metrics requires "Authorization: Bearer <METRICS_TOKEN>" when set
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+# Admission control (per worker): each route admits up to an adaptive number of concurrent requests, the limit
+# backs off when the route's recent latency exceeds its long term latency by ADMISSION_LATENCY_TOLERANCE
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "true").lower() in ("1", "true", "yes")
+ADMISSION_INITIAL_LIMIT = int(os.environ.get("ADMISSION_INITIAL_LIMIT", "50"))
+ADMISSION_MIN_LIMIT = int(os.environ.get("ADMISSION_MIN_LIMIT", "4"))
+ADMISSION_MAX_LIMIT = int(os.environ.get("ADMISSION_MAX_LIMIT", "500"))
+ADMISSION_LATENCY_TOLERANCE = float(os.environ.get("ADMISSION_LATENCY_TOLERANCE", "2"))
+# token buckets per user and client address, "route=requests per second/burst" comma separated, empty disables them
+RATE_LIMITS = os.environ.get("RATE_LIMITS", "/api/all-books=1/5,/api/search-books=5/20,/api/history/=2/10")
+
+# "Borrowed together" recommendations, an in memory index per worker refreshed from the loan history
+RECOMMENDATIONS_REFRESH_SECONDS = float(os.environ.get("RECOMMENDATIONS_REFRESH_SECONDS", "30"))
+RECOMMENDATIONS_READER_BOOKS = int(os.environ.get("RECOMMENDATIONS_READER_BOOKS", "100"))  # most recent per reader
+
+# Query profiler for development and staging, groups statements per request, flags N+1s and slow statements
+QUERY_PROFILER = os.environ.get("QUERY_PROFILER", "false").lower() in ("1", "true", "yes")
+QUERY_PROFILER_REPEATS = int(os.environ.get("QUERY_PROFILER_REPEATS", "3"))  # same statement shape in one request
+QUERY_PROFILER_EXPLAIN = os.environ.get("QUERY_PROFILER_EXPLAIN", "true").lower() in ("1", "true", "yes")
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "100"))
+
+
+@contextlib.contextmanager
 def get_db() -> Session:
     """
-    Dependency function to get a database session.
+    Database session for scripts and maintenance commands, closed when the block ends:
+
+        with get_db() as db:
+            ...
     """
     db = SessionLocal()
     try:
-        return db
+        yield db
     finally:
         db.close()
 
 
-# Dependency: Get Database Connection
-async def get_database():
+class PoolStats:
     """
-    Dependency function to get a database connection.
+    Connection acquire statistics of this worker's pool
     """
-    # Connect to the database
-    await database.connect()
-    try:
-        yield database
-    finally:
-        await database.disconnect()
+
+    def __init__(self):
+        self.acquired = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, wait: float):
+        self.acquired += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def as_dict(self) -> dict:
+        return {
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "wait_avg_ms": round(self.wait_total / self.acquired * 1000, 3) if self.acquired else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 3),
+        }
+
+
+pool_stats = PoolStats()
+
+
+def get_pool_status() -> dict:
+    """
+    Current state of the async engine's pool along with its configuration and acquire stats
+    """
+    pool = get_async_engine().pool
+    pool_status = {"pool": type(pool).__name__}
+    for key, method in (("size", "size"), ("idle", "checkedin"), ("checked_out", "checkedout"),
+                        ("overflow", "overflow")):
+        if hasattr(pool, method):
+            pool_status[key] = getattr(pool, method)()
+    pool_status["config"] = {
+        "min_size": DB_POOL_MIN_SIZE,
+        **{key.replace("pool_", ""): value for key, value in get_pool_options(ASYNC_DATABASE_URL).items()},
+    }
+    pool_status["stats"] = pool_stats.as_dict()
+    return pool_status
+
+
+async def open_pool():
+    """
+    Startup hook: warm up DB_POOL_MIN_SIZE connections so the first requests skip the connect cost
+    """
+    connections = [await get_async_engine().connect() for _ in range(min(DB_POOL_MIN_SIZE, DB_POOL_SIZE))]
+    for connection in connections:
+        await connection.close()
+
+
+async def close_pool():
+    """
+    Shutdown hook: close every pooled connection
+    """
+    if get_async_engine.cache_info().currsize:
+        await get_async_engine().dispose()
+
+
+async def get_async_db() -> AsyncSession:
+    """
+    Dependency function to get an async database session.
+    The connection is checked out of the application pool up front, a saturated pool answers 503 before the
+    endpoint runs.
+    """
+    async with AsyncSessionLocal() as db:
+        try:
+            await db.connection()
+        except PoolTimeoutError:
+            pool_stats.timeouts += 1
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Database is busy, please try again")
+        yield db
+
+
+async def get_lazy_async_db() -> AsyncSession:
+    """
+    Dependency function to get an async database session that checks a connection out only once it runs a
+    query, for code served from a cache most of the time.
+    """
+    async with AsyncSessionLocal() as db:
+        try:
+            yield db
+        except PoolTimeoutError:
+            pool_stats.timeouts += 1
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Database is busy, please try again")
+
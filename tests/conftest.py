@@ -0,0 +1,61 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+from fastapi.testclient import TestClient
+
+# settings are read at import time, point them at a throwaway SQLite database before any module of the app loads
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/test.db")
+os.environ.setdefault("SECRET_KEY", "test")
+os.environ.setdefault("ADMISSION_CONTROL", "false")
+# the cheapest bcrypt cost, hashes of any other cost are upgraded on login
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+# statement counts per request, see test_query_counts
+os.environ.setdefault("QUERY_PROFILER", "true")
+os.environ.pop("REDIS_URL", None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def app():
+    import main
+    import models
+
+    models.create_schema()
+    return main.create_app()
+
+
+@pytest.fixture(scope="session")
+def client(app):
+    with TestClient(app) as client:
+        yield client
+
+
+def make_user(name: str, is_admin: bool = False) -> dict:
+    """
+    :return: Authorization header of a new active user
+    """
+    from api.account.utils import issue_tokens
+    from models import User
+    from settings import SessionLocal
+
+    db = SessionLocal()
+    user = User(name=name, email=f"{name}@example.com", password="-", is_admin=is_admin, is_active=True)
+    db.add(user)
+    db.commit()
+    db.refresh(user)
+    db.close()
+    return {"Authorization": f"Bearer {asyncio.run(issue_tokens(user))['access_token']}"}
+
+
+@pytest.fixture(scope="session")
+def admin(client) -> dict:
+    return make_user("admin", is_admin=True)
+
+
+@pytest.fixture(scope="session")
+def reader(client) -> dict:
+    return make_user("reader")
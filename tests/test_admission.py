@@ -0,0 +1,129 @@
+import time
+from types import SimpleNamespace
+
+import jwt
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import admission
+from admission import AdaptiveLimit, AdmissionMiddleware
+from settings import ADMISSION_INITIAL_LIMIT, ADMISSION_MIN_LIMIT, SECRET_KEY, ALGORITHM
+
+
+class Clock:
+    """
+    time.monotonic stand-in moved by the test
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    # only the admission module's clock, the event loop keeps the real one
+    monkeypatch.setattr(admission, "time", SimpleNamespace(monotonic=clock, perf_counter=time.perf_counter))
+    return clock
+
+
+def serve(limit: AdaptiveLimit, latency: float, failed: bool = False):
+    assert limit.acquire()
+    limit.release(latency, failed)
+
+
+def test_limit_shrinks_once_per_round_trip_when_latency_rises(clock):
+    limit = AdaptiveLimit()
+    for _ in range(20):
+        serve(limit, 0.01)
+    assert limit.limit == ADMISSION_INITIAL_LIMIT
+
+    for _ in range(20):
+        serve(limit, 0.5)
+    # all in the same instant: one decrease
+    assert limit.limit == pytest.approx(ADMISSION_INITIAL_LIMIT * admission.BACKOFF)
+    clock.now += 1
+    serve(limit, 0.5)
+    assert limit.limit == pytest.approx(ADMISSION_INITIAL_LIMIT * admission.BACKOFF ** 2)
+
+
+def test_limit_shrinks_on_errors_down_to_the_minimum(clock):
+    limit = AdaptiveLimit()
+    for _ in range(100):
+        serve(limit, 0.01, failed=True)
+        clock.now += 1
+    assert limit.limit == ADMISSION_MIN_LIMIT
+
+
+def test_limit_grows_only_while_in_use(clock):
+    limit = AdaptiveLimit()
+    for _ in range(200):
+        serve(limit, 0.01)
+    # one request at a time never needs more
+    assert limit.limit == ADMISSION_INITIAL_LIMIT
+
+    busy = [limit.acquire() for _ in range(ADMISSION_INITIAL_LIMIT - 1)]
+    assert all(busy)
+    for _ in range(200):
+        serve(limit, 0.01)
+    assert limit.limit > ADMISSION_INITIAL_LIMIT + 3
+
+
+def test_limit_refuses_requests_over_it():
+    limit = AdaptiveLimit()
+    assert all(limit.acquire() for _ in range(ADMISSION_INITIAL_LIMIT))
+    assert not limit.acquire()
+    limit.release(0.01, False)
+    assert limit.acquire()
+
+
+def bearer(user_id: int) -> dict:
+    return {"Authorization": f"Bearer {jwt.encode({'sub': user_id}, SECRET_KEY, algorithm=ALGORITHM)}"}
+
+
+def limited_app(monkeypatch, rate_limits: str) -> FastAPI:
+    monkeypatch.setattr(admission, "RATE_LIMITS", rate_limits)
+    app = FastAPI()
+
+    @app.get("/limited")
+    async def limited():
+        return {"ok": True}
+
+    app.add_middleware(AdmissionMiddleware, routes=app.routes)
+    return app
+
+
+def test_rate_limit_answers_429_with_retry_after(monkeypatch, clock):
+    client = TestClient(limited_app(monkeypatch, "/limited=0.5/2"))
+    assert [client.get("/limited", headers=bearer(1)).status_code for _ in range(2)] == [200, 200]
+    response = client.get("/limited", headers=bearer(1))
+    assert response.status_code == 429
+    # one token every 2 seconds
+    assert response.headers["Retry-After"] == "2"
+    assert response.json() == {"detail": "Too many requests, please slow down"}
+
+    # another user has a bucket of their own
+    assert client.get("/limited", headers=bearer(2)).status_code == 200
+    clock.now += 2
+    assert client.get("/limited", headers=bearer(1)).status_code == 200
+    assert client.get("/limited", headers=bearer(1)).status_code == 429
+
+
+def test_clients_sharing_a_token_have_their_own_buckets(monkeypatch, clock):
+    middleware = AdmissionMiddleware(None, [])
+    middleware.rate_limits = {"/limited": (1.0, 1.0)}
+    token = [(b"authorization", bearer(1)["Authorization"].encode())]
+
+    def take(address, headers=token):
+        return middleware.take_token("/limited", {"headers": headers, "client": (address, 5000)})
+
+    assert take("10.0.0.1") == 0
+    assert take("10.0.0.1") == pytest.approx(1.0)
+    assert take("10.0.0.2") == 0
+    # without a valid token, the address alone
+    assert take("10.0.0.3", headers=[(b"authorization", b"Bearer invalid")]) == 0
+    assert take("10.0.0.3", headers=[]) == pytest.approx(1.0)
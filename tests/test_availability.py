@@ -0,0 +1,134 @@
+import asyncio
+import json
+
+import httpx
+
+from api.book.availability import hub
+from conftest import make_user
+
+
+def new_book(title: str, count: int):
+    """
+    :return: (id, version) of a new book
+    """
+    from models import Book
+    from settings import SessionLocal
+
+    db = SessionLocal()
+    book = Book(title=title, description="-", author="-", count=count)
+    db.add(book)
+    db.commit()
+    created = book.id, book.version
+    db.close()
+    return created
+
+
+class Stream:
+    """
+    GET /api/books/availability served by the ASGI app, the events are collected as they are sent
+    """
+
+    def __init__(self, app, headers: dict, book_ids, last_event_id: str = None):
+        raw_headers = [(name.lower().encode(), value.encode()) for name, value in headers.items()]
+        if last_event_id is not None:
+            raw_headers.append((b"last-event-id", last_event_id.encode()))
+        self.scope = {"type": "http", "method": "GET", "path": "/api/books/availability",
+                      "raw_path": b"/api/books/availability", "root_path": "", "scheme": "http",
+                      "query_string": "&".join(f"book_ids={book_id}" for book_id in book_ids).encode(),
+                      "headers": raw_headers, "client": ("127.0.0.1", 5000), "server": ("test", 80),
+                      "http_version": "1.1", "asgi": {"version": "3.0"}}
+        self.app = app
+        self.body = ""
+        self.status = None
+        self.closed = asyncio.Event()
+
+    async def receive(self):
+        await self.closed.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            self.status = message["status"]
+        elif message["type"] == "http.response.body":
+            self.body += message.get("body", b"").decode()
+
+    async def __aenter__(self):
+        self.task = asyncio.ensure_future(self.app(self.scope, self.receive, self.send))
+        await self.wait_for(lambda: "retry:" in self.body)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.closed.set()
+        await asyncio.wait_for(self.task, 2)
+
+    async def wait_for(self, condition, timeout: float = 2.0):
+        for _ in range(int(timeout / 0.01)):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        raise AssertionError(f"not seen in {self.body!r}")
+
+    def events(self) -> list:
+        """
+        :return: (id, data) of the events so far
+        """
+        events = []
+        for block in self.body.split("\n\n"):
+            fields = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line)
+            if fields.get("event") == "availability":
+                events.append((fields["id"], json.loads(fields["data"])))
+        return events
+
+
+def test_dispatch_drops_older_versions():
+    subscriber = hub.subscribe([1])
+    try:
+        hub.dispatch({1: (3, 5)})
+        hub.dispatch({1: (4, 4)})
+        assert subscriber.pending == {1: (3, 5)}
+        hub.dispatch({1: (None, 6)})
+        assert subscriber.pending == {1: (None, 6)}
+    finally:
+        hub.unsubscribe(subscriber)
+
+
+def test_stream_pushes_newer_changes_and_resumes(app, client):
+    headers = make_user("streamer")
+    book_id, version = new_book("Streamed", 2)
+    other_id, other_version = new_book("Streamed too", 1)
+
+    async def scenario():
+        http = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test", headers=headers)
+        async with Stream(app, headers, [book_id, other_id]) as stream:
+            assert stream.status == 200
+            await stream.wait_for(lambda: len(stream.events()) == 2)
+            assert [data for _, data in stream.events()] == [
+                {"book_id": book_id, "count": 2, "available": True, "version": version},
+                {"book_id": other_id, "count": 1, "available": True, "version": other_version},
+            ]
+            assert (await http.post(f"/api/book/{book_id}/borrow")).status_code == 200
+            await stream.wait_for(lambda: len(stream.events()) == 3)
+            assert stream.events()[-1][1] == {"book_id": book_id, "count": 1, "available": True,
+                                              "version": version + 1}
+            # published late by a concurrent request: older than the change sent
+            hub.dispatch({book_id: (2, version)})
+            await asyncio.sleep(0.05)
+            assert len(stream.events()) == 3
+            token = stream.events()[-1][0]
+        assert token == f"{book_id}:1:{version + 1},{other_id}:1:{other_version}"
+
+        # changed while the client was away
+        assert (await http.post(f"/api/book/{book_id}/return")).status_code == 200
+        async with Stream(app, headers, [book_id, other_id], last_event_id=token) as stream:
+            await stream.wait_for(lambda: stream.events())
+            await asyncio.sleep(0.05)
+            assert [data for _, data in stream.events()] == [
+                {"book_id": book_id, "count": 2, "available": True, "version": version + 2}]
+            token = stream.events()[-1][0]
+        async with Stream(app, headers, [book_id, other_id], last_event_id=token) as stream:
+            await asyncio.sleep(0.05)
+            assert stream.events() == []
+        await http.aclose()
+
+    asyncio.run(scenario())
+    assert hub.stats() == {"subscribers": 0, "books": 0}
@@ -0,0 +1,26 @@
+from sqlalchemy import select
+
+from api.book.utils import book_keyset, book_cursor
+from models import Book
+from settings import SessionLocal
+
+
+def test_title_keyset_pages_through_null_titles(client):
+    db = SessionLocal()
+    db.query(Book).delete()
+    db.add_all([Book(title=title, description="-", author="-", count=1) for title in (None, "b", None, "a", "c")])
+    db.commit()
+
+    seen, cursor = [], None
+    for _ in range(5):
+        page = db.execute(book_keyset(select(Book), "title", cursor).limit(2)).scalars().all()
+        seen += [(book.title, book.id) for book in page]
+        if len(page) < 2:
+            break
+        cursor = book_cursor(page[-1], "title")
+    # books without a title are not valid responses, leave none for the other tests
+    db.query(Book).delete()
+    db.commit()
+    db.close()
+    assert [title for title, _ in seen] == [None, None, "a", "b", "c"]
+    assert len(set(seen)) == 5
@@ -0,0 +1,132 @@
+import asyncio
+
+import fakeredis
+import pytest
+
+import cache
+from cache import MISSING, TieredCache, listen_for_invalidations
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture(autouse=True)
+def unregister_caches():
+    yield
+    for name in [name for name in cache.caches if name.startswith("test_")]:
+        del cache.caches[name]
+
+
+def make_redis(server):
+    return fakeredis.aioredis.FakeRedis(server=server)
+
+
+def test_delete_evicts_local_tier_of_other_workers(server):
+    async def scenario():
+        # two workers sharing Redis, the listener of the second one runs here
+        first = TieredCache("test_shared", redis=make_redis(server))
+        second = TieredCache("test_shared", redis=make_redis(server))
+        listener = asyncio.create_task(listen_for_invalidations(make_redis(server)))
+        await asyncio.sleep(0.05)
+        await first.set("book:1", {"count": 1})
+        assert await second.get("book:1") == {"count": 1}
+        assert second.local.get("book:1") == {"count": 1}
+
+        await first.delete("book:1")
+        for _ in range(50):
+            if second.local.get("book:1") is MISSING:
+                break
+            await asyncio.sleep(0.01)
+        listener.cancel()
+        assert second.local.get("book:1") is MISSING
+        assert await second.get("book:1") is MISSING
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_misses_run_the_loader_once(server):
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"count": 3}
+
+    async def scenario():
+        tiered = TieredCache("test_stampede", redis=make_redis(server))
+        values = await asyncio.gather(*(tiered.get_or_load("book:1", loader) for _ in range(20)))
+        return tiered, values
+
+    tiered, values = asyncio.run(scenario())
+    assert values == [{"count": 3}] * 20
+    assert len(calls) == 1
+    assert tiered.stats()["coalesced"] == 19
+
+
+def test_redis_outage_falls_back_to_the_local_tier(server):
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        return {"count": 2}
+
+    async def scenario():
+        tiered = TieredCache("test_outage", redis=make_redis(server))
+        server.connected = False
+        first = await tiered.get_or_load("book:1", loader)
+        second = await tiered.get_or_load("book:1", loader)
+        await tiered.delete("book:1")
+        third = await tiered.get_or_load("book:1", loader)
+        return first, second, third
+
+    assert asyncio.run(scenario()) == ({"count": 2},) * 3
+    # served from the local tier in between, reloaded after the delete
+    assert len(calls) == 2
+
+
+def test_load_racing_a_delete_of_its_key_is_not_stored():
+    async def scenario():
+        tiered = TieredCache("test_race")
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def loader():
+            started.set()
+            await release.wait()
+            return {"count": 1}
+
+        async def race(deleted_key):
+            load = asyncio.create_task(tiered.get_or_load("book:1", loader))
+            await started.wait()
+            await tiered.delete(deleted_key)
+            release.set()
+            value = await load
+            started.clear()
+            release.clear()
+            return value
+
+        # a write to another key leaves the load alone, one to the key itself means the value may be stale
+        assert await race("book:2") == {"count": 1}
+        assert tiered.local.get("book:1") == {"count": 1}
+        await tiered.delete("book:1")
+        assert await race("book:1") == {"count": 1}
+        assert tiered.local.get("book:1") is MISSING
+
+    asyncio.run(scenario())
+
+
+def test_get_books_does_not_store_a_book_invalidated_while_loading(monkeypatch):
+    from api.book import catalog
+
+    async def load_books(db, book_ids):
+        # book 1 is updated and invalidated while its row is in flight
+        await catalog.invalidate_books([1])
+        return {book_id: {"id": book_id} for book_id in book_ids}
+
+    monkeypatch.setattr(catalog, "load_books", load_books)
+    catalog.catalog_cache.local.clear()
+    books = asyncio.run(catalog.get_books(None, [1, 2]))
+    assert set(books) == {1, 2}
+    assert catalog.catalog_cache.local.get(catalog.book_key(1)) is MISSING
+    assert catalog.catalog_cache.local.get(catalog.book_key(2)) == {"id": 2}
@@ -0,0 +1,98 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import make_user
+
+
+def new_book(title: str, count: int) -> int:
+    from models import Book
+    from settings import SessionLocal
+
+    db = SessionLocal()
+    book = Book(title=title, description="-", author="-", count=count)
+    db.add(book)
+    db.commit()
+    book_id = book.id
+    db.close()
+    return book_id
+
+
+def stored(book_id: int):
+    """
+    :return: (count, version) of the book as stored
+    """
+    from models import Book
+    from settings import SessionLocal
+
+    db = SessionLocal()
+    book = db.get(Book, book_id)
+    db.close()
+    return book.count, book.version
+
+
+def test_concurrent_borrows_never_oversell(client):
+    copies, readers = 5, 12
+    book_id = new_book("Scarce", copies)
+    version = stored(book_id)[1]
+    headers = [make_user(f"borrower{i}") for i in range(readers)]
+
+    with ThreadPoolExecutor(max_workers=readers) as pool:
+        statuses = list(pool.map(lambda h: client.post(f"/api/book/{book_id}/borrow", headers=h).status_code, headers))
+    assert sorted(statuses) == [200] * copies + [400] * (readers - copies)
+    assert stored(book_id) == (0, version + copies)
+    assert client.post("/api/book/999999/borrow", headers=headers[0]).status_code == 404
+
+
+def test_a_loan_is_returned_once(client):
+    book_id = new_book("Returned", 2)
+    headers = make_user("returner")
+    assert client.post(f"/api/book/{book_id}/borrow", headers=headers).status_code == 200
+    count, version = stored(book_id)
+    assert count == 1
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        statuses = list(pool.map(lambda _: client.post(f"/api/book/{book_id}/return", headers=headers).status_code,
+                                 range(4)))
+    assert sorted(statuses) == [200, 400, 400, 400]
+    count, version = stored(book_id)[0], version + 1
+    assert stored(book_id) == (2, version)
+    response = client.post(f"/api/book/{book_id}/return", headers=headers)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Book is not borrowed by the user"
+    assert stored(book_id) == (count, version)
+
+
+def test_batch_borrow_and_return(client):
+    available, exhausted = new_book("Batch available", 3), new_book("Batch exhausted", 0)
+    headers = make_user("batcher")
+
+    response = client.post("/api/books/borrow", headers=headers, json={"book_ids": [available, exhausted, 999999]})
+    assert response.status_code == 200
+    assert response.json()["message"] == "1 of 3 books borrowed"
+    assert response.json()["results"] == [
+        {"book_id": available, "status": "borrowed", "count": 2},
+        {"book_id": exhausted, "status": "unavailable"},
+        {"book_id": 999999, "status": "not_found"},
+    ]
+    assert stored(available)[0] == 2
+    assert stored(exhausted)[0] == 0
+
+    response = client.post("/api/books/return", headers=headers, json={"book_ids": [available, exhausted, 999999]})
+    assert response.status_code == 200
+    assert response.json()["message"] == "1 of 3 books returned"
+    assert response.json()["results"] == [
+        {"book_id": available, "status": "returned", "count": 3},
+        {"book_id": exhausted, "status": "not_borrowed"},
+        {"book_id": 999999, "status": "not_borrowed"},
+    ]
+    assert stored(available)[0] == 3
+    # returned already
+    response = client.post("/api/books/return", headers=headers, json={"book_ids": [available]})
+    assert response.json()["results"] == [{"book_id": available, "status": "not_borrowed"}]
+    assert stored(available)[0] == 3
+
+
+def test_batch_size_is_capped(client):
+    headers = make_user("bulk batcher")
+    for path in ("/api/books/borrow", "/api/books/return"):
+        assert client.post(path, headers=headers, json={"book_ids": list(range(1, 102))}).status_code == 422
+        assert client.post(path, headers=headers, json={"book_ids": []}).status_code == 422
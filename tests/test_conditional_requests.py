@@ -0,0 +1,109 @@
+import contextlib
+
+
+def new_category(client, admin: dict, title: str) -> int:
+    response = client.post("/api/category", headers=admin, json={"title": title, "description": "-"})
+    assert response.status_code == 200
+    return response.json()["Category"]["id"]
+
+
+def new_book(client, admin: dict, title: str, category_id: int) -> int:
+    response = client.post("/api/book", headers=admin, json={"title": title, "description": "-", "author": "-",
+                                                             "count": 1, "category_id": category_id})
+    assert response.status_code == 200
+    return response.json()["Book"]["id"]
+
+
+@contextlib.contextmanager
+def concurrent_update(table: str, row_id: int):
+    """
+    Bump the version of the row from another connection right before the next flush: an update committed
+    between the endpoint's read and its write
+    """
+    from sqlalchemy import event, text
+    from sqlalchemy.orm import Session
+    from settings import get_engine
+
+    bumped = []
+
+    def bump(session, flush_context, instances):
+        if not bumped:
+            bumped.append(row_id)
+            with get_engine().begin() as connection:
+                connection.execute(text(f"UPDATE {table} SET version = version + 1 WHERE id = :id"), {"id": row_id})
+
+    event.listen(Session, "before_flush", bump)
+    try:
+        yield bumped
+    finally:
+        event.remove(Session, "before_flush", bump)
+
+
+def test_book_conditional_requests(client, admin):
+    category_id = new_category(client, admin, "Conditional books")
+    book_id = new_book(client, admin, "Conditional", category_id)
+    url = f"/api/book/{book_id}"
+
+    response = client.get(url, headers=admin)
+    etag = response.headers["ETag"]
+    response = client.get(url, headers={**admin, "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert client.get(url, headers={**admin, "If-None-Match": f'"other", W/{etag}'}).status_code == 304
+
+    update = {"title": "Conditional, revised", "category_id": category_id}
+    response = client.put(url, headers={**admin, "If-Match": etag}, json=update)
+    assert response.status_code == 200
+    new_etag = response.headers["ETag"]
+    assert new_etag != etag
+    assert client.get(url, headers=admin).headers["ETag"] == new_etag
+    assert client.get(url, headers={**admin, "If-None-Match": etag}).status_code == 200
+
+    # based on the copy from before the update
+    response = client.put(url, headers={**admin, "If-Match": etag}, json={**update, "title": "Lost"})
+    assert response.status_code == 412
+    # a weak ETag never matches If-Match
+    assert client.put(url, headers={**admin, "If-Match": f"W/{new_etag}"}, json=update).status_code == 412
+    assert client.get(url, headers=admin).json()["title"] == "Conditional, revised"
+
+
+def test_book_update_losing_a_version_race(client, admin):
+    category_id = new_category(client, admin, "Raced books")
+    book_id = new_book(client, admin, "Raced", category_id)
+    url = f"/api/book/{book_id}"
+    etag = client.get(url, headers=admin).headers["ETag"]
+
+    # with an If-Match that still matched when the book was read
+    with concurrent_update("books", book_id) as bumped:
+        response = client.put(url, headers={**admin, "If-Match": etag}, json={"title": "Overwritten",
+                                                                              "category_id": category_id})
+    assert bumped and response.status_code == 412
+    with concurrent_update("books", book_id) as bumped:
+        response = client.put(url, headers=admin, json={"title": "Overwritten", "category_id": category_id})
+    assert bumped and response.status_code == 409
+    assert client.get(url, headers=admin).json()["title"] == "Raced"
+
+
+def test_category_conditional_requests(client, admin):
+    category_id = new_category(client, admin, "Conditional")
+    url = f"/api/category/{category_id}"
+
+    etag = client.get(url, headers=admin).headers["ETag"]
+    response = client.get(url, headers={**admin, "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+    update = {"title": "Conditional, revised", "description": "-"}
+    response = client.put(url, headers={**admin, "If-Match": etag}, json=update)
+    assert response.status_code == 200
+    new_etag = response.headers["ETag"]
+    assert new_etag != etag
+    assert client.get(url, headers={**admin, "If-None-Match": new_etag}).status_code == 304
+    assert client.get(url, headers={**admin, "If-None-Match": etag}).status_code == 200
+
+    assert client.put(url, headers={**admin, "If-Match": etag}, json=update).status_code == 412
+    assert client.get(url, headers=admin).json()["title"] == "Conditional, revised"
+
+    with concurrent_update("categories", category_id) as bumped:
+        response = client.put(url, headers=admin, json={"title": "Overwritten", "description": "-"})
+    assert bumped and response.status_code == 409
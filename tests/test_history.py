@@ -0,0 +1,112 @@
+from datetime import date
+
+from conftest import make_user
+
+# (borrowed_date, returned_date) of one reader's loans, oldest first
+LOANS = [
+    (date(2026, 1, 5), date(2026, 1, 10)),
+    (date(2026, 2, 1), date(2026, 2, 20)),
+    (date(2026, 3, 3), None),
+    (date(2026, 3, 15), date(2026, 4, 1)),
+    (date(2026, 4, 2), None),
+]
+
+
+def new_history(name: str):
+    """
+    :return: (user id, history ids of LOANS) of a new reader with the loans recorded
+    """
+    from models import ActionType, Book, User, UserBookHistory
+    from settings import SessionLocal
+
+    db = SessionLocal()
+    user = User(name=name, email=f"{name}@example.com", password="-", is_active=True)
+    book = Book(title=f"{name} book", description="-", author="-", count=1)
+    db.add_all([user, book])
+    db.flush()
+    rows = [UserBookHistory(user_id=user.id, book_id=book.id, borrowed_date=borrowed, returned_date=returned,
+                            action=ActionType.BORROW if returned is None else ActionType.RETURN)
+            for borrowed, returned in LOANS]
+    db.add_all(rows)
+    db.commit()
+    user_id, ids = user.id, [row.id for row in rows]
+    db.close()
+    return user_id, ids
+
+
+def history_ids(client, headers: dict, **params):
+    response = client.get("/api/history/", headers=headers, params=params)
+    assert response.status_code == 200
+    return [row["id"] for row in response.json()]
+
+
+def test_history_pages_follow_the_cursor(client, admin):
+    user_id, ids = new_history("paged")
+    pages, cursor = [], None
+    while True:
+        params = {"user_id": user_id, "limit": 2, **({"cursor": cursor} if cursor else {})}
+        response = client.get("/api/history/", headers=admin, params=params)
+        assert response.status_code == 200
+        pages.append([row["id"] for row in response.json()])
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    newest_first = ids[::-1]
+    assert pages == [newest_first[:2], newest_first[2:4], newest_first[4:]]
+
+
+def test_history_rejects_foreign_cursors(client, admin):
+    from api.book.utils import encode_cursor
+
+    for cursor in ("not a cursor", encode_cursor({"o": "title", "t": "", "id": 1})):
+        response = client.get("/api/history/", headers=admin, params={"cursor": cursor})
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Invalid cursor"
+
+
+def test_history_filters(client, admin):
+    user_id, ids = new_history("filtered")
+
+    def matching(**params):
+        return history_ids(client, admin, user_id=user_id, **params)
+
+    assert matching(borrowed_from="2026-02-01", borrowed_to="2026-03-15") == [ids[3], ids[2], ids[1]]
+    assert matching(borrowed_from="2026-03-16") == [ids[4]]
+    assert matching(returned_from="2026-01-11", returned_to="2026-04-01") == [ids[3], ids[1]]
+    assert matching(borrowed_date="2026-01-05") == [ids[0]]
+    assert matching(open_only=True) == [ids[4], ids[2]]
+    assert matching(open_only=True, borrowed_to="2026-03-31") == [ids[2]]
+
+
+def test_history_total_counts_every_page(client, admin):
+    user_id, ids = new_history("counted")
+    response = client.get("/api/history/", headers=admin, params={"user_id": user_id, "limit": 2,
+                                                                   "include_total": True})
+    assert response.headers["X-Total-Count"] == str(len(ids))
+    assert len(response.json()) == 2
+    response = client.get("/api/history/", headers=admin, params={"user_id": user_id, "open_only": True,
+                                                                   "include_total": True})
+    assert response.headers["X-Total-Count"] == "2"
+    response = client.get("/api/history/", headers=admin, params={"user_id": user_id})
+    assert "X-Total-Count" not in response.headers
+
+
+def test_history_is_for_admins(client):
+    assert client.get("/api/history/", headers=make_user("curious")).status_code == 403
+
+
+def test_history_include_archived(client, admin):
+    from api.book.archive_history import archive_history
+
+    user_id, ids = new_history("archived")
+    # the loans closed before March move to user_book_history_archive, the open one of March stays
+    assert archive_history(date(2026, 3, 1))["loans_moved"] >= 2
+
+    assert history_ids(client, admin, user_id=user_id) == [ids[4], ids[3], ids[2]]
+    assert history_ids(client, admin, user_id=user_id, include_archived=True) == ids[::-1]
+    response = client.get("/api/history/", headers=admin, params={"user_id": user_id, "include_archived": True,
+                                                                   "limit": 3, "include_total": True})
+    assert response.headers["X-Total-Count"] == str(len(ids))
+    assert history_ids(client, admin, user_id=user_id, include_archived=True,
+                       cursor=response.headers["X-Next-Cursor"]) == [ids[1], ids[0]]
+    assert history_ids(client, admin, user_id=user_id, include_archived=True, borrowed_to="2026-01-31") == [ids[0]]
@@ -0,0 +1,30 @@
+from sqlalchemy import text
+
+from models import Book, Category
+from settings import SessionLocal, get_engine
+
+
+def test_import_reports_rows_the_database_rejects(client, admin):
+    db = SessionLocal()
+    db.add(Category(title="Imported", description="-"))
+    db.commit()
+    db.close()
+    with get_engine().begin() as connection:
+        connection.execute(text("CREATE TRIGGER reject_title BEFORE INSERT ON books WHEN new.title = 'reject' "
+                                "BEGIN SELECT RAISE(ABORT, 'title rejected'); END"))
+    try:
+        body = "title,author,count,category\n" + "".join(
+            f"{'reject' if i in (3, 7) else f'Imported {i}'},Author,1,imported\n" for i in range(10))
+        response = client.post("/api/books/import?format=csv", content=body, headers=admin)
+    finally:
+        with get_engine().begin() as connection:
+            connection.execute(text("DROP TRIGGER reject_title"))
+    assert response.status_code == 200, response.text
+    report = response.json()
+    assert report["imported"] == 8 and report["failed"] == 2
+    assert report["errors"] == [{"line": 5, "error": "rejected by the database: title rejected"},
+                                {"line": 9, "error": "rejected by the database: title rejected"}]
+    db = SessionLocal()
+    imported = db.query(Book).filter(Book.title.like("Imported %")).all()
+    assert len(imported) == 8 and all(len(book.categories) == 1 for book in imported)
+    db.close()
@@ -0,0 +1,78 @@
+import os
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, inspect as sa_inspect, text
+
+import models
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def alembic_config(url: str) -> Config:
+    config = Config(os.path.join(ROOT, "alembic.ini"))
+    config.set_main_option("script_location", os.path.join(ROOT, "alembic"))
+    config.set_main_option("sqlalchemy.url", url)
+    return config
+
+
+def test_sqlite_search_indexes_are_added_to_an_existing_database(tmp_path):
+    url = f"sqlite:///{tmp_path}/existing.db"
+    engine = create_engine(url)
+    models.create_schema(engine)
+    with engine.begin() as connection:
+        # a database from before the search indexes
+        for index in ("books_fts", "books_trgm"):
+            for trigger in ("insert", "delete", "update"):
+                connection.execute(text(f"DROP TRIGGER {index}_{trigger}"))
+            connection.execute(text(f"DROP TABLE {index}"))
+        connection.execute(text("INSERT INTO books (title, author, description, count, version) "
+                                "VALUES ('Foundation', 'Asimov', 'psychohistory', 3, 1)"))
+    config = alembic_config(url)
+    command.stamp(config, "6b1e9d3f2a47")
+    command.upgrade(config, "head")
+
+    with engine.begin() as connection:
+        def search(index, query):
+            return connection.execute(text(f"SELECT rowid FROM {index} WHERE {index} MATCH :q"), {"q": query}).all()
+
+        assert search("books_fts", "psychohistory") == [(1,)]
+        assert search("books_trgm", "asim") == [(1,)]
+        connection.execute(text("UPDATE books SET title = 'Dune' WHERE id = 1"))
+        assert search("books_fts", "dune") == [(1,)]
+        assert search("books_fts", "foundation") == []
+        # a count change leaves the indexes alone
+        triggers = connection.execute(text("SELECT sql FROM sqlite_master WHERE type = 'trigger' "
+                                           "AND name IN ('books_fts_update', 'books_trgm_update')")).scalars().all()
+        assert len(triggers) == 2 and all("AFTER UPDATE OF title, author" in sql for sql in triggers)
+    engine.dispose()
+
+
+def test_sqlite_history_borrowed_date_becomes_not_null(tmp_path):
+    url = f"sqlite:///{tmp_path}/history.db"
+    engine = create_engine(url)
+    models.create_schema(engine)
+    with engine.begin() as connection:
+        # user_book_history as it was before the partitioning, borrowed_date nullable
+        connection.execute(text("DROP TABLE user_book_history"))
+        connection.execute(text("CREATE TABLE user_book_history (id INTEGER NOT NULL PRIMARY KEY, "
+                                "user_id INTEGER REFERENCES users (id), book_id INTEGER REFERENCES books (id), "
+                                "borrowed_date DATE, returned_date DATE, action VARCHAR(6))"))
+        connection.execute(text("CREATE INDEX ix_user_book_history_open_loans ON user_book_history "
+                                "(user_id, book_id) WHERE returned_date IS NULL"))
+        connection.execute(text("INSERT INTO user_book_history (user_id, book_id, borrowed_date, returned_date) "
+                                "VALUES (1, 1, NULL, '2026-01-02'), (1, 2, '2026-01-03', NULL)"))
+    config = alembic_config(url)
+    command.stamp(config, "5b8e2d41c7a9")
+    command.upgrade(config, "head")
+
+    with engine.begin() as connection:
+        columns = {column["name"]: column for column in sa_inspect(connection).get_columns("user_book_history")}
+        assert columns["borrowed_date"]["nullable"] is False
+        assert connection.execute(text("SELECT borrowed_date FROM user_book_history ORDER BY id")).scalars().all() \
+            == ["2026-01-02", "2026-01-03"]
+        # the open loans index stays partial
+        index = connection.execute(text("SELECT sql FROM sqlite_master "
+                                        "WHERE name = 'ix_user_book_history_open_loans'")).scalar()
+        assert "WHERE returned_date IS NULL" in index
+    engine.dispose()
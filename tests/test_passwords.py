@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from passlib.hash import bcrypt
+
+from api.account import utils
+
+
+def test_saturated_hashing_pool_answers_503(monkeypatch):
+    monkeypatch.setattr(utils, "PASSWORD_HASH_QUEUE_TIMEOUT", 0.05)
+
+    async def scenario():
+        slots = utils.get_hash_slots()
+        # every slot taken by hashes in progress
+        for _ in range(utils.PASSWORD_HASH_CONCURRENCY):
+            await slots.acquire()
+        try:
+            await utils.hash_password("secret")
+        finally:
+            for _ in range(utils.PASSWORD_HASH_CONCURRENCY):
+                slots.release()
+
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(scenario())
+    assert raised.value.status_code == 503
+    assert raised.value.headers["Retry-After"] == "1"
+
+
+def test_hashing_pool_serves_each_event_loop():
+    # the semaphore is created in the running loop, not at import
+    for _ in range(2):
+        assert asyncio.run(utils.verify_and_update_password("secret", utils.get_password_hash("secret")))[0]
+
+
+def test_login_rehashes_a_password_of_another_cost(client):
+    from models import User
+    from settings import SessionLocal
+
+    db = SessionLocal()
+    user = User(name="old", email="old-hash@example.com", password=bcrypt.using(rounds=5).hash("secret"),
+                is_active=True, is_admin=False)
+    db.add(user)
+    db.commit()
+    user_id = user.id
+    db.close()
+
+    def login(password):
+        return client.post("/api/user/login", json={"email": "old-hash@example.com", "password": password})
+
+    def stored_hash():
+        db = SessionLocal()
+        try:
+            return db.get(User, user_id).password
+        finally:
+            db.close()
+
+    assert login("secret").status_code == 200
+    upgraded = stored_hash()
+    assert upgraded.startswith("$2b$04$")
+    # the new hash logs in and is kept
+    assert login("secret").status_code == 200
+    assert stored_hash() == upgraded
+    assert login("wrong").status_code == 401
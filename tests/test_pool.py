@@ -0,0 +1,31 @@
+from sqlalchemy import text
+
+from settings import get_db, pool_stats
+
+
+def test_lazy_session_records_the_checkout(client, reader):
+    from models import Book
+    from settings import SessionLocal
+
+    db = SessionLocal()
+    book = Book(title="Pooled", description="-", author="-", count=1)
+    db.add(book)
+    db.commit()
+    book_id = book.id
+    db.close()
+
+    acquired = pool_stats.acquired
+    # served through get_lazy_async_db, the book is not cached yet
+    assert client.get(f"/api/book/{book_id}", headers=reader).status_code == 200
+    assert pool_stats.acquired > acquired
+    # from the cache, no connection
+    acquired = pool_stats.acquired
+    assert client.get(f"/api/book/{book_id}", headers=reader).status_code == 200
+    assert pool_stats.acquired == acquired
+
+
+def test_get_db_closes_the_session(client):
+    with get_db() as db:
+        assert db.execute(text("SELECT 1")).scalar() == 1
+        assert db.in_transaction()
+    assert not db.in_transaction()
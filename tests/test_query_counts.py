@@ -0,0 +1,53 @@
+import pytest
+
+from query_profiler import capture_queries
+
+# statements per request are independent of the number of rows served, a query per row (N+1) fails here
+BOOKS = 12
+
+
+@pytest.fixture(scope="module")
+def book_ids(client):
+    from models import Book, Category
+    from settings import SessionLocal
+
+    db = SessionLocal()
+    categories = [Category(title=f"Shelf {i}", description="-") for i in range(4)]
+    books = [Book(title=f"Counted {i}", description="-", author="-", count=5,
+                  categories=[categories[i % 4], categories[(i + 1) % 4]]) for i in range(BOOKS)]
+    db.add_all(books)
+    db.commit()
+    ids = [book.id for book in books]
+    db.close()
+    return ids
+
+
+def served(client, method: str, path: str, headers: dict, **kwargs):
+    with capture_queries() as captured:
+        response = client.request(method, path, headers=headers, **kwargs)
+    assert response.status_code < 400, response.text
+    assert len(captured.profiles) == 1
+    captured.assert_no_repeats(threshold=2)
+    return captured
+
+
+def test_books_page(client, reader, book_ids):
+    served(client, "GET", f"/api/books?limit={BOOKS}", reader).assert_max_queries(1, route="/api/books")
+
+
+def test_all_books_with_categories(client, reader, book_ids):
+    served(client, "GET", "/api/all-books", reader).assert_max_queries(1, route="/api/all-books")
+
+
+def test_book_with_categories(client, reader, book_ids):
+    # book, its category ids, its categories, whatever the number of categories
+    served(client, "GET", f"/api/book/{book_ids[0]}", reader).assert_max_queries(3, route="/api/book/{book_id}")
+    # then from the cache
+    served(client, "GET", f"/api/book/{book_ids[0]}", reader).assert_max_queries(0, route="/api/book/{book_id}")
+
+
+def test_borrow_and_return(client, reader, book_ids):
+    served(client, "POST", f"/api/book/{book_ids[1]}/borrow", reader).assert_max_queries(
+        3, route="/api/book/{book_id}/borrow")
+    served(client, "POST", f"/api/book/{book_ids[1]}/return", reader).assert_max_queries(
+        3, route="/api/book/{book_id}/return")
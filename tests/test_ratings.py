@@ -0,0 +1,118 @@
+import asyncio
+
+from conftest import make_user
+
+
+def new_book(title: str) -> int:
+    from models import Book
+    from settings import SessionLocal
+
+    db = SessionLocal()
+    book = Book(title=title, description="-", author="-", count=10)
+    db.add(book)
+    db.commit()
+    book_id = book.id
+    db.close()
+    return book_id
+
+
+def rate(client, headers: dict, book_id: int, stars: int):
+    return client.post(f"/api/book/{book_id}/rating", json={"rating": stars}, headers=headers)
+
+
+def borrower(client, name: str, *book_ids: int) -> dict:
+    headers = make_user(name)
+    for book_id in book_ids:
+        assert client.post(f"/api/book/{book_id}/borrow", headers=headers).status_code == 200
+    return headers
+
+
+def summary(client, headers: dict, book_id: int) -> dict:
+    response = client.get(f"/api/book/{book_id}/rating", headers=headers)
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_rating_requires_a_loan(client, reader):
+    book_id = new_book("Unread")
+    response = rate(client, reader, book_id, 4)
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Book is not borrowed by the user"
+    assert summary(client, reader, book_id) == {"book_id": book_id, "average": 0.0, "count": 0,
+                                                "histogram": {str(stars): 0 for stars in range(1, 6)}}
+
+
+def test_first_rating_and_re_rating_keep_the_summary(client):
+    book_id = new_book("Rated")
+    first, second = borrower(client, "rater1", book_id), borrower(client, "rater2", book_id)
+
+    response = rate(client, first, book_id, 3)
+    assert response.status_code == 200
+    assert response.json()["rating"] == "THREE_STARS"
+    assert rate(client, second, book_id, 5).status_code == 200
+    assert summary(client, first, book_id) == {"book_id": book_id, "average": 4.0, "count": 2,
+                                               "histogram": {"1": 0, "2": 0, "3": 1, "4": 0, "5": 1}}
+
+    # rating again replaces the user's rating, the count stays
+    assert rate(client, first, book_id, 1).json()["rating"] == "ONE_STAR"
+    assert rate(client, first, book_id, 1).status_code == 200
+    assert summary(client, first, book_id) == {"book_id": book_id, "average": 3.0, "count": 2,
+                                               "histogram": {"1": 1, "2": 0, "3": 0, "4": 0, "5": 1}}
+
+
+def test_concurrent_change_of_the_same_rating_conflicts(client):
+    from api.book.book_api_endpoints import rate_book
+    from fastapi import HTTPException
+    from models import UserBookRating
+    from schema import CurrentUser, RatingCreate
+    from settings import AsyncSessionLocal, SessionLocal
+
+    book_id = new_book("Raced")
+    headers = borrower(client, "racer", book_id)
+    assert rate(client, headers, book_id, 3).status_code == 200
+
+    async def scenario():
+        async with AsyncSessionLocal() as db:
+            # this request read the rating (3 stars) ...
+            rating = (await db.execute(UserBookRating.__table__.select().where(
+                UserBookRating.book_id == book_id))).first()
+            stale = await db.get(UserBookRating, rating.id)
+            user = CurrentUser(id=rating.user_id, name="racer", is_admin=False, is_active=True)
+            # ... while a concurrent one of the same user changed it to 5 stars
+            assert rate(client, headers, book_id, 5).status_code == 200
+            assert stale.rating.value == 3
+            try:
+                await rate_book(book_id, RatingCreate(rating=1), db=db, current_user=user)
+            except HTTPException as e:
+                return e.status_code
+
+    assert asyncio.run(scenario()) == 409
+    assert summary(client, headers, book_id) == {"book_id": book_id, "average": 5.0, "count": 1,
+                                                 "histogram": {"1": 0, "2": 0, "3": 0, "4": 0, "5": 1}}
+    db = SessionLocal()
+    assert db.query(UserBookRating).filter_by(book_id=book_id).one().rating.value == 5
+    db.close()
+
+
+def test_top_rated_pages_follow_the_cursor(client, reader):
+    ids = [new_book(f"Top {stars}") for stars in (2, 5, 4, 5)]
+    headers = borrower(client, "top-rater", *ids)
+    for book_id, stars in zip(ids, (2, 5, 4, 5)):
+        assert rate(client, headers, book_id, stars).status_code == 200
+
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        response = client.get("/api/books/top-rated", params=params, headers=reader)
+        assert response.status_code == 200
+        seen += [(entry["book"]["id"], entry["average"]) for entry in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert len(seen) == len(set(seen))
+    averages = [average for _, average in seen]
+    assert averages == sorted(averages, reverse=True)
+    # equal averages, newest book first
+    ours = [book_id for book_id, _ in seen if book_id in ids]
+    assert ours == [ids[3], ids[1], ids[2], ids[0]]
+    assert client.get("/api/books/top-rated", params={"cursor": "nonsense"}, headers=reader).status_code == 400
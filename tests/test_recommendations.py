@@ -0,0 +1,97 @@
+import asyncio
+
+from api.book import recommendations
+from api.book.recommendations import CoBorrowIndex
+from conftest import make_user
+
+
+def new_book(title: str) -> int:
+    from models import Book
+    from settings import SessionLocal
+
+    db = SessionLocal()
+    book = Book(title=title, description="-", author="-", count=5)
+    db.add(book)
+    db.commit()
+    book_id = book.id
+    db.close()
+    return book_id
+
+
+def refresh(index: CoBorrowIndex):
+    from settings import AsyncSessionLocal
+
+    async def run():
+        async with AsyncSessionLocal() as db:
+            await index.refresh(db)
+
+    asyncio.run(run())
+
+
+def test_counts_readers_of_both_books():
+    index = CoBorrowIndex()
+    index.add([1, 1, 1, 2, 2], [10, 11, 12, 10, 11], [1, 2, 3, 4, 5])
+    assert index.similar(10, 5) == [(11, 2), (12, 1)]
+    assert index.similar(12, 1) == [(10, 1)]
+    assert index.similar(99, 5) == []
+
+
+def test_reloaded_loans_are_not_counted_twice():
+    index = CoBorrowIndex(reader_books=2)
+    index.add([1, 1, 1], [10, 11, 12], [1, 2, 3])
+    # a refresh reads the overlap again, book 10 left the reader's books meanwhile
+    index.add([1, 1, 1], [10, 11, 12], [1, 2, 3])
+    assert index.similar(11, 5) == [(12, 1)]
+    assert index.similar(10, 5) == []
+
+
+def test_loan_committed_late_is_applied():
+    index = CoBorrowIndex()
+    index.add([1], [10], [2])
+    # history id 1 was committed after id 2 had been read
+    index.add([1, 1], [11, 10], [1, 2])
+    assert index.similar(10, 5) == [(11, 1)]
+
+
+def test_reader_counts_with_their_most_recent_books():
+    index = CoBorrowIndex(reader_books=2)
+    index.add([1, 1, 1], [10, 11, 12], [1, 2, 3])
+    assert index.similar(10, 5) == []
+    # borrowing book 11 again makes it recent, book 12 drops out when 13 comes
+    index.add([1, 1], [11, 13], [4, 5])
+    assert index.similar(11, 5) == [(13, 1)]
+    assert index.similar(12, 5) == []
+
+
+def test_refresh_builds_then_applies_new_loans(client):
+    first, second, third = new_book("Together"), new_book("Together too"), new_book("Together later")
+    readers = [make_user("co-reader"), make_user("co-reader too")]
+    for headers in readers:
+        for book_id in (first, second):
+            assert client.post(f"/api/book/{book_id}/borrow", headers=headers).status_code == 200
+
+    index = CoBorrowIndex()
+    refresh(index)
+    assert index.built
+    assert index.similar(first, 5) == [(second, 2)]
+    assert client.post(f"/api/book/{third}/borrow", headers=readers[0]).status_code == 200
+    refresh(index)
+    assert index.similar(first, 5) == [(second, 2), (third, 1)]
+
+
+def test_requests_only_read_the_index(client, monkeypatch):
+    first, second = new_book("Read only"), new_book("Read only too")
+    reader = make_user("index reader")
+    for book_id in (first, second):
+        assert client.post(f"/api/book/{book_id}/borrow", headers=reader).status_code == 200
+    url = f"/api/book/{first}/recommendations"
+
+    # not built yet: no recommendations rather than a build in the request
+    index = CoBorrowIndex()
+    monkeypatch.setattr(recommendations, "index", index)
+    assert client.get(url, headers=reader).json() == []
+    assert not index.built
+
+    refresh(index)
+    response = client.get(url, headers=reader).json()
+    assert [(item["book"]["id"], item["readers"]) for item in response] == [(second, 1)]
@@ -0,0 +1,58 @@
+from typing import List, Optional
+
+import pytest
+from fastapi import APIRouter, FastAPI
+from fastapi.testclient import TestClient
+from pydantic import BaseModel, ValidationError
+
+from responses import ORJSONRoute
+
+
+class Item(BaseModel):
+    id: int
+    title: str
+
+
+def make_client(content) -> TestClient:
+    router = APIRouter(route_class=ORJSONRoute)
+
+    @router.get("/items", response_model=List[Item])
+    async def items():
+        return content
+
+    app = FastAPI()
+    app.include_router(router)
+    return TestClient(app)
+
+
+def test_response_is_limited_to_the_model_fields():
+    response = make_client([{"id": 1, "title": "Dune", "password": "secret"}]).get("/items")
+    assert response.json() == [{"id": 1, "title": "Dune"}]
+
+
+def test_response_values_are_coerced_by_the_model():
+    assert make_client([{"id": "1", "title": "Dune"}]).get("/items").json() == [{"id": 1, "title": "Dune"}]
+
+
+@pytest.mark.parametrize("content", [[{"id": "one", "title": "Dune"}], [{"id": 1}]])
+def test_invalid_response_fails_the_request(content):
+    with pytest.raises(ValidationError):
+        make_client(content).get("/items")
+
+
+class Shelf(BaseModel):
+    title: str
+    note: Optional[str]
+    items: List[Item]
+
+
+def test_validated_models_are_rendered_without_none():
+    router = APIRouter(route_class=ORJSONRoute)
+
+    @router.get("/shelf", response_model=Shelf, response_model_exclude_none=True)
+    async def shelf():
+        return {"title": "Fiction", "note": None, "items": [{"id": "2", "title": "Dune"}]}
+
+    app = FastAPI()
+    app.include_router(router)
+    assert TestClient(app).get("/shelf").json() == {"title": "Fiction", "items": [{"id": 2, "title": "Dune"}]}
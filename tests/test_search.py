@@ -0,0 +1,33 @@
+import pytest
+
+from models import Book
+from settings import SessionLocal
+
+
+@pytest.fixture(scope="module")
+def books(client):
+    db = SessionLocal()
+    db.query(Book).delete()
+    db.add_all([Book(title=title, description="-", author=author, count=1) for title, author in (
+        ("Dune", "Frank Herbert"), ("Foundation", "Isaac Asimov"), ("Dune Messiah", "Frank Herbert"))])
+    db.commit()
+    db.close()
+
+
+def titles(client, headers, url):
+    response = client.get(url, headers=headers)
+    assert response.status_code == 200, response.text
+    return [book["title"] for book in response.json()]
+
+
+def test_search_matches_every_term_by_prefix(client, reader, books):
+    assert titles(client, reader, "/api/search-books?q=dune messi") == ["Dune Messiah"]
+    assert titles(client, reader, "/api/search-books?q=herb&fuzzy=false") == ["Dune", "Dune Messiah"]
+
+
+def test_fuzzy_search_tolerates_typos(client, reader, books):
+    assert titles(client, reader, "/api/search-books?q=foundatoin&fuzzy=false") == []
+    assert titles(client, reader, "/api/search-books?q=foundatoin") == ["Foundation"]
+    assert titles(client, reader, "/api/search-books?q=asimof") == ["Foundation"]
+    # exact matches rank before typo tolerant ones
+    assert titles(client, reader, "/api/search-books?q=dune") == ["Dune", "Dune Messiah"]
@@ -0,0 +1,66 @@
+import jwt
+
+
+def register(client, name: str) -> tuple:
+    """
+    :return: (user id, login response) of a new user
+    """
+    user = {"name": name, "email": f"{name}@example.com", "password": "secret"}
+    user_id = client.post("/api/user/register", json=user).json()["id"]
+    response = client.post("/api/user/login", json={"email": user["email"], "password": "secret"})
+    assert response.status_code == 200
+    return user_id, response.json()
+
+
+def bearer(tokens: dict) -> dict:
+    return {"Authorization": f"Bearer {tokens['access_token']}"}
+
+
+def claims(tokens: dict) -> dict:
+    return jwt.decode(tokens["access_token"], options={"verify_signature": False})
+
+
+def refresh(client, tokens: dict):
+    return client.post("/api/user/token/refresh", json={"refresh_token": tokens["refresh_token"]})
+
+
+def test_a_refresh_token_is_redeemed_once(client):
+    _, tokens = register(client, "refresher")
+    response = refresh(client, tokens)
+    assert response.status_code == 200
+    renewed = response.json()
+    assert renewed["refresh_token"] != tokens["refresh_token"]
+    assert client.get("/api/categories", headers=bearer(renewed)).status_code == 200
+
+    # the same jti again, e.g. a stolen token replayed
+    replayed = refresh(client, tokens)
+    assert replayed.status_code == 401
+    assert replayed.json()["detail"] == "Invalid authentication credentials"
+    # the renewed one is good for one more exchange
+    assert refresh(client, renewed).status_code == 200
+    assert refresh(client, renewed).status_code == 401
+
+
+def test_refresh_rejects_access_tokens(client):
+    _, tokens = register(client, "mixedup")
+    response = client.post("/api/user/token/refresh", json={"refresh_token": tokens["access_token"]})
+    assert response.status_code == 401
+
+
+def test_activation_change_revokes_the_access_tokens(client, admin):
+    user_id, tokens = register(client, "activated")
+    assert claims(tokens)["act"] is False
+    assert client.get("/api/categories", headers=bearer(tokens)).status_code == 200
+
+    response = client.put(f"/api/user/{user_id}/activate", headers=admin, json={"is_active": True})
+    assert response.status_code == 200
+    # issued before the change, its act claim is stale
+    response = client.get("/api/categories", headers=bearer(tokens))
+    assert response.status_code == 401
+    # the refresh token re-reads the users row
+    response = refresh(client, tokens)
+    assert response.status_code == 200
+    assert claims(response.json())["act"] is True
+    assert client.get("/api/categories", headers=bearer(response.json())).status_code == 200
+    # the admin's own tokens are left alone
+    assert client.get("/api/categories", headers=admin).status_code == 200